@@ -0,0 +1,199 @@
+"""
+Reading-history analytics backed by rollup tables
+
+The dashboard never scans user_books. Every borrow and return adds its
+counts to ReadingRollup rows (per month and 'all') and AuthorRollup
+rows, for the reader and for the whole library (user_id 0), inside the
+same transaction as the change itself. A dashboard is then a handful of
+primary-key lookups however long the history is.
+
+`flask analytics-backfill` (also run by migration 9) rebuilds every
+rollup from user_books in one transaction, for existing data or if the
+counters are ever suspected to have drifted.
+"""
+from collections import Counter, defaultdict
+from datetime import date
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects import mysql, sqlite, postgresql
+
+from extensions import db
+from models import ReadingRollup, AuthorRollup, UserBook
+
+LIBRARY = 0
+ALL_TIME = 'all'
+TOP_AUTHORS = 10
+ROLLUP_COUNTERS = ('borrowed', 'returned', 'returned_on_time', 'loan_days')
+
+
+def month_period(day):
+    return day.strftime('%Y-%m')
+
+
+class Deltas:
+    """Counter changes for a batch of borrows and returns, keyed by row"""
+
+    def __init__(self):
+        self.rollups = defaultdict(Counter)
+        self.authors = Counter()
+
+    def borrow(self, user_id, author, borrow_date):
+        for scope in (user_id, LIBRARY):
+            for period in (month_period(borrow_date), ALL_TIME):
+                self.rollups[(scope, period)]['borrowed'] += 1
+            self.authors[(scope, author)] += 1
+
+    def give_back(self, user_id, borrow_date, due_date, return_date):
+        for scope in (user_id, LIBRARY):
+            for period in (month_period(return_date), ALL_TIME):
+                counts = self.rollups[(scope, period)]
+                counts['returned'] += 1
+                counts['returned_on_time'] += return_date <= due_date
+                counts['loan_days'] += max(0, (return_date - borrow_date).days)
+
+    def rows(self):
+        """
+        Returns:
+            Tuple of (reading_rollups rows, reading_author_rollups rows),
+            each sorted by primary key
+        """
+        rollups = [
+            dict(user_id=user_id, period=period, **{name: counts[name] for name in ROLLUP_COUNTERS})
+            for (user_id, period), counts in sorted(self.rollups.items())
+        ]
+        authors = [
+            {'user_id': user_id, 'author': author, 'borrowed': borrowed}
+            for (user_id, author), borrowed in sorted(self.authors.items())
+        ]
+        return rollups, authors
+
+
+def upsert_statement(model, counters, dialect):
+    """INSERT that adds to the counters of an existing row instead"""
+    table = model.__table__
+    if dialect == 'mysql':
+        stmt = mysql.insert(table)
+        return stmt.on_duplicate_key_update(
+            {name: table.c[name] + stmt.inserted[name] for name in counters})
+    module = postgresql if dialect == 'postgresql' else sqlite
+    stmt = module.insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[column.name for column in table.primary_key],
+        set_={name: table.c[name] + stmt.excluded[name] for name in counters}
+    )
+
+
+def apply(deltas):
+    """Write a batch of deltas inside the current transaction, one upsert per table"""
+    dialect = db.session.get_bind().dialect.name
+    # Sorted rows: concurrent writers lock shared rows in the same order
+    # and cannot deadlock
+    rollups, authors = deltas.rows()
+    if rollups:
+        db.session.execute(upsert_statement(ReadingRollup, ROLLUP_COUNTERS, dialect), rollups)
+    if authors:
+        db.session.execute(upsert_statement(AuthorRollup, ('borrowed',), dialect), authors)
+
+
+def record_borrows(books):
+    """Count new UserBook rows; call before committing them"""
+    deltas = Deltas()
+    for book in books:
+        deltas.borrow(book.user_id, book.author, book.borrow_date)
+    apply(deltas)
+
+
+def record_returns(books):
+    """Count UserBook rows that were just marked returned"""
+    deltas = Deltas()
+    for book in books:
+        deltas.give_back(book.user_id, book.borrow_date, book.due_date, book.return_date)
+    apply(deltas)
+
+
+def recent_months(today, count):
+    """The last `count` month periods, oldest first"""
+    year, month = today.year, today.month
+    periods = []
+    for _ in range(count):
+        periods.append(f"{year:04d}-{month:02d}")
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return periods[::-1]
+
+
+def summary(user_id, months=12, today=None):
+    """
+    Dashboard figures for one reader, or the library with user_id 0
+
+    Returns:
+        Dict with per-month borrow and return counts, lifetime totals,
+        average loan length in days, on-time return rate (None before
+        any return) and the most borrowed authors
+    """
+    periods = recent_months(today or date.today(), months)
+    rows = {
+        row.period: row for row in ReadingRollup.query.filter(
+            ReadingRollup.user_id == user_id,
+            ReadingRollup.period.in_(periods + [ALL_TIME])
+        )
+    }
+    total = rows.get(ALL_TIME)
+    returned = total.returned if total else 0
+    authors = db.session.execute(
+        select(AuthorRollup.author, AuthorRollup.borrowed)
+        .where(AuthorRollup.user_id == user_id)
+        .order_by(AuthorRollup.borrowed.desc(), AuthorRollup.author)
+        .limit(TOP_AUTHORS)
+    ).all()
+    return {
+        'months': [
+            {'period': period,
+             'borrowed': rows[period].borrowed if period in rows else 0,
+             'returned': rows[period].returned if period in rows else 0}
+            for period in periods
+        ],
+        'borrowed': total.borrowed if total else 0,
+        'returned': returned,
+        'average_loan_days': round(total.loan_days / returned, 1) if returned else None,
+        'on_time_rate': round(total.returned_on_time / returned, 3) if returned else None,
+        'top_authors': [{'author': author, 'borrowed': count} for author, count in authors],
+    }
+
+
+def rebuild(conn, batch_size=5000):
+    """
+    Recompute every rollup from user_books on a connection
+
+    Reads user_books in primary-key batches, so only the rollup rows are
+    held in memory, and replaces the rollup tables' contents in the
+    caller's transaction.
+
+    Returns:
+        Number of user_books rows counted
+    """
+    deltas = Deltas()
+    books = UserBook.__table__
+    last_id, seen = 0, 0
+    while True:
+        batch = conn.execute(
+            select(books.c.id, books.c.user_id, books.c.author, books.c.borrow_date,
+                   books.c.due_date, books.c.return_date, books.c.is_returned)
+            .where(books.c.id > last_id).order_by(books.c.id).limit(batch_size)
+        ).all()
+        if not batch:
+            break
+        for row in batch:
+            deltas.borrow(row.user_id, row.author, row.borrow_date)
+            if row.is_returned and row.return_date is not None:
+                deltas.give_back(row.user_id, row.borrow_date, row.due_date, row.return_date)
+        last_id = batch[-1].id
+        seen += len(batch)
+
+    conn.execute(delete(ReadingRollup.__table__))
+    conn.execute(delete(AuthorRollup.__table__))
+    rollups, authors = deltas.rows()
+    for table, rows in ((ReadingRollup.__table__, rollups), (AuthorRollup.__table__, authors)):
+        for start in range(0, len(rows), batch_size):
+            conn.execute(insert(table), rows[start:start + batch_size])
+    return seen
+rebuild.description = "rebuild reading analytics rollups from user_books"
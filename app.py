@@ -1,46 +1,199 @@
 # app.py
-from flask import Flask
 import os
-from dotenv import load_dotenv
-import pymysql
-from extensions import db, login_manager
-from models import User  # Add this import at the top
-from flask_mail import Mail
-from email_service import mail, send_welcome_email
+import tempfile
+
+from flask import Flask
+from flask.cli import AppGroup
+
+from extensions import db, login_manager, mail
+import db_pool
+import query_counter
+import metrics
+import stats
+import outbox
+import image_pipeline
+import upload_storage
+import search_index
+import circulation
+import user_cache
+import assets
+import http_cache
+import passwords
+import live
+import user_book_batches
+
+
+class LazyCommands(AppGroup):
+    """
+    CLI group that imports commands.py the first time a command is
+    looked up, so web workers never load the import/export and
+    migration tooling
+    """
+
+    def load(self):
+        import commands  # noqa: F401  (registers onto app.cli)
+
+    def list_commands(self, ctx):
+        self.load()
+        return super().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        self.load()
+        return super().get_command(ctx, name)
 
-pymysql.install_as_MySQLdb()
-load_dotenv()
 
 # Initialize Flask app
 app = Flask(__name__)
+app.cli = LazyCommands(name=app.name)
+
+
+def load_env():
+    """Read .env if there is one; hosted deployments set the environment directly"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+    if os.path.exists(path):
+        from dotenv import load_dotenv
+        load_dotenv(path)
+
+
+def create_app():
+    """
+    Configure the app, initialise extensions and register routes
+
+    Nothing here connects to the database or starts a thread or process,
+    so a preforking server can build the app once in its master process
+    (gunicorn --preload wsgi:app) and fork workers from it; db_pool drops
+    inherited connections in each child. Views register on the module's
+    single app, so later calls return it unchanged.
+    """
+    if app.extensions.get('library_system'):
+        return app
+    load_env()
+
+    # Configure app
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL') or f"mysql+pymysql://{os.getenv('MYSQL_USER')}:{os.getenv('MYSQL_PASSWORD')}@{os.getenv('MYSQL_HOST')}/{os.getenv('MYSQL_DB')}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 10))
+    app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    app.config['DB_POOL_RECYCLE'] = int(os.getenv('DB_POOL_RECYCLE', 1800))
+    app.config['DB_POOL_TIMEOUT'] = int(os.getenv('DB_POOL_TIMEOUT', 10))
+    app.config['DB_POOL_PRE_PING'] = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+    app.config['DB_STATEMENT_TIMEOUT_MS'] = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 0))
+    # Vercel sets VERCEL=1 in its functions
+    app.config['DB_SERVERLESS'] = os.getenv('DB_SERVERLESS', os.getenv('VERCEL', '')).lower() in ('1', 'true', 'yes')
+    # Proxies in front of the app that append to X-Forwarded-For; Vercel's
+    # edge is one. Left at 0 elsewhere, since trusting the header without a
+    # proxy lets clients pick their own address.
+    app.config['TRUSTED_PROXY_HOPS'] = int(os.getenv('TRUSTED_PROXY_HOPS', 1 if os.getenv('VERCEL') else 0))
+    app.config['FORUM_PAGE_SIZE'] = int(os.getenv('FORUM_PAGE_SIZE', 20))
+    app.config['FORUM_COMMENT_PREVIEW'] = int(os.getenv('FORUM_COMMENT_PREVIEW', 3))
+    app.config['FORUM_COMMENT_PAGE_SIZE'] = int(os.getenv('FORUM_COMMENT_PAGE_SIZE', 20))
+    # A serverless host freezes or kills the pool once the response is
+    # sent, leaving renditions pending forever, so they render inline there
+    app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 0 if app.config['DB_SERVERLESS'] else 2))
+    app.config['IMAGE_UPLOAD_FOLDER'] = os.getenv('IMAGE_UPLOAD_FOLDER', os.path.join(app.root_path, 'static', 'forum_uploads'))
+    app.config['IMAGE_RAW_FOLDER'] = os.getenv('IMAGE_RAW_FOLDER', os.path.join(app.root_path, 'uploads', 'raw'))
+    app.config['MAX_UPLOAD_BYTES'] = int(os.getenv('MAX_UPLOAD_BYTES', 16 * 1024 * 1024))
+    app.config['MAX_IMAGE_PIXELS'] = int(os.getenv('MAX_IMAGE_PIXELS', 50_000_000))
+    # A serverless instance's temp dir starts empty on every cold start and
+    # only sees that instance's writes, so there search reads the database
+    # unless SEARCH_INDEX_PATH points at storage every instance shares
+    app.config['SEARCH_BACKEND'] = os.getenv('SEARCH_BACKEND', 'database' if app.config['DB_SERVERLESS'] and not os.getenv('SEARCH_INDEX_PATH') else 'index')
+    # Serverless bundles are read-only apart from the temp dir
+    search_dir = tempfile.gettempdir() if app.config['DB_SERVERLESS'] else app.instance_path
+    app.config['SEARCH_INDEX_PATH'] = os.getenv('SEARCH_INDEX_PATH', os.path.join(search_dir, 'search.db'))
+    app.config['CATALOG_PAGE_SIZE'] = int(os.getenv('CATALOG_PAGE_SIZE', 24))
+    app.config['LOAN_DAYS'] = int(os.getenv('LOAN_DAYS', 14))
+    app.config['HOLD_PICKUP_DAYS'] = int(os.getenv('HOLD_PICKUP_DAYS', 3))
+    app.config['STATS_TTL'] = int(os.getenv('STATS_TTL', 300))
+    app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 60))
+    app.config['USER_CACHE_URL'] = os.getenv('USER_CACHE_URL')
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+    app.config['SLOW_REQUEST_SECONDS'] = float(os.getenv('SLOW_REQUEST_SECONDS', 0))
+    app.config['SLOW_REQUEST_LOG'] = os.getenv('SLOW_REQUEST_LOG')
+    app.config['ASSETS_REQUIRED'] = os.getenv('ASSETS_REQUIRED', os.getenv('VERCEL', '')).lower() in ('1', 'true', 'yes')
+    app.config['HTTP_CACHE_ENABLED'] = os.getenv('HTTP_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    app.config['FRAGMENT_CACHE_SIZE'] = int(os.getenv('FRAGMENT_CACHE_SIZE', 2048))
+    app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+    # Hashed inline where the host stops the pool after the response
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', 0 if app.config['DB_SERVERLESS'] else 2))
+    app.config['PASSWORD_HASH_QUEUE'] = int(os.getenv('PASSWORD_HASH_QUEUE', 8))
+    app.config['LOGIN_ATTEMPTS_PER_IP'] = int(os.getenv('LOGIN_ATTEMPTS_PER_IP', 20))
+    app.config['LOGIN_ATTEMPTS_PER_USERNAME'] = int(os.getenv('LOGIN_ATTEMPTS_PER_USERNAME', 5))
+    app.config['LOGIN_BACKOFF_FREE_FAILURES'] = int(os.getenv('LOGIN_BACKOFF_FREE_FAILURES', 10))
+    app.config['LOGIN_BACKOFF_MAX'] = int(os.getenv('LOGIN_BACKOFF_MAX', 60))
+    # Each open stream holds a worker thread; see live.py before enabling
+    app.config['LIVE_ENABLED'] = os.getenv('LIVE_ENABLED', '').lower() in ('1', 'true', 'yes')
+    app.config['LIVE_EVENTS_URL'] = os.getenv('LIVE_EVENTS_URL')
+    app.config['LIVE_MAX_SUBSCRIBERS'] = int(os.getenv('LIVE_MAX_SUBSCRIBERS', 100))
+    app.config['LIVE_STREAM_SECONDS'] = int(os.getenv('LIVE_STREAM_SECONDS', 30))
+    app.config['API_BATCH_LIMIT'] = int(os.getenv('API_BATCH_LIMIT', 500))
+    app.config['QUERY_COUNT_HEADER'] = os.getenv('QUERY_COUNT_HEADER', '').lower() in ('1', 'true', 'yes')
+
+    app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')
+    app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 587))
+    app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', 'true').lower() in ('1', 'true', 'yes')
+    app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
+    app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
+    app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
+    # Serverless hosts freeze the outbox threads after the response, so
+    # there the request that queues mail sends a small batch itself
+    app.config['EMAIL_WORKERS'] = int(os.getenv('EMAIL_WORKERS', 0 if app.config['DB_SERVERLESS'] else 1))
+    app.config['OUTBOX_INLINE_BATCH'] = int(os.getenv('OUTBOX_INLINE_BATCH', 5 if app.config['DB_SERVERLESS'] else 0))
+    app.config['OUTBOX_BATCH_SIZE'] = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+    app.config['OUTBOX_MAX_ATTEMPTS'] = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+
+    # pymysql stands in for MySQLdb; other databases never need it
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('mysql'):
+        import pymysql
+        pymysql.install_as_MySQLdb()
+
+    # request.remote_addr is the client rather than the proxy, so the
+    # per-address login and registration limits apply per client
+    if app.config['TRUSTED_PROXY_HOPS']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        hops = app.config['TRUSTED_PROXY_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+
+    # Initialize extensions
+    mail.init_app(app)
+    db_pool.init_app(app)
+    db.init_app(app)
+    assets.init_app(app)
+    login_manager.init_app(app)
+    login_manager.login_view = 'login'
+    query_counter.init_app(app)
+    metrics.init_app(app)
+    stats.init_app(app)
+    outbox.init_app(app)
+    image_pipeline.init_app(app)
+    upload_storage.init_app(app)
+    search_index.init_app(app)
+    circulation.init_app(app)
+    user_cache.init_app(app)
+    http_cache.init_app(app)
+    passwords.init_app(app)
+    live.init_app(app)
+    user_book_batches.init_app(app)
 
-# Configure app
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = f"mysql+pymysql://{os.getenv('MYSQL_USER')}:{os.getenv('MYSQL_PASSWORD')}@{os.getenv('MYSQL_HOST')}/{os.getenv('MYSQL_DB')}"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Add the user loader
+    @login_manager.user_loader
+    def load_user(user_id):
+        # Served from the identity cache; a miss costs one primary-key query
+        return user_cache.user_cache.load(int(user_id))
 
-app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')
-app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 587))
-app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
-app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
-app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
+    # Import routes after initializing extensions
+    import routes  # noqa: F401
 
-# Initialize extensions
-mail.init_app(app)
-db.init_app(app)
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+    app.extensions['library_system'] = True
+    return app
 
-# Add the user loader
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
 
-# Import routes after initializing extensions
-from routes import *
+create_app()
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
-    app.run(debug=False)
\ No newline at end of file
+    # Pick up mail queued before the last shutdown
+    outbox.worker_pool.ensure_started(app)
+    app.run(debug=False)
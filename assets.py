@@ -0,0 +1,193 @@
+"""
+Fingerprinted, precompressed static assets
+
+`flask build-assets` copies every file under static/ (except uploads)
+to static/dist/ with a content hash in its name, writes .gz and .br
+siblings for compressible types, and records the mapping in
+static/dist/manifest.json. At runtime url_for('static', ...) resolves
+through the manifest, and fingerprinted files and forum uploads, whose
+names are unique per content, are served as immutable for a year; the
+precompressed variant matching Accept-Encoding is sent when it exists.
+
+static/dist is committed, since the deployment has no build step:
+rebuild it whenever a static file changes, and `flask build-assets
+--check` fails while it is out of date. Without a manifest (e.g. in
+development before the first build) the original files are served
+exactly as before, unless ASSETS_REQUIRED is set, as it is on Vercel.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+
+from flask import current_app, request, send_from_directory, session
+
+logger = logging.getLogger(__name__)
+
+DIST_FOLDER = 'dist'
+UPLOAD_FOLDER = 'forum_uploads'
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.map', '.xml', '.ico'}
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+manifest = {}
+
+
+def fingerprinted_name(path, digest):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{digest[:12]}{ext}"
+
+
+def compress(path, data):
+    """Write .gz and, if the brotli package is installed, .br siblings"""
+    written = []
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+        with open(path + '.gz', 'wb') as f:
+            f.write(gz)
+        written.append('gzip')
+    try:
+        import brotli
+    except ImportError:
+        return written
+    br = brotli.compress(data, quality=11)
+    if len(br) < len(data):
+        with open(path + '.br', 'wb') as f:
+            f.write(br)
+        written.append('br')
+    return written
+
+
+def sources(static_folder):
+    """Yield (relative path, contents) for every file build() copies"""
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder:
+            dirs[:] = [d for d in dirs if d not in (DIST_FOLDER, UPLOAD_FOLDER)]
+        for name in sorted(files):
+            if name.startswith('.'):
+                continue
+            source = os.path.join(root, name)
+            with open(source, 'rb') as f:
+                data = f.read()
+            yield os.path.relpath(source, static_folder).replace(os.sep, '/'), data
+
+
+def dist_name(relative, data):
+    return f"{DIST_FOLDER}/{fingerprinted_name(relative, hashlib.sha256(data).hexdigest())}"
+
+
+def build(static_folder):
+    """
+    Rebuild static/dist from the sources
+
+    Returns:
+        The manifest: source path -> fingerprinted path, both relative
+        to the static folder with forward slashes
+    """
+    dist = os.path.join(static_folder, DIST_FOLDER)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    built = {}
+    for relative, data in sources(static_folder):
+        target = dist_name(relative, data)
+        path = os.path.join(static_folder, *target.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if os.path.splitext(relative)[1].lower() in COMPRESSIBLE:
+            compress(path, data)
+        built[relative] = target
+    os.makedirs(dist, exist_ok=True)
+    with open(os.path.join(dist, 'manifest.json'), 'w') as f:
+        json.dump(built, f, indent=2, sort_keys=True)
+    return built
+
+
+def stale(static_folder, built):
+    """Source paths whose committed build is missing or out of date"""
+    current = dict(sources(static_folder))
+    out_of_date = [
+        relative for relative, data in current.items()
+        if built.get(relative) != dist_name(relative, data)
+        or not os.path.isfile(os.path.join(static_folder, *built[relative].split('/')))
+    ]
+    return sorted(out_of_date + [relative for relative in built if relative not in current])
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logger.error(f"Ignoring unreadable asset manifest {path}: {str(e)}")
+        return {}
+
+
+def fingerprint_url(endpoint, values):
+    """url_defaults hook: point static URLs at the fingerprinted copy"""
+    if endpoint == 'static' and manifest:
+        hashed = manifest.get(values.get('filename'))
+        if hashed:
+            values['filename'] = hashed
+
+
+def is_immutable(filename):
+    return filename.startswith((DIST_FOLDER + '/', UPLOAD_FOLDER + '/'))
+
+
+def serve_static(filename):
+    """Replacement for Flask's static view"""
+    static_folder = current_app.static_folder
+    response = None
+    if filename.startswith(DIST_FOLDER + '/'):
+        for encoding, suffix in ENCODINGS:
+            if request.accept_encodings[encoding] and os.path.isfile(
+                    os.path.join(static_folder, *(filename + suffix).split('/'))):
+                mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                response = send_from_directory(static_folder, filename + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        response = response or send_from_directory(static_folder, filename)
+        response.vary.add('Accept-Encoding')
+    elif filename.startswith(UPLOAD_FOLDER + '/'):
+        # Served from IMAGE_UPLOAD_FOLDER, static/forum_uploads unless moved
+        response = send_from_directory(current_app.config['IMAGE_UPLOAD_FOLDER'],
+                                       filename[len(UPLOAD_FOLDER) + 1:])
+    else:
+        response = send_from_directory(static_folder, filename)
+    if is_immutable(filename) and response.status_code in (200, 206, 304):
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+
+def init_app(app):
+    """Must run before login_manager.init_app, see forget_session_access"""
+    app.config.setdefault('ASSET_MANIFEST', os.path.join(app.static_folder, DIST_FOLDER, 'manifest.json'))
+    app.config.setdefault('ASSETS_REQUIRED', False)
+    manifest.clear()
+    manifest.update(load_manifest(app.config['ASSET_MANIFEST']))
+    if app.config['ASSETS_REQUIRED'] and not manifest:
+        # Deployments serve static/dist as committed; without it every
+        # asset would silently lose fingerprinting and compression
+        raise RuntimeError(f"Asset manifest {app.config['ASSET_MANIFEST']} is missing; "
+                           "run `flask build-assets` and commit static/dist")
+    app.url_defaults(fingerprint_url)
+    app.view_functions['static'] = serve_static
+
+    # after_request handlers run in reverse order, so this one runs after
+    # Flask-Login's, which reads the session on every response and would
+    # otherwise add Vary: Cookie to files every visitor shares
+    @app.after_request
+    def forget_session_access(response):
+        if request.endpoint == 'static':
+            session.accessed = False
+        return response
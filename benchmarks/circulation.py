@@ -0,0 +1,179 @@
+"""
+Concurrency check for catalog circulation: no copy is ever lent twice
+
+Phase "rush": many threads race to borrow a hot title; exactly
+--copies checkouts may succeed. Phase "churn": with fewer copies than
+threads, most threads borrow and return the title in a loop while every
+fourth one queues a hold and borrows the copy set aside for it.
+After each phase the copy invariant is verified:
+
+    open loans + shelf copies + copies held for a reader == copies_total
+
+Reports checkout throughput as JSON. Uses a temporary SQLite file unless
+--database-url points at MySQL, where row locks are exercised for real.
+
+Usage:
+    python benchmarks/circulation.py [--copies 20] [--threads 16] [--seconds 5]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def invariant(db, book_id):
+    from sqlalchemy import func
+    from models import Book, BorrowedBook, BookHold
+
+    book = db.session.get(Book, book_id, populate_existing=True)
+    loans = db.session.query(func.count(BorrowedBook.id)).filter(
+        BorrowedBook.book_id == book_id, BorrowedBook.return_date.is_(None)).scalar()
+    ready = db.session.query(func.count(BookHold.id)).filter(
+        BookHold.book_id == book_id, BookHold.status == 'ready').scalar()
+    return {
+        'copies_total': book.copies_total,
+        'copies_available': book.copies_available,
+        'open_loans': loans,
+        'ready_holds': ready,
+        'ok': book.copies_available >= 0
+              and loans + book.copies_available + ready == book.copies_total,
+    }
+
+
+def run_threads(app, count, target):
+    threads = [threading.Thread(target=target, args=(app, i)) for i in range(count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database-url')
+    parser.add_argument('--copies', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--attempts', type=int, default=50, help='Rush checkouts per thread.')
+    parser.add_argument('--churn-copies', type=int, default=4,
+                        help='Copies during churn; fewer than threads keeps a waitlist.')
+    parser.add_argument('--seconds', type=float, default=5.0, help='Length of the churn phase.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='library-circulation-')
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['EMAIL_WORKERS'] = '0'
+    os.environ['IMAGE_UPLOAD_FOLDER'] = os.path.join(workdir, 'forum_uploads')
+    os.environ['IMAGE_RAW_FOLDER'] = os.path.join(workdir, 'raw')
+    os.environ['DB_POOL_SIZE'] = str(args.threads)
+
+    from app import app
+    from extensions import db
+    from models import User, Book, BorrowedBook
+    import circulation
+
+    with app.app_context():
+        db.create_all()
+        users = [User(username=f'circ_{time.time_ns()}_{i}', email=f'circ_{time.time_ns()}_{i}@example.com',
+                      password='x') for i in range(args.threads * 2)]
+        book = Book(title='Hot Title', author='Popular Author', availability=True,
+                    copies_total=args.copies, copies_available=args.copies)
+        db.session.add_all(users + [book])
+        db.session.commit()
+        user_ids = [user.id for user in users]
+        book_id = book.id
+
+    results = {'database': os.environ['DATABASE_URL'].split('://')[0],
+               'threads': args.threads, 'copies': args.copies}
+    lock = threading.Lock()
+
+    # Rush: everyone races for the copies, nobody returns
+    rush = {'succeeded': 0, 'refused': 0, 'errors': 0}
+
+    def rush_worker(app, index):
+        with app.app_context():
+            for _ in range(args.attempts):
+                try:
+                    circulation.checkout(book_id, user_ids[index])
+                    outcome = 'succeeded'
+                except circulation.CirculationError:
+                    outcome = 'refused'
+                except Exception:
+                    db.session.rollback()
+                    outcome = 'errors'
+                with lock:
+                    rush[outcome] += 1
+
+    elapsed = run_threads(app, args.threads, rush_worker)
+    with app.app_context():
+        rush['invariant'] = invariant(db, book_id)
+        rush['double_lent'] = rush['succeeded'] > args.copies
+        # Put every copy back for the churn phase
+        for loan in BorrowedBook.query.filter_by(book_id=book_id, return_date=None).all():
+            circulation.return_loan(loan.id, loan.user_id)
+        circulation.set_copies(book_id, args.churn_copies)
+    rush['attempts_per_second'] = round((rush['succeeded'] + rush['refused']) / elapsed, 1)
+    results['rush'] = rush
+
+    # Churn: borrowers cycle checkouts and returns, waiters queue holds
+    # and collect their copy when it is set aside for them
+    churn = {'checkouts': 0, 'returns': 0, 'refused': 0, 'holds': 0, 'errors': 0}
+    deadline = time.perf_counter() + args.seconds
+
+    def churn_worker(app, index):
+        from models import BookHold
+        waiter = index % 4 == 0
+        user_id = user_ids[args.threads + index] if waiter else user_ids[index]
+        with app.app_context():
+            while time.perf_counter() < deadline:
+                try:
+                    if waiter:
+                        status = db.session.query(BookHold.status).filter(
+                            BookHold.user_id == user_id,
+                            BookHold.status.in_(circulation.ACTIVE_HOLD_STATUSES)
+                        ).scalar()
+                        db.session.rollback()
+                        if status is None:
+                            try:
+                                circulation.place_hold(book_id, user_id)
+                                with lock:
+                                    churn['holds'] += 1
+                                continue
+                            except circulation.CirculationError:
+                                pass  # a copy is on the shelf, borrow it
+                        elif status == 'waiting':
+                            time.sleep(0.001)
+                            continue
+                    loan = circulation.checkout(book_id, user_id)
+                    with lock:
+                        churn['checkouts'] += 1
+                    circulation.return_loan(loan.id, user_id)
+                    outcome = 'returns'
+                except circulation.CirculationError:
+                    outcome = 'refused'
+                except Exception:
+                    db.session.rollback()
+                    outcome = 'errors'
+                with lock:
+                    churn[outcome] += 1
+
+    elapsed = run_threads(app, args.threads, churn_worker)
+    with app.app_context():
+        churn['invariant'] = invariant(db, book_id)
+    churn['checkouts_per_second'] = round(churn['checkouts'] / elapsed, 1)
+    results['churn'] = churn
+
+    print(json.dumps(results, indent=2))
+    if not (rush['invariant']['ok'] and churn['invariant']['ok']) or rush['double_lent']:
+        sys.exit('Circulation invariant violated')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Cold-start benchmark: import cost and time to first response
+
+Starts a fresh interpreter per run under `python -X importtime`, imports
+wsgi.py (or --module) and serves one request through the test client, like a
+serverless cold start. Reports the median wall time to the first
+response, the import and first-request split, the slowest imports of
+the first run, which optional heavy modules were loaded, and whether
+start-up opened a database connection. Uses a throwaway SQLite URL, so
+no database server is needed.
+
+Usage:
+    python benchmarks/cold_start.py [--runs 10] [--path /login] [--top 15] [--module wsgi]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should stay unloaded until something needs them
+DEFERRED = ('PIL', 'flask_mail', 'smtplib', 'dotenv', 'pymysql', 'catalog_io', 'commands', 'migrations')
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+module = __import__(sys.argv[3])
+imported = time.perf_counter()
+response = module.app.test_client().get(sys.argv[1])
+responded = time.perf_counter()
+from db_pool import pool_stats
+print(json.dumps({
+    'status': response.status_code,
+    'import_ms': (imported - started) * 1000,
+    'first_request_ms': (responded - imported) * 1000,
+    'db_checkouts': pool_stats.checkouts,
+    'loaded': sorted(name for name in sys.argv[2].split(',') if name in sys.modules),
+}))
+"""
+
+
+def parse_importtime(stderr, depth=2):
+    """(cumulative microseconds, module) for imports at most depth levels deep"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        if level <= depth:
+            rows.append((int(cumulative), name.strip()))
+    return rows
+
+
+def run_once(path, module, env):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD, path, ','.join(DEFERRED), module],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    wall = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        sys.exit(proc.stderr[-2000:])
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['wall_ms'] = wall
+    return result, proc.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--path', default='/login', help='URL of the first request.')
+    parser.add_argument('--top', type=int, default=15, help='Slowest imports to list.')
+    parser.add_argument('--module', default='wsgi',
+                        help='Module exposing `app`; use app to measure commits without wsgi.py.')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='library-cold-start-')
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'cold.db')}")
+    env.setdefault('SECRET_KEY', 'benchmark')
+    env['SEARCH_INDEX_PATH'] = os.path.join(workdir, 'search.db')
+    env['IMAGE_UPLOAD_FOLDER'] = os.path.join(workdir, 'forum_uploads')
+    env['IMAGE_RAW_FOLDER'] = os.path.join(workdir, 'raw')
+
+    runs, first_stderr = [], None
+    for _ in range(args.runs):
+        result, stderr = run_once(args.path, args.module, env)
+        runs.append(result)
+        first_stderr = first_stderr or stderr
+
+    def median(key):
+        return round(statistics.median(run[key] for run in runs), 1)
+
+    imports = sorted(parse_importtime(first_stderr), reverse=True)[:args.top]
+    results = {
+        'runs': args.runs,
+        'path': args.path,
+        'status': runs[0]['status'],
+        'wall_to_first_response_ms': median('wall_ms'),
+        'import_ms': median('import_ms'),
+        'first_request_ms': median('first_request_ms'),
+        'db_connections_at_startup': runs[0]['db_checkouts'],
+        'deferred_modules_loaded': runs[0]['loaded'],
+        'slowest_imports_ms': {name: round(us / 1000, 1) for us, name in imports},
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
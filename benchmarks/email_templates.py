@@ -0,0 +1,53 @@
+"""
+Micro-benchmark: per-send render_template_string vs the compiled registry
+
+Usage:
+    python benchmarks/email_templates.py [--iterations N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, render_template_string
+
+from email_service import (
+    WELCOME_EMAIL_TEMPLATE, BORROWED_BOOK_EMAIL_TEMPLATE, render_email
+)
+
+CASES = [
+    ('welcome', WELCOME_EMAIL_TEMPLATE,
+     dict(username='reader', email='reader@example.com')),
+    ('borrowed_book', BORROWED_BOOK_EMAIL_TEMPLATE,
+     dict(username='reader', book_title='Dune', author='Frank Herbert',
+          borrow_date='2024-01-01', due_date='2024-01-15')),
+]
+
+
+def renders_per_second(render, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        render()
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    with app.app_context():
+        for name, source, context in CASES:
+            before = renders_per_second(
+                lambda: render_template_string(source, **context), args.iterations)
+            after = renders_per_second(
+                lambda: render_email(name, **context), args.iterations)
+            print(f"{name:15} before: {before:10.0f}/s  after: {after:10.0f}/s  "
+                  f"speedup: {after / before:5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+Load test: seed synthetic data and drive the real routes concurrently
+
+Seeds the database named by --database-url (a throwaway SQLite file by
+default) and replays the index, forum, borrowed_books, create_post and
+add_borrowed_book routes from concurrent logged-in clients, either
+through Flask's test client or over HTTP against a running server
+(--base-url; start it with QUERY_COUNT_HEADER=1 to get query counts).
+Results are written as JSON so runs on two commits can be compared with
+--compare.
+
+Usage:
+    python benchmarks/load_test.py [--users 1000] [--posts 5000] [--requests 500]
+        [--concurrency 8] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'benchmark'
+WORDS = ('library', 'novel', 'chapter', 'author', 'reading', 'review', 'classic',
+         'fiction', 'history', 'science', 'poetry', 'mystery', 'series', 'edition')
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+# name -> (method, path, form builder)
+SCENARIOS = {
+    'index': ('GET', '/', None),
+    'forum': ('GET', '/forum', None),
+    'borrowed_books': ('GET', '/borrowed_books', None),
+    'create_post': ('POST', '/forum/post', lambda rng: {
+        'title': sentence(rng, 5), 'content': sentence(rng, 40)}),
+    'add_borrowed_book': ('POST', '/add_borrowed_book', lambda rng: {
+        'title': sentence(rng, 3), 'author': sentence(rng, 2),
+        'due_date': (datetime.utcnow().date() + timedelta(days=rng.randint(1, 30))).isoformat()}),
+}
+
+
+def configure_env(args, workdir):
+    """Settings the app reads at import time"""
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['QUERY_COUNT_HEADER'] = '1'
+    os.environ['SEARCH_INDEX_PATH'] = os.path.join(workdir, 'search.db')
+    os.environ['IMAGE_UPLOAD_FOLDER'] = os.path.join(workdir, 'forum_uploads')
+    os.environ['IMAGE_RAW_FOLDER'] = os.path.join(workdir, 'raw')
+    # Keep mail and image work out of the measured requests
+    os.environ['EMAIL_WORKERS'] = '0'
+    os.environ['IMAGE_WORKERS'] = '0'
+    # Every simulated client logs in from the same address
+    os.environ['LOGIN_ATTEMPTS_PER_IP'] = str(10 ** 6)
+
+
+def seed(db, counts, rng, chunk=5000):
+    """Bulk insert synthetic rows; every user's password is PASSWORD"""
+    from sqlalchemy import func, insert, select, update
+    from werkzeug.security import generate_password_hash
+    from models import User, Book, UserBook, ForumPost, ForumComment
+
+    db.create_all()
+    now = datetime.utcnow()
+    today = now.date()
+    password = generate_password_hash(PASSWORD)
+
+    def bulk(model, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == chunk:
+                db.session.execute(insert(model), batch)
+                batch = []
+        if batch:
+            db.session.execute(insert(model), batch)
+        db.session.commit()
+
+    users = counts['users']
+    bulk(User, (dict(username=f'bench_user_{i}', email=f'bench_user_{i}@example.com',
+                     password=password, created_at=now) for i in range(1, users + 1)))
+    def book(i):
+        # The index keeps (title, author) unique over the small word list
+        total = rng.randint(1, 3)
+        available = rng.randint(1, total) if rng.random() < 0.8 else 0
+        return dict(title=f'{sentence(rng, 3)} {i}', author=sentence(rng, 2),
+                    copies_total=total, copies_available=available, availability=available > 0)
+    bulk(Book, (book(i) for i in range(1, counts['books'] + 1)))
+
+    def user_book():
+        borrowed = today - timedelta(days=rng.randint(0, 60))
+        returned = rng.random() < 0.6
+        return dict(user_id=rng.randint(1, users), book_title=sentence(rng, 3),
+                    author=sentence(rng, 2), borrow_date=borrowed,
+                    due_date=borrowed + timedelta(days=14), is_returned=returned,
+                    return_date=borrowed + timedelta(days=rng.randint(1, 20)) if returned else None)
+    bulk(UserBook, (user_book() for _ in range(counts['user_books'])))
+
+    bulk(ForumPost, (dict(user_id=rng.randint(1, users), title=sentence(rng, 5),
+                          content=sentence(rng, 60),
+                          date_posted=now - timedelta(minutes=rng.randint(0, 525600)))
+                     for _ in range(counts['posts'])))
+    bulk(ForumComment, (dict(post_id=rng.randint(1, counts['posts']), user_id=rng.randint(1, users),
+                             content=sentence(rng, 20),
+                             date_posted=now - timedelta(minutes=rng.randint(0, 525600)))
+                        for _ in range(counts['comments'])))
+    db.session.execute(update(ForumPost).values(comment_count=select(func.count(ForumComment.id))
+                                                .where(ForumComment.post_id == ForumPost.id)
+                                                .scalar_subquery()))
+    db.session.commit()
+
+
+class TestClientSession:
+    """One logged-in user driven through Flask's test client"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None):
+        response = self.client.open(path, method=method, data=form)
+        count = response.headers.get('X-Query-Count')
+        return response.status_code, int(count) if count is not None else None
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession:
+    """One logged-in user driven over HTTP with its own cookie jar"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect())
+
+    def request(self, method, path, form=None):
+        data = urllib.parse.urlencode(form).encode() if form is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        try:
+            with self.opener.open(req) as response:
+                response.read()
+                status, headers = response.status, response.headers
+        except urllib.error.HTTPError as e:
+            status, headers = e.code, e.headers
+        count = headers.get('X-Query-Count')
+        return status, int(count) if count is not None else None
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_scenario(name, sessions, requests, warmup, rng_seed):
+    method, path, build_form = SCENARIOS[name]
+    latencies, query_counts, errors = [], [], []
+    lock = threading.Lock()
+    per_session = max(1, requests // len(sessions))
+
+    def worker(index, session):
+        rng = random.Random(rng_seed + index)
+        local = []
+        for i in range(warmup + per_session):
+            form = build_form(rng) if build_form else None
+            start = time.perf_counter()
+            status, count = session.request(method, path, form)
+            elapsed = time.perf_counter() - start
+            if i >= warmup:
+                local.append((elapsed, status, count))
+        with lock:
+            for elapsed, status, count in local:
+                latencies.append(elapsed)
+                if count is not None:
+                    query_counts.append(count)
+                if status >= 400:
+                    errors.append(status)
+
+    threads = [threading.Thread(target=worker, args=(i, s)) for i, s in enumerate(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        # Includes the warm-up requests, which ran in the same window
+        'throughput_rps': round(len(sessions) * (warmup + per_session) / wall, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2),
+        'queries_per_request': round(sum(query_counts) / len(query_counts), 2) if query_counts else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print p95 and query-count changes against an earlier run"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['scenarios']
+    for name, current in results['scenarios'].items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        change = (current['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+        print(f"{name:18} p95 {before['p95_ms']:8.2f} -> {current['p95_ms']:8.2f} ms ({change:+6.1f}%)  "
+              f"queries {before['queries_per_request']} -> {current['queries_per_request']}",
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database-url', help='Defaults to a temporary SQLite file.')
+    parser.add_argument('--base-url', help='Drive a running server over HTTP instead of the test client.')
+    parser.add_argument('--no-seed', action='store_true', help='Reuse data from an earlier run.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--user-books', type=int, default=20000)
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=500, help='Measured requests per scenario.')
+    parser.add_argument('--warmup', type=int, default=5, help='Unmeasured requests per client.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout.')
+    parser.add_argument('--compare', help='Earlier results to compare against.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='library-bench-')
+    configure_env(args, workdir)
+    from app import app
+    from extensions import db
+
+    rng = random.Random(args.seed)
+    counts = dict(users=args.users, books=args.books, user_books=args.user_books,
+                  posts=args.posts, comments=args.comments)
+    if not args.no_seed:
+        start = time.perf_counter()
+        with app.app_context():
+            seed(db, counts, rng)
+        print(f"Seeded {sum(counts.values())} rows in {time.perf_counter() - start:.1f}s",
+              file=sys.stderr)
+
+    sessions = []
+    for i in range(args.concurrency):
+        session = HttpSession(args.base_url) if args.base_url else TestClientSession(app)
+        status, _ = session.request('POST', '/login', {
+            'username': f'bench_user_{rng.randint(1, args.users)}', 'password': PASSWORD})
+        if status != 302:
+            sys.exit(f"Login failed with status {status}; was the database seeded?")
+        sessions.append(session)
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'mode': 'http' if args.base_url else 'test_client',
+        'database': os.environ['DATABASE_URL'].split('://')[0],
+        'concurrency': args.concurrency,
+        'rows': counts,
+        'scenarios': {},
+    }
+    for name in args.scenarios.split(','):
+        results['scenarios'][name] = run_scenario(
+            name, sessions, args.requests, args.warmup, args.seed)
+        print(f"{name}: {results['scenarios'][name]}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
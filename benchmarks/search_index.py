@@ -0,0 +1,99 @@
+"""
+Search latency benchmark: seed a synthetic FTS5 index and time queries
+
+Usage:
+    python benchmarks/search_index.py [--docs 1000000] [--queries 2000]
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import SearchIndex, KINDS
+
+
+def make_vocabulary(size, rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters) for _ in range(rng.randint(4, 9))))
+    return sorted(words)
+
+
+def zipf_sampler(words, rng, exponent=1.1):
+    """Draw words with a Zipf-like frequency, as in natural text"""
+    cum_weights = list(itertools.accumulate(
+        1 / (rank + 1) ** exponent for rank in range(len(words))
+    ))
+    return lambda k: rng.choices(words, cum_weights=cum_weights, k=k)
+
+
+def seed(index, docs, batch_size, sample, rng):
+    kinds = list(KINDS)
+    for start in range(1, docs + 1, batch_size):
+        batch = []
+        for ref_id in range(start, min(start + batch_size, docs + 1)):
+            kind = kinds[ref_id % len(kinds)]
+            batch.append(dict(
+                kind=kind, ref_id=ref_id,
+                title=' '.join(sample(rng.randint(3, 8))),
+                body=' '.join(sample(rng.randint(20, 60))),
+                owner_id=rng.randint(1, 5000) if kind == 'user_book' else None,
+            ))
+        index.upsert_many(batch)
+    index.optimize()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--docs', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--vocabulary', type=int, default=50_000)
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    parser.add_argument('--index', help='Reuse or create the index at this path.')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words = make_vocabulary(args.vocabulary, rng)
+    sample = zipf_sampler(words, rng)
+    path = args.index or os.path.join(tempfile.mkdtemp(), 'search.db')
+    index = SearchIndex(path)
+
+    if not index.connection().execute('SELECT count(*) FROM documents').fetchone()[0]:
+        start = time.perf_counter()
+        seed(index, args.docs, args.batch_size, sample, rng)
+        print(f"Seeded {args.docs} documents in {time.perf_counter() - start:.1f}s",
+              file=sys.stderr)
+
+    latencies = []
+    for _ in range(args.queries):
+        query = ' '.join(sample(rng.randint(1, 2)))
+        page = rng.choice([1, 1, 1, 2, 3])
+        start = time.perf_counter()
+        index.search(query, viewer_id=rng.randint(1, 5000), page=page)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    print(json.dumps({
+        'documents': args.docs,
+        'queries': args.queries,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'max_ms': round(max(latencies), 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""
+Streaming bulk import and export for the catalog
+
+Imports read CSV or JSON Lines one row at a time, validate each row, and
+upsert bounded chunks keyed on (title, author) with one executemany per
+chunk: INSERT ... ON DUPLICATE KEY UPDATE on MySQL, ON CONFLICT DO
+UPDATE elsewhere. Duplicates are collapsed within a chunk and by the
+unique key across chunks, so memory stays flat for any file size.
+
+Exports walk the table in primary-key order with keyset batches of plain
+rows, never ORM objects, and write each batch out before reading the
+next.
+"""
+import csv
+import json
+import time
+
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.dialects import mysql, sqlite, postgresql
+
+from extensions import db
+from models import Book, UserBook
+from search_index import index_documents, book_doc
+
+MAX_TEXT_LENGTH = 255
+
+EXPORT_COLUMNS = {
+    'books': (Book, ('id', 'title', 'author', 'copies_total', 'copies_available')),
+    'user_books': (UserBook, ('id', 'user_id', 'book_title', 'author', 'borrow_date',
+                              'due_date', 'return_date', 'is_returned', 'notes')),
+}
+
+
+class RowRejected(ValueError):
+    """An import row that fails validation"""
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, dict) pairs; unparseable JSON lines yield None"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else None
+
+
+def validate(row):
+    """Normalise one import row to the books columns"""
+    if row is None:
+        raise RowRejected('not a JSON object')
+    title = str(row.get('title') or '').strip()
+    author = str(row.get('author') or '').strip()
+    if not title or not author:
+        raise RowRejected('title and author are required')
+    if len(title) > MAX_TEXT_LENGTH or len(author) > MAX_TEXT_LENGTH:
+        raise RowRejected(f'title and author are limited to {MAX_TEXT_LENGTH} characters')
+    copies = row.get('copies', 1)
+    try:
+        copies = int(copies if copies not in (None, '') else 1)
+    except (TypeError, ValueError):
+        raise RowRejected('copies must be a whole number')
+    if copies < 0:
+        raise RowRejected('copies cannot be negative')
+    return dict(title=title, author=author, availability=copies > 0,
+                copies_total=copies, copies_available=copies)
+
+
+def upsert_statement(dialect):
+    """
+    Dialect-specific upsert for books
+
+    An existing title keeps its copies unless the import lists more, in
+    which case the extra copies go on the shelf. Copies are never
+    withdrawn here, since some may be out on loan; use set-copies.
+    """
+    table = Book.__table__
+    if dialect == 'mysql':
+        stmt = mysql.insert(table)
+        new = stmt.inserted
+        added = func.greatest(new.copies_total - table.c.copies_total, 0)
+        # MySQL applies SET clauses left to right on the updated row, so
+        # every clause reads copies_total before it is raised
+        return stmt.on_duplicate_key_update([
+            ('availability', table.c.copies_available + added > 0),
+            ('copies_available', table.c.copies_available + added),
+            ('copies_total', func.greatest(table.c.copies_total, new.copies_total)),
+        ])
+    module = postgresql if dialect == 'postgresql' else sqlite
+    greatest = func.greatest if dialect == 'postgresql' else func.max
+    stmt = module.insert(table)
+    new = stmt.excluded
+    added = greatest(new.copies_total - table.c.copies_total, 0)
+    return stmt.on_conflict_do_update(
+        index_elements=['title', 'author'],
+        set_={
+            'availability': table.c.copies_available + added > 0,
+            'copies_available': table.c.copies_available + added,
+            'copies_total': greatest(table.c.copies_total, new.copies_total),
+        }
+    )
+
+
+def write_chunk(stmt, chunk, reindex=True):
+    """Upsert one chunk of validated rows and commit it"""
+    rows = list(chunk.values())
+    db.session.execute(stmt, rows)
+    db.session.commit()
+    if reindex:
+        keys = list(chunk)
+        books = db.session.execute(
+            select(Book.id, Book.title, Book.author)
+            .where(tuple_(Book.title, Book.author).in_(keys))
+        ).all()
+        index_documents([book_doc(book) for book in books])
+
+
+def import_books(stream, fmt='csv', chunk_size=5000, reindex=True, on_progress=None, on_reject=None):
+    """
+    Stream a catalog file into the books table
+
+    Args:
+        stream: Open text stream of CSV (title, author, copies columns)
+            or JSON Lines objects with the same keys
+        chunk_size: Rows per executemany and commit
+        reindex: Update the search index for every upserted title
+        on_progress: Called with the running totals after each chunk
+        on_reject: Called with (line number, reason) for each bad row
+
+    Returns:
+        Dict of totals: read, upserted, duplicates, rejected
+    """
+    stmt = upsert_statement(db.engine.dialect.name)
+    totals = dict(read=0, upserted=0, duplicates=0, rejected=0)
+    chunk = {}
+    for number, row in read_rows(stream, fmt):
+        totals['read'] += 1
+        try:
+            book = validate(row)
+        except RowRejected as e:
+            totals['rejected'] += 1
+            if on_reject:
+                on_reject(number, str(e))
+            continue
+        key = (book['title'], book['author'])
+        if key in chunk:
+            # Last occurrence wins, as it would across chunks
+            totals['duplicates'] += 1
+        chunk[key] = book
+        if len(chunk) >= chunk_size:
+            write_chunk(stmt, chunk, reindex)
+            totals['upserted'] += len(chunk)
+            chunk = {}
+            if on_progress:
+                on_progress(totals)
+    if chunk:
+        write_chunk(stmt, chunk, reindex)
+        totals['upserted'] += len(chunk)
+        if on_progress:
+            on_progress(totals)
+    return totals
+
+
+def iter_table(table, batch_size=5000):
+    """Yield batches of a table's export columns in primary-key order"""
+    model, names = EXPORT_COLUMNS[table]
+    columns = [getattr(model, name) for name in names]
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(*columns).where(model.id > last_id).order_by(model.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        yield names, rows
+        last_id = rows[-1][0]
+        # Each batch runs in its own short transaction
+        db.session.rollback()
+
+
+def export_table(table, stream, fmt='csv', batch_size=5000):
+    """Write a whole table to stream; returns the number of rows"""
+    count = 0
+    writer = None
+    for names, rows in iter_table(table, batch_size):
+        if fmt == 'csv':
+            if writer is None:
+                writer = csv.writer(stream)
+                writer.writerow(names)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                stream.write(json.dumps(dict(zip(names, row)), default=str) + '\n')
+        count += len(rows)
+    if fmt == 'csv' and writer is None:
+        csv.writer(stream).writerow(EXPORT_COLUMNS[table][1])
+    return count
+
+
+class Progress:
+    """Rate-limited progress reporting for the CLI"""
+
+    def __init__(self, echo, every=2.0):
+        self.echo = echo
+        self.every = every
+        self.started = time.monotonic()
+        self.last = 0.0
+
+    def __call__(self, totals):
+        now = time.monotonic()
+        if now - self.last >= self.every:
+            self.last = now
+            rate = totals['read'] / max(now - self.started, 1e-9)
+            self.echo(f"{totals['read']} rows read, {totals['upserted']} upserted, "
+                      f"{totals['rejected']} rejected ({rate:.0f} rows/s)")
@@ -0,0 +1,335 @@
+"""
+Catalog circulation: checkouts, returns and holds
+
+Every change to a title's copy count is a single conditional UPDATE
+(e.g. "copies_available - 1 WHERE copies_available > 0"), so concurrent
+borrowers can never both take the last copy: the database serialises
+them on the book's row lock and the loser's UPDATE matches no row. A
+checkout holds that lock only for its UPDATE, loan INSERT and commit.
+
+Returned copies go to the oldest waiting hold before the shelf. Returns
+and hold placement lock the book row first, so a new hold either sees
+the returned copy or is seen by the return.
+"""
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import select, update
+
+from extensions import db
+from models import Book, BorrowedBook, BookHold, User
+from email_service import register_template, send_templated_email
+from outbox import worker_pool
+from http_cache import bump, user_books_key
+
+HOLD_READY_EMAIL_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <style>
+        body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; }
+        .header { background: #f8f9fa; padding: 20px; text-align: center; }
+        .content { padding: 20px; }
+        .footer { background: #f8f9fa; padding: 20px; text-align: center; }
+        .book-details { background: #f1f1f1; padding: 15px; border-radius: 5px; }
+    </style>
+</head>
+<body>
+    <div class="header">
+        <h1>Your Hold Is Ready</h1>
+    </div>
+    <div class="content">
+        <h2>Hello {{username}},</h2>
+        <p>A copy of the book you are waiting for has been set aside for you:</p>
+
+        <div class="book-details">
+            <p><strong>Title:</strong> {{book_title}}</p>
+            <p><strong>Author:</strong> {{author}}</p>
+            <p><strong>Borrow by:</strong> {{ready_until}}</p>
+        </div>
+
+        <p>After that date the copy goes to the next reader on the waitlist.</p>
+    </div>
+    <div class="footer">
+        <p>Best regards,<br>Your Library Team</p>
+    </div>
+</body>
+</html>
+"""
+register_template('hold_ready', 'Your hold is ready - {{book_title}}', HOLD_READY_EMAIL_TEMPLATE)
+
+ACTIVE_HOLD_STATUSES = ('waiting', 'ready')
+
+
+class CirculationError(ValueError):
+    """A checkout, return or hold the catalog cannot honour"""
+
+
+def take_copy(book_id):
+    """Atomically take one shelf copy; returns False if none is left"""
+    return db.session.execute(
+        update(Book)
+        .where(Book.id == book_id, Book.copies_available > 0)
+        # Ordered so availability is computed from the old count on
+        # MySQL too, which applies SET clauses left to right
+        .ordered_values(
+            (Book.availability, Book.copies_available > 1),
+            (Book.copies_available, Book.copies_available - 1),
+        )
+    ).rowcount == 1
+
+
+def lock_book(book_id):
+    """Take the book row lock for the rest of the transaction"""
+    return db.session.execute(
+        select(Book).where(Book.id == book_id).with_for_update()
+        .execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+
+
+def release_copy(book, now=None):
+    """
+    Give a copy back to the waitlist or the shelf; book row must be locked
+
+    Returns:
+        The hold the copy was assigned to, or None if it was shelved
+    """
+    now = now or datetime.utcnow()
+    ready_until = now + timedelta(days=current_app.config['HOLD_PICKUP_DAYS'])
+    while True:
+        hold_id = db.session.execute(
+            select(BookHold.id)
+            .where(BookHold.book_id == book.id, BookHold.status == 'waiting')
+            .order_by(BookHold.created_at, BookHold.id)
+            .limit(1)
+        ).scalar()
+        if hold_id is None:
+            break
+        # A concurrent cancel may have won; then try the next hold
+        promoted = db.session.execute(
+            update(BookHold)
+            .where(BookHold.id == hold_id, BookHold.status == 'waiting')
+            .values(status='ready', ready_until=ready_until)
+        ).rowcount
+        if promoted:
+            hold = db.session.get(BookHold, hold_id, populate_existing=True)
+            bump(user_books_key(hold.user_id))
+            queue_hold_ready_email(hold, book)
+            return hold
+
+    db.session.execute(
+        update(Book).where(Book.id == book.id)
+        .values(copies_available=Book.copies_available + 1, availability=True)
+    )
+    return None
+
+
+def queue_hold_ready_email(hold, book):
+    user = db.session.get(User, hold.user_id)
+    send_templated_email(
+        'hold_ready', [user.email], commit=False,
+        username=user.username, book_title=book.title, author=book.author,
+        ready_until=hold.ready_until.strftime('%Y-%m-%d')
+    )
+
+
+def notify_mail_workers():
+    worker_pool.notify(current_app._get_current_object())
+
+
+def checkout(book_id, user_id, today=None):
+    """
+    Lend a copy of a book to a user
+
+    A copy set aside by the user's ready hold is used first; otherwise a
+    shelf copy is taken with one conditional UPDATE.
+
+    Returns:
+        The new BorrowedBook loan
+    """
+    today = today or datetime.utcnow().date()
+    claimed = db.session.execute(
+        update(BookHold)
+        .where(BookHold.book_id == book_id, BookHold.user_id == user_id,
+               BookHold.status == 'ready')
+        .values(status='fulfilled')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed and not take_copy(book_id):
+        db.session.rollback()
+        raise CirculationError('No copies are available. Place a hold to join the waitlist.')
+
+    loan = BorrowedBook(
+        user_id=user_id, book_id=book_id, borrow_date=today,
+        due_date=today + timedelta(days=current_app.config['LOAN_DAYS'])
+    )
+    db.session.add(loan)
+    bump(user_books_key(user_id))
+    db.session.commit()
+    return loan
+
+
+def return_loan(loan_id, user_id, today=None):
+    """
+    Close a loan and pass its copy on
+
+    Returns:
+        The hold that received the copy, or None
+    """
+    today = today or datetime.utcnow().date()
+    loan = db.session.get(BorrowedBook, loan_id)
+    if loan is None or loan.user_id != user_id:
+        raise CirculationError('Loan not found.')
+    book = lock_book(loan.book_id)
+    closed = db.session.execute(
+        update(BorrowedBook)
+        .where(BorrowedBook.id == loan_id, BorrowedBook.return_date.is_(None))
+        .values(return_date=today)
+    ).rowcount
+    if not closed:
+        db.session.rollback()
+        raise CirculationError('This book has already been returned.')
+    hold = release_copy(book)
+    bump(user_books_key(user_id))
+    db.session.commit()
+    if hold is not None:
+        notify_mail_workers()
+    return hold
+
+
+def place_hold(book_id, user_id):
+    """Join a title's waitlist; only allowed while no copy is on the shelf"""
+    book = lock_book(book_id)
+    if book is None:
+        db.session.rollback()
+        raise CirculationError('Book not found.')
+    if book.copies_available > 0:
+        db.session.rollback()
+        raise CirculationError('A copy is available, borrow it instead.')
+    existing = db.session.query(BookHold.id).filter(
+        BookHold.book_id == book_id, BookHold.user_id == user_id,
+        BookHold.status.in_(ACTIVE_HOLD_STATUSES)
+    ).first()
+    if existing:
+        db.session.rollback()
+        raise CirculationError('You already have a hold on this book.')
+    hold = BookHold(book_id=book_id, user_id=user_id, status='waiting')
+    db.session.add(hold)
+    bump(user_books_key(user_id))
+    db.session.commit()
+    return hold
+
+
+def cancel_hold(hold_id, user_id):
+    """Leave a waitlist; a copy already set aside is passed on"""
+    hold = db.session.get(BookHold, hold_id)
+    if hold is None or hold.user_id != user_id:
+        raise CirculationError('Hold not found.')
+    book = lock_book(hold.book_id)
+    was_ready = db.session.execute(
+        update(BookHold)
+        .where(BookHold.id == hold_id, BookHold.status == 'ready')
+        .values(status='cancelled')
+    ).rowcount
+    promoted = None
+    if was_ready:
+        promoted = release_copy(book)
+    elif not db.session.execute(
+        update(BookHold)
+        .where(BookHold.id == hold_id, BookHold.status == 'waiting')
+        .values(status='cancelled')
+    ).rowcount:
+        db.session.rollback()
+        raise CirculationError('This hold is no longer active.')
+    bump(user_books_key(user_id))
+    db.session.commit()
+    if promoted is not None:
+        notify_mail_workers()
+
+
+def expire_holds(now=None):
+    """Pass on copies whose ready holds were not collected; returns how many"""
+    now = now or datetime.utcnow()
+    expired = 0
+    promoted = False
+    for hold_id, book_id, user_id in db.session.query(
+        BookHold.id, BookHold.book_id, BookHold.user_id
+    ).filter(BookHold.status == 'ready', BookHold.ready_until < now).all():
+        book = lock_book(book_id)
+        if db.session.execute(
+            update(BookHold)
+            .where(BookHold.id == hold_id, BookHold.status == 'ready')
+            .values(status='expired')
+        ).rowcount:
+            expired += 1
+            bump(user_books_key(user_id))
+            promoted = release_copy(book, now) is not None or promoted
+        db.session.commit()
+    if promoted:
+        notify_mail_workers()
+    return expired
+
+
+def set_copies(book_id, total):
+    """
+    Change how many copies of a title the library owns
+
+    New copies go through the waitlist like returns. Copies can only be
+    withdrawn from the shelf, never from an open loan or a ready hold.
+    """
+    if total < 0:
+        raise CirculationError('Copy count cannot be negative.')
+    book = lock_book(book_id)
+    if book is None:
+        db.session.rollback()
+        raise CirculationError('Book not found.')
+    delta = total - book.copies_total
+    promoted = False
+    if delta > 0:
+        for _ in range(delta):
+            promoted = release_copy(book) is not None or promoted
+    elif delta < 0:
+        withdrawn = db.session.execute(
+            update(Book)
+            .where(Book.id == book_id, Book.copies_available >= -delta)
+            .ordered_values(
+                (Book.availability, Book.copies_available > -delta),
+                (Book.copies_available, Book.copies_available + delta),
+            )
+        ).rowcount
+        if not withdrawn:
+            db.session.rollback()
+            raise CirculationError('Only copies on the shelf can be withdrawn.')
+    db.session.execute(update(Book).where(Book.id == book_id).values(copies_total=total))
+    db.session.commit()
+    if promoted:
+        notify_mail_workers()
+
+
+def serve_waitlists():
+    """
+    Hand shelf copies to waiting holds, e.g. after a bulk import added
+    copies without going through release_copy; returns holds promoted
+    """
+    book_ids = db.session.query(BookHold.book_id).join(Book).filter(
+        BookHold.status == 'waiting', Book.copies_available > 0
+    ).distinct().all()
+    promoted = 0
+    for (book_id,) in book_ids:
+        book = lock_book(book_id)
+        # Take a shelf copy and release it again until the shelf or the
+        # waitlist runs out; a release with nobody waiting reshelves it
+        while take_copy(book_id):
+            if release_copy(book) is None:
+                break
+            promoted += 1
+        db.session.commit()
+    if promoted:
+        notify_mail_workers()
+    return promoted
+
+
+def init_app(app):
+    app.config.setdefault('CATALOG_PAGE_SIZE', 24)
+    app.config.setdefault('LOAN_DAYS', 14)
+    app.config.setdefault('HOLD_PICKUP_DAYS', 3)
@@ -0,0 +1,206 @@
+import contextlib
+import sys
+import time
+
+import click
+
+from app import app
+from extensions import db
+import outbox
+import reminders
+import migrations
+import image_pipeline
+import search_index
+import circulation
+import catalog_io
+import assets
+import analytics
+
+
+@app.cli.command('init-db')
+def init_db():
+    """Create any missing tables and mark all migrations as applied"""
+    db.create_all()
+    migrations.upgrade()
+    click.echo('Database tables created.')
+
+
+@app.cli.command('drain-outbox')
+def drain_outbox():
+    """Send every due email in the outbox once, then exit (for cron)"""
+    sent = outbox.drain()
+    click.echo(f'Processed {sent} outbox messages.')
+
+
+@app.cli.command('outbox-worker')
+@click.option('--workers', default=None, type=int, help='Number of worker threads.')
+def outbox_worker(workers):
+    """Run the outbox worker pool in the foreground"""
+    # EMAIL_WORKERS=0 keeps web processes from sending; this one still does
+    outbox.worker_pool.start(app, size=workers or app.config['EMAIL_WORKERS'] or 1)
+    click.echo('Outbox workers running, press Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        outbox.worker_pool.stop()
+
+
+@app.cli.command('send-reminders')
+@click.option('--days', default=3, show_default=True, help='Remind about books due within this many days.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows fetched per query.')
+@click.option('--send/--no-send', default=False, help='Drain the outbox before exiting.')
+def send_reminders(days, batch_size, send):
+    """Queue due-date and overdue digests, one email per user"""
+    users, books = reminders.send_due_reminders(days=days, batch_size=batch_size)
+    click.echo(f'Queued reminders for {books} books to {users} users.')
+    if send:
+        click.echo(f'Processed {outbox.drain()} outbox messages.')
+
+
+@app.cli.command('db-upgrade')
+@click.option('--explain/--no-explain', default=False, help='Print EXPLAIN plans for the hot queries before and after.')
+def db_upgrade(explain):
+    """Apply pending schema migrations"""
+    if explain:
+        click.echo('EXPLAIN before upgrade:\n' + migrations.explain_report())
+    applied = migrations.upgrade()
+    click.echo(f"Applied migrations: {', '.join(map(str, applied)) or 'none'}")
+    if explain:
+        click.echo('EXPLAIN after upgrade:\n' + migrations.explain_report())
+
+
+@app.cli.command('db-status')
+def db_status():
+    """List schema migrations that have not been applied"""
+    pending = migrations.pending_migrations()
+    if not pending:
+        click.echo('Database schema is up to date.')
+    for version, name, steps in pending:
+        click.echo(f'{version}: {name}')
+        for step in steps:
+            click.echo(f'    {step.description}')
+
+
+@app.cli.command('db-explain')
+def db_explain():
+    """Print EXPLAIN plans for the hot route queries"""
+    click.echo(migrations.explain_report())
+
+
+@app.cli.command('process-images')
+def process_images():
+    """Resubmit forum images left unprocessed by a restart"""
+    count = image_pipeline.requeue_pending()
+    image_pipeline.pipeline.shutdown()
+    click.echo(f'Processed {count} pending images.')
+
+
+@app.cli.command('search-reindex')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows read per query.')
+def search_reindex(batch_size):
+    """Rebuild the full-text search index from the database"""
+    if search_index.backend is not search_index.index:
+        raise click.ClickException('SEARCH_BACKEND is database; there is no index to rebuild.')
+    total = search_index.rebuild(batch_size=batch_size)
+    click.echo(f'Indexed {total} documents.')
+
+
+@app.cli.command('set-copies')
+@click.argument('book_id', type=int)
+@click.argument('total', type=int)
+def set_copies(book_id, total):
+    """Set how many copies of a catalog book the library owns"""
+    try:
+        circulation.set_copies(book_id, total)
+    except circulation.CirculationError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Book {book_id} now has {total} copies.')
+
+
+@app.cli.command('expire-holds')
+def expire_holds():
+    """Pass on held copies that were not borrowed in time"""
+    count = circulation.expire_holds()
+    click.echo(f'Expired {count} holds.')
+
+
+def open_text(path, mode, encoding):
+    """Open a file for the csv module, or stdin/stdout for -"""
+    if path == '-':
+        return contextlib.nullcontext(sys.stdin if mode == 'r' else sys.stdout)
+    return open(path, mode, encoding=encoding, newline='')
+
+
+@app.cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Defaults to the file extension (csv unless .jsonl/.ndjson/.json).')
+@click.option('--chunk-size', default=5000, show_default=True, help='Rows per batched upsert.')
+@click.option('--reindex/--no-reindex', default=True, show_default=True,
+              help='Update the search index as titles are imported.')
+@click.option('--max-errors', default=20, show_default=True, help='Rejected rows to print.')
+def import_books(path, fmt, chunk_size, reindex, max_errors):
+    """Bulk import catalog titles from CSV or JSON Lines (title, author, copies)"""
+    fmt = catalog_io.detect_format(path, fmt)
+    shown = 0
+
+    def on_reject(line, reason):
+        nonlocal shown
+        if shown < max_errors:
+            click.echo(f'Line {line}: {reason}', err=True)
+        shown += 1
+
+    with open_text(path, 'r', encoding='utf-8-sig') as stream:
+        totals = catalog_io.import_books(
+            stream, fmt, chunk_size=chunk_size, reindex=reindex,
+            on_progress=catalog_io.Progress(lambda msg: click.echo(msg, err=True)),
+            on_reject=on_reject
+        )
+    promoted = circulation.serve_waitlists()
+    click.echo(f"Imported {totals['upserted']} titles from {totals['read']} rows "
+               f"({totals['duplicates']} duplicates, {totals['rejected']} rejected, "
+               f"{promoted} holds served).")
+
+
+@app.cli.command('export-table')
+@click.argument('table', type=click.Choice(sorted(catalog_io.EXPORT_COLUMNS)))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv', show_default=True)
+@click.option('--output', default='-', show_default=True, help='File to write, - for stdout.')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows read per query.')
+def export_table(table, fmt, output, batch_size):
+    """Stream the books or user_books table to CSV or JSON Lines"""
+    with open_text(output, 'w', encoding='utf-8') as stream:
+        count = catalog_io.export_table(table, stream, fmt, batch_size)
+    click.echo(f'Exported {count} rows.', err=True)
+
+
+@app.cli.command('build-assets')
+@click.option('--check', is_flag=True, help='Only verify that static/dist matches the sources.')
+def build_assets(check):
+    """Fingerprint and precompress static files into static/dist (commit the result)"""
+    if check:
+        out_of_date = assets.stale(app.static_folder, assets.manifest)
+        if out_of_date:
+            raise click.ClickException(
+                f"static/dist is out of date for: {', '.join(out_of_date)}; run `flask build-assets`")
+        click.echo(f'{len(assets.manifest)} assets are up to date.')
+        return
+    built = assets.build(app.static_folder)
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        click.echo('brotli is not installed (pip install -r requirements-dev.txt); '
+                   'only gzip variants were written.', err=True)
+    click.echo(f'Built {len(built)} assets into {assets.DIST_FOLDER}/.')
+
+
+@app.cli.command('analytics-backfill')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows read per query.')
+def analytics_backfill(batch_size):
+    """Rebuild the reading analytics rollups from user_books"""
+    started = time.perf_counter()
+    with db.engine.begin() as conn:
+        count = analytics.rebuild(conn, batch_size)
+    click.echo(f'Rebuilt reading rollups from {count} borrowed books '
+               f'in {time.perf_counter() - started:.1f}s.')
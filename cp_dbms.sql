@@ -16,7 +16,10 @@ CREATE TABLE books (
     id INT AUTO_INCREMENT PRIMARY KEY,
     title VARCHAR(255) NOT NULL,
     author VARCHAR(255) NOT NULL,
-    availability TINYINT NOT NULL CHECK (availability IN (0, 1))
+    availability TINYINT NOT NULL CHECK (availability IN (0, 1)),
+    copies_total INT NOT NULL DEFAULT 1,
+    copies_available INT NOT NULL DEFAULT 1,
+    UNIQUE KEY uq_books_title_author (title, author)
 );
 
 -- BorrowedBooks table
@@ -26,8 +29,10 @@ CREATE TABLE borrowed_books (
     book_id INT NOT NULL,
     borrow_date DATE NOT NULL,
     due_date DATE NOT NULL,
+    return_date DATE NULL,
     FOREIGN KEY (user_id) REFERENCES users(id),
-    FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE
+    FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE,
+    INDEX ix_borrowed_books_user_return (user_id, return_date)
 );
 
 -- Forum posts table
@@ -37,8 +42,11 @@ CREATE TABLE forum_posts (
     title VARCHAR(200) NOT NULL,
     content TEXT NOT NULL,
     photo_filename VARCHAR(255) NULL,
+    photo_status VARCHAR(10) NULL,
+    comment_count INT NOT NULL DEFAULT 0,
     date_posted TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id)
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    INDEX ix_forum_posts_date_posted_id (date_posted, id)
 );
 
 -- Forum comments table
@@ -49,7 +57,8 @@ CREATE TABLE forum_comments (
     content TEXT NOT NULL,
     date_posted TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (post_id) REFERENCES forum_posts(id),
-    FOREIGN KEY (user_id) REFERENCES users(id)
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    INDEX ix_forum_comments_post_date_posted (post_id, date_posted)
 );
 
 -- User books table
@@ -63,5 +72,90 @@ CREATE TABLE user_books (
     return_date DATE,
     is_returned TINYINT DEFAULT 0,
     notes TEXT,
-    FOREIGN KEY (user_id) REFERENCES users(id)
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    INDEX ix_user_books_active_user_due (is_returned, user_id, due_date),
+    INDEX ix_user_books_user_borrow_date (user_id, borrow_date)
+);
+
+-- Outgoing email queue, drained by the outbox workers
+CREATE TABLE email_outbox (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    recipient VARCHAR(120) NOT NULL,
+    subject VARCHAR(255) NOT NULL,
+    html TEXT NOT NULL,
+    status VARCHAR(10) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL,
+    locked_at DATETIME NULL,
+    last_error TEXT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at DATETIME NULL,
+    INDEX ix_email_outbox_status_next_attempt (status, next_attempt_at)
+);
+
+-- Due-date reminders already sent, one row per book and reminder kind
+CREATE TABLE book_reminders (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_book_id INT NOT NULL,
+    kind VARCHAR(10) NOT NULL,
+    sent_at DATETIME,
+    UNIQUE KEY uq_book_reminders_book_kind (user_book_id, kind),
+    FOREIGN KEY (user_book_id) REFERENCES user_books(id) ON DELETE CASCADE
+);
+
+-- Applied schema migrations, see migrations.py
+CREATE TABLE schema_migrations (
+    version INT PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    applied_at DATETIME
+);
+
+-- Content-addressed forum uploads (sha256 of the raw file) and their references
+CREATE TABLE stored_uploads (
+    digest CHAR(64) PRIMARY KEY,
+    refcount INT NOT NULL DEFAULT 0,
+    size_bytes INT NOT NULL,
+    width INT NOT NULL,
+    height INT NOT NULL,
+    created_at DATETIME
+);
+
+-- Waitlist for catalog titles, see circulation.py
+CREATE TABLE book_holds (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    book_id INT NOT NULL,
+    user_id INT NOT NULL,
+    status VARCHAR(10) NOT NULL DEFAULT 'waiting',
+    created_at DATETIME NOT NULL,
+    ready_until DATETIME NULL,
+    FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    INDEX ix_book_holds_book_status_created (book_id, status, created_at),
+    INDEX ix_book_holds_user_status (user_id, status)
+);
+
+-- Version stamps for HTTP and fragment caching, see http_cache.py
+CREATE TABLE data_versions (
+    `key` VARCHAR(64) PRIMARY KEY,
+    version INT NOT NULL DEFAULT 0,
+    updated_at DATETIME NULL
+);
+
+-- Reading analytics rollups, see analytics.py; user_id 0 is the whole library
+CREATE TABLE reading_rollups (
+    user_id INT NOT NULL,
+    period VARCHAR(7) NOT NULL,
+    borrowed INT NOT NULL DEFAULT 0,
+    returned INT NOT NULL DEFAULT 0,
+    returned_on_time INT NOT NULL DEFAULT 0,
+    loan_days INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, period)
+);
+
+CREATE TABLE reading_author_rollups (
+    user_id INT NOT NULL,
+    author VARCHAR(255) NOT NULL,
+    borrowed INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, author),
+    INDEX ix_reading_author_rollups_user_borrowed (user_id, borrowed)
 );
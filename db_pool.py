@@ -0,0 +1,153 @@
+"""
+Engine and connection pool configuration
+
+Builds SQLALCHEMY_ENGINE_OPTIONS from the DB_* settings before the
+database extension is initialised, and keeps running pool metrics:
+how long requests waited for a connection and how close the pool is
+to its limit.
+
+In serverless mode (DB_SERVERLESS, on by default under Vercel) each
+instance keeps one pooled connection that warm invocations reuse. It is
+pinged before use, because a frozen instance's connection may have been
+closed by the server in the meantime.
+"""
+import os
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats:
+    """Checkout wait times collected from every TimedQueuePool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def snapshot(self, engine):
+        """Wait statistics plus the pool's current occupancy"""
+        with self._lock:
+            data = {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': self.wait_total,
+                'wait_seconds_max': self.wait_max,
+                'wait_seconds_avg': self.wait_total / self.checkouts if self.checkouts else 0.0,
+            }
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            capacity = pool.size() + max(pool._max_overflow, 0)
+            data.update(
+                pool_size=pool.size(),
+                checked_out=pool.checkedout(),
+                overflow=max(pool.overflow(), 0),
+                # Fraction of the connection limit in use; at 1.0 the next
+                # checkout waits up to DB_POOL_TIMEOUT
+                saturation=pool.checkedout() / capacity if capacity else 0.0,
+            )
+        return data
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waited (including
+    opening a new connection when the pool is below its size)"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeout:
+            pool_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record(time.perf_counter() - start)
+        return conn
+
+
+def engine_options(config):
+    """SQLAlchemy engine options for the DB_* settings in config"""
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('sqlite') and ':memory:' in uri:
+        # Single connection shared by design; nothing to pool
+        return {}
+
+    if config['DB_SERVERLESS']:
+        options = {
+            'pool_size': 1,
+            'max_overflow': 2,
+            'pool_recycle': min(config['DB_POOL_RECYCLE'], 300),
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+            'pool_pre_ping': True,
+            # Hand back the most recent connection so extras go idle and
+            # are recycled instead of kept alive by round-robin use
+            'pool_use_lifo': True,
+        }
+    else:
+        options = {
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_recycle': config['DB_POOL_RECYCLE'],
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+            'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        }
+    options['poolclass'] = TimedQueuePool
+
+    if uri.startswith('mysql'):
+        connect_args = {'connect_timeout': config['DB_CONNECT_TIMEOUT']}
+        if config['DB_STATEMENT_TIMEOUT_MS']:
+            # Caps SELECT run time server-side (MySQL 5.7.8+)
+            connect_args['init_command'] = (
+                f"SET SESSION max_execution_time={int(config['DB_STATEMENT_TIMEOUT_MS'])}"
+            )
+        options['connect_args'] = connect_args
+    return options
+
+
+def reset_after_fork(app):
+    """
+    Forget connections inherited from a parent process without closing
+    them, since the parent may still be using the same sockets
+    """
+    extension = app.extensions.get('sqlalchemy')
+    if extension is None:
+        return
+    # Flask-SQLAlchemy looks engines up through the current app
+    with app.app_context():
+        for engine in extension.engines.values():
+            engine.dispose(close=False)
+
+
+def init_app(app):
+    """Fill in SQLALCHEMY_ENGINE_OPTIONS; call before db.init_app"""
+    app.config.setdefault('DB_POOL_SIZE', 10)
+    app.config.setdefault('DB_MAX_OVERFLOW', 10)
+    # Below MySQL's default wait_timeout and most proxies' idle limits
+    app.config.setdefault('DB_POOL_RECYCLE', 1800)
+    app.config.setdefault('DB_POOL_TIMEOUT', 10)
+    app.config.setdefault('DB_POOL_PRE_PING', True)
+    app.config.setdefault('DB_CONNECT_TIMEOUT', 5)
+    app.config.setdefault('DB_STATEMENT_TIMEOUT_MS', 0)
+    app.config.setdefault('DB_SERVERLESS', False)
+    options = engine_options(app.config)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    # Workers forked from a preloaded app open their own connections
+    os.register_at_fork(after_in_child=lambda: reset_after_fork(app))
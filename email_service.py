@@ -1,9 +1,36 @@
 # email_service.py
-from flask_mail import Mail, Message
-import os
-from flask import render_template_string
+from jinja2 import Environment
+from extensions import db
+from outbox import enqueue
 
-mail = Mail()
+# Template registry: every email template is compiled once, at import
+# time, and rendered from the cached Template object on each send
+_template_env = Environment(autoescape=True)
+EMAIL_TEMPLATES = {}
+
+def register_template(name, subject, source):
+    """
+    Compile an email template and make it available by name
+    
+    Args:
+        name: Key used by send_templated_email
+        subject: Subject line, itself a Jinja template
+        source: HTML body template
+    """
+    EMAIL_TEMPLATES[name] = (
+        _template_env.from_string(subject),
+        _template_env.from_string(source)
+    )
+
+def render_email(name, **context):
+    """Render a registered template, returning (subject, html)"""
+    subject, body = EMAIL_TEMPLATES[name]
+    return subject.render(**context), body.render(**context)
+
+def send_templated_email(name, recipients, commit=True, **context):
+    """Render a registered template and queue it for delivery"""
+    subject, html = render_email(name, **context)
+    enqueue(recipients, subject, html, commit=commit)
 
 # HTML template for welcome email
 WELCOME_EMAIL_TEMPLATE = """
@@ -47,32 +74,29 @@ WELCOME_EMAIL_TEMPLATE = """
 </body>
 </html>
 """
+register_template('welcome', 'Welcome to Our Library!', WELCOME_EMAIL_TEMPLATE)
 
-def send_welcome_email(user):
+def send_welcome_email(user, commit=True):
     """
-    Send welcome email to newly registered users
+    Queue welcome email for newly registered users
     
     Args:
         user: User object containing username and email
+        commit: Pass False to queue it in the caller's transaction;
+            errors are then raised for the caller to roll back
     """
     try:
-        msg = Message(
-            'Welcome to Our Library!',
-            sender=os.getenv('MAIL_DEFAULT_SENDER'),
-            recipients=[user.email]
-        )
-        
-        # Render the HTML template with user data
-        msg.html = render_template_string(
-            WELCOME_EMAIL_TEMPLATE,
+        send_templated_email(
+            'welcome', [user.email], commit=commit,
             username=user.username,
             email=user.email
         )
-        
-        mail.send(msg)
         return True
     except Exception as e:
-        print(f"Error sending welcome email: {str(e)}")
+        if not commit:
+            raise
+        db.session.rollback()
+        print(f"Error queueing welcome email: {str(e)}")
         return False
 
 # Add a new template for borrowed book notification
@@ -114,34 +138,31 @@ BORROWED_BOOK_EMAIL_TEMPLATE = """
 </body>
 </html>
 """
+register_template('borrowed_book', 'New Borrowed Book Notification', BORROWED_BOOK_EMAIL_TEMPLATE)
 
-def send_borrowed_book_notification(user, book_details):
+def send_borrowed_book_notification(user, book_details, commit=True):
     """
-    Send notification email when a book is added to borrowed list
+    Queue notification email when a book is added to borrowed list
     
     Args:
         user: User object 
         book_details: Dictionary containing book information
+        commit: Pass False to queue it in the caller's transaction;
+            errors are then raised for the caller to roll back
     """
     try:
-        msg = Message(
-            'New Borrowed Book Notification',
-            sender=os.getenv('MAIL_DEFAULT_SENDER'),
-            recipients=[user.email]
-        )
-        
-        # Render the HTML template with user and book data
-        msg.html = render_template_string(
-            BORROWED_BOOK_EMAIL_TEMPLATE,
+        send_templated_email(
+            'borrowed_book', [user.email], commit=commit,
             username=user.username,
             book_title=book_details['book_title'],
             author=book_details['author'],
             borrow_date=book_details['borrow_date'],
             due_date=book_details['due_date']
         )
-        
-        mail.send(msg)
         return True
     except Exception as e:
-        print(f"Error sending borrowed book notification: {str(e)}")
+        if not commit:
+            raise
+        db.session.rollback()
+        print(f"Error queueing borrowed book notification: {str(e)}")
         return False
\ No newline at end of file
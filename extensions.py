@@ -1,5 +1,34 @@
+import threading
+
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 
+
+class LazyMail:
+    """
+    Flask-Mail, imported and configured the first time mail is sent
+
+    Requests only queue mail in the outbox, so a web worker that never
+    delivers any skips loading smtplib and the email package.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        # Flask-Mail reads MAIL_* from app.config when first used
+        pass
+
+    def connect(self):
+        app = current_app._get_current_object()
+        with self._lock:
+            if 'mail' not in app.extensions:
+                from flask_mail import Mail
+                Mail(app)
+        return app.extensions['mail'].connect()
+
+
 db = SQLAlchemy()
-login_manager = LoginManager()
\ No newline at end of file
+login_manager = LoginManager()
+mail = LazyMail()
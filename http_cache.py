@@ -0,0 +1,178 @@
+"""
+Conditional GETs and fragment caching keyed on data version stamps
+
+Pages that only change when their data does carry a weak ETag built
+from version stamps (the DataVersion rows) plus the viewer, and
+If-None-Match / If-Modified-Since are answered with a 304 before any
+page query or template render runs. Writers bump the stamps inside
+their own transaction, so a stamp can never run ahead of or behind the
+data it describes.
+
+Rendered forum post cards are cached per process, keyed on the post's
+stamp; a worker holding an older card simply sees a newer version and
+renders again.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import current_app, make_response, request, session
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import DataVersion
+
+FORUM_KEY = 'forum'
+
+
+def post_key(post_id):
+    return f'post:{post_id}'
+
+def user_books_key(user_id):
+    return f'user_books:{user_id}'
+
+
+def bump(*keys):
+    """Advance version stamps inside the current transaction"""
+    now = datetime.utcnow()
+    # A fixed order keeps concurrent writers from deadlocking on the rows
+    for key in sorted(set(keys)):
+        def increment():
+            return db.session.execute(
+                update(DataVersion).where(DataVersion.key == key)
+                .values(version=DataVersion.version + 1, updated_at=now)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+
+        if increment():
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.add(DataVersion(key=key, version=1, updated_at=now))
+        except IntegrityError:
+            # Another writer created the row first
+            increment()
+
+
+def versions(keys):
+    """Map each key to (version, updated_at); missing keys are (0, None)"""
+    found = {
+        row.key: (row.version, row.updated_at)
+        for row in db.session.query(DataVersion.key, DataVersion.version, DataVersion.updated_at)
+        .filter(DataVersion.key.in_(list(keys)))
+    } if keys else {}
+    return {key: found.get(key, (0, None)) for key in keys}
+
+
+def make_etag(parts):
+    raw = repr((current_app.config['CACHE_BUILD_ID'],) + tuple(parts))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def conditional_response(parts, render, last_modified=None):
+    """
+    Serve a page through ETag / Last-Modified validation
+
+    Args:
+        parts: Everything the page depends on: version stamps, viewer,
+            query arguments, the date for date-sensitive badges
+        render: Called only when the client's copy is stale
+        last_modified: Optional datetime of the newest change
+    """
+    # Pending flash messages are rendered (and consumed) by the page
+    if not current_app.config['HTTP_CACHE_ENABLED'] or session.get('_flashes'):
+        return render()
+
+    etag = make_etag(parts)
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0)
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = (last_modified is not None and request.if_modified_since is not None
+                 and last_modified <= request.if_modified_since.replace(tzinfo=None))
+
+    response = make_response('', 304) if fresh else make_response(render())
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Pages differ per user, so only the browser may keep them, and it
+    # must revalidate every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+class FragmentCache:
+    """
+    Bounded LRU of rendered fragments
+
+    Each name (e.g. a post key) holds the variants rendered for one
+    version; a lookup with a different version misses and the next put
+    replaces every variant.
+    """
+
+    def __init__(self, max_size=2048):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, name, version, variant):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] == version and variant in entry[1]:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return entry[1][variant]
+            self.misses += 1
+            return None
+
+    def put(self, name, version, variant, html):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry[0] != version:
+                entry = self._entries[name] = (version, {})
+            entry[1][variant] = html
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *names):
+        with self._lock:
+            for name in names:
+                self._entries.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def counters(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+fragments = FragmentCache()
+
+
+def build_id(app):
+    """
+    Changes whenever a template or the asset manifest does, so deploys
+    invalidate ETags of pages whose markup or asset URLs changed
+    """
+    paths = [app.config.get('ASSET_MANIFEST')]
+    for root, _, files in os.walk(os.path.join(app.root_path, app.template_folder)):
+        paths.extend(os.path.join(root, name) for name in files)
+    newest = max([os.path.getmtime(path) for path in paths if path and os.path.exists(path)] or [0])
+    return str(int(newest))
+
+
+def init_app(app):
+    app.config.setdefault('HTTP_CACHE_ENABLED', True)
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 2048)
+    if not app.config.get('CACHE_BUILD_ID'):
+        app.config['CACHE_BUILD_ID'] = build_id(app)
+    fragments.max_size = app.config['FRAGMENT_CACHE_SIZE']
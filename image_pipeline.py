@@ -0,0 +1,203 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from flask import current_app, url_for
+
+from extensions import db
+from models import ForumPost
+from metrics import observe_image
+from http_cache import FORUM_KEY, post_key, bump
+from live import publish
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_FOLDER = 'static/forum_uploads'
+RAW_FOLDER = 'uploads/raw'
+# Rendition name -> longest edge in pixels, smallest first
+RENDITIONS = {'thumb': 320, 'medium': 800, 'full': 1600}
+FORMATS = ('webp', 'jpg')
+
+
+def rendition_filename(base, rendition, fmt):
+    return f"{base}_{rendition}.{fmt}"
+
+
+def render_renditions(raw_path, out_dir, base, quality=85, max_pixels=None):
+    """
+    Write every rendition of a raw upload; runs in a pool process
+
+    Each file is written under a temporary name and renamed into place,
+    so the web server never serves a half-written image.
+
+    Returns:
+        Seconds spent decoding, resizing and encoding
+    """
+    from PIL import Image, ImageOps
+
+    started = time.perf_counter()
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    with Image.open(raw_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        for rendition, edge in RENDITIONS.items():
+            resized = img.copy()
+            resized.thumbnail((edge, edge), Image.LANCZOS)
+            for fmt in FORMATS:
+                path = os.path.join(out_dir, rendition_filename(base, rendition, fmt))
+                tmp_path = f"{path}.tmp"
+                if fmt == 'webp':
+                    resized.save(tmp_path, 'WEBP', quality=quality - 5, method=4)
+                else:
+                    resized.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+                os.replace(tmp_path, path)
+    return time.perf_counter() - started
+
+
+def raw_path(base):
+    return os.path.join(current_app.config['IMAGE_RAW_FOLDER'], base)
+
+
+def photo_status_for(base):
+    """Processing status of content already attached to another post"""
+    status = db.session.query(ForumPost.photo_status).filter(
+        ForumPost.photo_filename == base,
+        ForumPost.photo_status.isnot(None)
+    ).first()
+    return status[0] if status else 'pending'
+
+
+class ImagePipeline:
+    """
+    Produces forum image renditions off the request thread
+
+    Jobs run in a process pool so Pillow's resampling neither blocks the
+    request nor holds the web process's GIL. With IMAGE_WORKERS = 0 (e.g.
+    on serverless hosts that freeze after the response) jobs run inline.
+    A pool broken by a dead worker (crashed, killed for memory) is
+    replaced and the job retried once; after that its posts are marked
+    failed rather than the error reaching the request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def executor(self, app):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=app.config['IMAGE_WORKERS'])
+                self._pid = os.getpid()
+            return self._executor
+
+    def _drop_executor(self, executor):
+        """Forget a broken pool, so the next job starts a fresh one"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def submit(self, base, attempt=0):
+        """Queue rendition work for stored content"""
+        app = current_app._get_current_object()
+        args = (raw_path(base), app.config['IMAGE_UPLOAD_FOLDER'], base,
+                app.config['IMAGE_QUALITY'], app.config['MAX_IMAGE_PIXELS'])
+        if app.config['IMAGE_WORKERS'] == 0:
+            started = time.perf_counter()
+            try:
+                self._finish(base, None, render_renditions(*args))
+            except Exception as e:
+                self._finish(base, e, time.perf_counter() - started)
+            return
+        for _ in range(2):
+            executor = self.executor(app)
+            try:
+                future = executor.submit(render_renditions, *args)
+                break
+            except (BrokenProcessPool, OSError) as e:
+                self._drop_executor(executor)
+                error = e
+        else:
+            self._finish(base, error)
+            return
+        future.add_done_callback(partial(self._on_done, app, executor, base, attempt))
+
+    def _on_done(self, app, executor, base, attempt, future):
+        error = future.exception()
+        with app.app_context():
+            if isinstance(error, BrokenProcessPool):
+                # Every job in the pool fails when one worker dies, so
+                # retry on a fresh pool before blaming this image
+                self._drop_executor(executor)
+                if attempt == 0:
+                    self.submit(base, attempt=1)
+                    return
+            self._finish(base, error, None if error is not None else future.result())
+
+    def _finish(self, base, error, seconds=None):
+        """Mark every post waiting on this content as ready or failed"""
+        if seconds is not None:
+            observe_image(seconds, error is None)
+        if error is not None:
+            logger.error(f"Image processing failed for {base}: {error}")
+        waiting = ForumPost.query.filter_by(photo_filename=base, photo_status='pending')
+        post_ids = [row[0] for row in waiting.with_entities(ForumPost.id)]
+        waiting.update(
+            {'photo_status': 'failed' if error is not None else 'ready'},
+            synchronize_session=False
+        )
+        if post_ids:
+            bump(FORUM_KEY, *[post_key(post_id) for post_id in post_ids])
+        db.session.commit()
+        for post_id in post_ids:
+            publish('post_updated', post_id=post_id)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+pipeline = ImagePipeline()
+
+
+def rendition_url(post, rendition='medium', fmt='jpg'):
+    """URL of one rendition of a post's photo"""
+    return url_for('static', filename='forum_uploads/'
+                   + rendition_filename(post.photo_filename, rendition, fmt))
+
+
+def rendition_srcset(post, fmt):
+    """srcset listing every rendition of a post's photo in one format"""
+    return ', '.join(
+        f"{rendition_url(post, rendition, fmt)} {edge}w"
+        for rendition, edge in RENDITIONS.items()
+    )
+
+
+def requeue_pending():
+    """Resubmit content left 'pending' by a restart; returns how many"""
+    bases = [row[0] for row in db.session.query(ForumPost.photo_filename)
+             .filter_by(photo_status='pending').distinct()]
+    for base in bases:
+        if os.path.exists(raw_path(base)):
+            pipeline.submit(base)
+        else:
+            pipeline._finish(base, FileNotFoundError(raw_path(base)))
+    return len(bases)
+
+
+def init_app(app):
+    app.config.setdefault('IMAGE_WORKERS', 2)
+    app.config.setdefault('IMAGE_QUALITY', 85)
+    app.config.setdefault('IMAGE_UPLOAD_FOLDER', os.path.join(app.root_path, UPLOAD_FOLDER))
+    app.config.setdefault('IMAGE_RAW_FOLDER', os.path.join(app.root_path, RAW_FOLDER))
+    app.add_template_global(rendition_url)
+    app.add_template_global(rendition_srcset)
@@ -0,0 +1,219 @@
+"""
+Live forum updates over Server-Sent Events
+
+Write routes publish small JSON events after they commit (a new or
+deleted comment, a new, changed or deleted post) and every open forum
+page receives them on /forum/events, so the page patches itself instead
+of reloading the whole feed.
+
+Each process keeps its subscribers and a short replay buffer. Event ids
+are local to the process serving the stream: a client reconnecting with
+a Last-Event-ID from this process gets what it missed from the buffer,
+anyone else gets a "resync" event and refreshes on its own terms. With
+LIVE_EVENTS_URL pointing at Redis, events are fanned out through
+pub/sub so subscribers on every worker see every write.
+
+Every open stream holds a server thread (or, on serverless hosts, a
+whole function invocation) for as long as it lasts, so live updates are
+opt-in: set LIVE_ENABLED on a server with a threaded, gevent or ASGI
+worker. A gunicorn sync worker pool is used up by a handful of open
+tabs, and serverless functions are billed for every second a stream
+stays open, so LIVE_ENABLED defaults to off and is ignored on
+DB_SERVERLESS hosts. Pages still post their forms with fetch and patch
+themselves from the response; they only stop hearing about other
+people's writes until they reload.
+
+Streams are capped (LIVE_MAX_SUBSCRIBERS) and closed after
+LIVE_STREAM_SECONDS, after which EventSource reconnects by itself.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from flask import Response, current_app, request, stream_with_context
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriber:
+    def __init__(self, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.dropped = False
+
+
+class Broker:
+    """In-process fan-out with a replay buffer"""
+
+    def __init__(self, buffer_size=256, queue_size=100):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._buffer = deque(maxlen=buffer_size)
+        self._seq = 0
+        self.token = os.urandom(4).hex()
+        self.queue_size = queue_size
+        self.published = 0
+
+    def deliver(self, kind, data):
+        """Number an event and hand it to every local subscriber"""
+        with self._lock:
+            self._seq += 1
+            event = (f"{self.token}-{self._seq}", kind, data)
+            self._buffer.append(event)
+            self.published += 1
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                # Too slow to keep up; it will resync when it reconnects
+                subscriber.dropped = True
+
+    def subscribe(self, last_event_id=None):
+        """
+        Returns:
+            Tuple of (subscriber, events to replay first, whether the
+            client missed events that can no longer be replayed)
+        """
+        subscriber = Subscriber(self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            replay, gap = [], False
+            if last_event_id:
+                token, _, seq = last_event_id.rpartition('-')
+                if token != self.token or not seq.isdigit():
+                    gap = True
+                else:
+                    seq = int(seq)
+                    replay = [event for event in self._buffer
+                              if int(event[0].rpartition('-')[2]) > seq]
+                    oldest = int(self._buffer[0][0].rpartition('-')[2]) if self._buffer else self._seq + 1
+                    gap = seq < self._seq and seq + 1 < oldest
+        return subscriber, replay, gap
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def counters(self):
+        with self._lock:
+            return {'subscribers': len(self._subscribers), 'published': self.published}
+
+
+class RedisBridge:
+    """Fans events out to every process through Redis pub/sub"""
+
+    def __init__(self, url, channel='library:forum-events'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def publish(self, kind, data):
+        self.client.publish(self.channel, json.dumps([kind, data]))
+
+    def listen(self, target):
+        """Start this process's listener thread once"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, args=(target,), name='live-events', daemon=True).start()
+
+    def _run(self, target):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    kind, data = json.loads(message['data'])
+                    target.deliver(kind, data)
+            except Exception as e:
+                logger.error(f"Live event listener failed: {str(e)}")
+                time.sleep(1)
+
+
+broker = Broker()
+bridge = None
+
+
+def enabled(app=None):
+    config = (app or current_app).config
+    return config['LIVE_ENABLED'] and not config['DB_SERVERLESS']
+
+
+def publish(kind, **data):
+    """Announce a committed change; never raises into the write route"""
+    if not enabled():
+        return
+    try:
+        if bridge is not None:
+            bridge.publish(kind, data)
+        else:
+            broker.deliver(kind, data)
+    except Exception as e:
+        logger.error(f"Failed to publish {kind} event: {str(e)}")
+
+
+def format_event(event):
+    event_id, kind, data = event
+    return f"id: {event_id}\nevent: {kind}\ndata: {json.dumps(data)}\n\n"
+
+
+def event_stream():
+    """The /forum/events view"""
+    config = current_app.config
+    if not enabled():
+        # 204 tells EventSource to stop reconnecting
+        return Response(status=204)
+    if broker.counters()['subscribers'] >= config['LIVE_MAX_SUBSCRIBERS']:
+        return Response('Too many live connections', status=503, headers={'Retry-After': '30'})
+    if bridge is not None:
+        bridge.listen(broker)
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    subscriber, replay, gap = broker.subscribe(last_event_id)
+    heartbeat = config['LIVE_HEARTBEAT_SECONDS']
+    deadline = time.monotonic() + config['LIVE_STREAM_SECONDS']
+
+    def generate():
+        try:
+            yield f"retry: {config['LIVE_RETRY_MS']}\n\n"
+            if gap:
+                yield "event: resync\ndata: {}\n\n"
+            for event in replay:
+                yield format_event(event)
+            while time.monotonic() < deadline and not subscriber.dropped:
+                try:
+                    event = subscriber.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(event)
+        finally:
+            broker.unsubscribe(subscriber)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx from buffering the stream
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def init_app(app):
+    global bridge
+    app.config.setdefault('LIVE_ENABLED', False)
+    app.config.setdefault('DB_SERVERLESS', False)
+    app.config.setdefault('LIVE_EVENTS_URL', None)
+    app.config.setdefault('LIVE_MAX_SUBSCRIBERS', 100)
+    app.config.setdefault('LIVE_STREAM_SECONDS', 30)
+    app.config.setdefault('LIVE_HEARTBEAT_SECONDS', 15)
+    app.config.setdefault('LIVE_RETRY_MS', 3000)
+    app.jinja_env.globals['live_enabled'] = enabled
+    if enabled(app) and app.config['LIVE_EVENTS_URL']:
+        bridge = RedisBridge(app.config['LIVE_EVENTS_URL'])
+    app.add_url_rule('/forum/events', 'forum_events', event_stream)
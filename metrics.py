@@ -0,0 +1,273 @@
+"""
+Request instrumentation and the Prometheus /metrics endpoint
+
+Records per-endpoint latency, SQL statement counts and time (from
+query_counter), template render time, and email and image processing
+time, and serves them in the Prometheus text format to scrapers that
+present METRICS_TOKEN (without one the endpoint stays hidden). Every
+worker process keeps its own registry, so scrape each process or run a
+single worker per scrape target.
+
+With SLOW_REQUEST_SECONDS set, slower requests are logged with their
+slowest SQL statements.
+"""
+import hmac
+import logging
+import threading
+import time
+
+from flask import (
+    Response, abort, current_app, g, request, before_render_template, template_rendered
+)
+
+import query_counter
+from db_pool import pool_stats
+from extensions import db
+from user_cache import user_cache
+from http_cache import fragments
+import passwords
+import live
+
+slow_logger = logging.getLogger('metrics.slow')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+SLOW_LOG_STATEMENTS = 5
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    labels = format_labels(self.labels, label_values, f'le="{format_value(float(bound))}"')
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = format_labels(self.labels, label_values, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {series[-2]}")
+                labels = format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {format_value(series[-1])}")
+                lines.append(f"{self.name}_count{labels} {series[-2]}")
+        return lines
+
+
+def gauge_lines(name, help, samples, kind='gauge'):
+    """Render values read at scrape time; samples are (labels dict, value)"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(labels.keys(), labels.values())} {format_value(value)}")
+    return lines
+
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Request latency by endpoint.',
+    ('endpoint', 'method', 'status'))
+REQUEST_QUERIES = Histogram(
+    'http_request_sql_queries', 'SQL statements per request.',
+    ('endpoint',), QUERY_COUNT_BUCKETS)
+REQUEST_SQL_TIME = Histogram(
+    'http_request_sql_seconds', 'Time spent in SQL per request.', ('endpoint',))
+SLOW_REQUESTS = Counter(
+    'http_slow_requests_total', 'Requests slower than SLOW_REQUEST_SECONDS.', ('endpoint',))
+TEMPLATE_RENDER = Histogram(
+    'template_render_seconds', 'Template render time.', ('template',))
+EMAIL_SEND = Histogram(
+    'email_send_seconds', 'Time to hand one outbox email to SMTP.', ('result',))
+IMAGE_PROCESS = Histogram(
+    'image_process_seconds', 'Time to build every rendition of an upload.', ('result',))
+
+REGISTRY = [REQUEST_LATENCY, REQUEST_QUERIES, REQUEST_SQL_TIME, SLOW_REQUESTS,
+            TEMPLATE_RENDER, EMAIL_SEND, IMAGE_PROCESS]
+
+
+def observe_email(seconds, sent):
+    EMAIL_SEND.observe(seconds, 'sent' if sent else 'error')
+
+def observe_image(seconds, ok):
+    IMAGE_PROCESS.observe(seconds, 'ok' if ok else 'error')
+
+
+def render_metrics():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+
+    pool = pool_stats.snapshot(db.engine)
+    lines += gauge_lines('db_pool_checkouts_total', 'Connection checkouts.',
+                         [({}, pool['checkouts'])], 'counter')
+    lines += gauge_lines('db_pool_checkout_timeouts_total', 'Checkouts that hit DB_POOL_TIMEOUT.',
+                         [({}, pool['timeouts'])], 'counter')
+    lines += gauge_lines('db_pool_checkout_wait_seconds_total', 'Time spent waiting for a connection.',
+                         [({}, pool['wait_seconds_total'])], 'counter')
+    lines += gauge_lines('db_pool_checkout_wait_seconds_max', 'Longest wait for a connection.',
+                         [({}, pool['wait_seconds_max'])])
+    if 'saturation' in pool:
+        lines += gauge_lines('db_pool_checked_out', 'Connections in use.',
+                             [({}, pool['checked_out'])])
+        lines += gauge_lines('db_pool_saturation', 'Fraction of the connection limit in use.',
+                             [({}, pool['saturation'])])
+
+    cache = user_cache.counters()
+    lines += gauge_lines('user_cache_lookups_total', 'User loader lookups by outcome.', [
+        ({'result': 'hit'}, cache['hits']),
+        ({'result': 'shared_hit'}, cache['shared_hits']),
+        ({'result': 'miss'}, cache['misses']),
+    ], 'counter')
+    lines += gauge_lines('user_cache_entries', 'Users held in the local cache.',
+                         [({}, cache['size'])])
+
+    cards = fragments.counters()
+    lines += gauge_lines('fragment_cache_lookups_total', 'Rendered fragment lookups by outcome.', [
+        ({'result': 'hit'}, cards['hits']),
+        ({'result': 'miss'}, cards['misses']),
+    ], 'counter')
+    lines += gauge_lines('fragment_cache_entries', 'Fragments held in the local cache.',
+                         [({}, cards['size'])])
+
+    hashing = passwords.hasher.counters()
+    lines += gauge_lines('password_hash_in_flight', 'Password hashes queued or running.',
+                         [({}, hashing['in_flight'])])
+    lines += gauge_lines('password_hash_rejected_total', 'Hashes refused because every slot was taken.',
+                         [({}, hashing['rejected'])], 'counter')
+    lines += gauge_lines('rate_limit_refused_total', 'Attempts refused by a rate limit.', [
+        ({'limit': 'login_ip'}, passwords.login_ip_limiter.refused),
+        ({'limit': 'login_username'}, passwords.login_username_limiter.refused),
+        ({'limit': 'register_ip'}, passwords.register_ip_limiter.refused),
+        ({'limit': 'login_account_backoff'}, passwords.login_account_backoff.refused),
+    ], 'counter')
+
+    events = live.broker.counters()
+    lines += gauge_lines('live_event_subscribers', 'Open /forum/events streams.',
+                         [({}, events['subscribers'])])
+    lines += gauge_lines('live_events_published_total', 'Forum events delivered to this process.',
+                         [({}, events['published'])], 'counter')
+    return '\n'.join(lines) + '\n'
+
+
+def log_slow_request(endpoint, elapsed):
+    statements = sorted(query_counter.get_statements(), key=lambda s: s[0], reverse=True)
+    lines = [f"Slow request: {request.method} {request.full_path.rstrip('?')} "
+             f"({endpoint}) took {elapsed * 1000:.1f}ms, "
+             f"{query_counter.get_query_count()} queries in "
+             f"{query_counter.get_query_time() * 1000:.1f}ms"]
+    for seconds, statement in statements[:SLOW_LOG_STATEMENTS]:
+        lines.append(f"  {seconds * 1000:.1f}ms  {' '.join(statement.split())}")
+    slow_logger.warning('\n'.join(lines))
+
+
+def init_app(app):
+    app.config.setdefault('METRICS_ENABLED', True)
+    # Bearer token for /metrics; the endpoint answers 404 until one is set
+    app.config.setdefault('METRICS_TOKEN', None)
+    app.config.setdefault('SLOW_REQUEST_SECONDS', 0)
+    # Optional file for the slow-request log; otherwise it goes wherever
+    # logging is configured to send warnings
+    app.config.setdefault('SLOW_REQUEST_LOG', None)
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    if app.config['SLOW_REQUEST_SECONDS']:
+        slow_logger.setLevel(logging.WARNING)
+        if app.config['SLOW_REQUEST_LOG']:
+            handler = logging.FileHandler(app.config['SLOW_REQUEST_LOG'])
+            handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+            slow_logger.addHandler(handler)
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        if app.config['SLOW_REQUEST_SECONDS']:
+            query_counter.record_statements()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        # Unmatched URLs share one label to keep the series count bounded
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_LATENCY.observe(elapsed, endpoint, request.method, response.status_code)
+        REQUEST_QUERIES.observe(query_counter.get_query_count(), endpoint)
+        REQUEST_SQL_TIME.observe(query_counter.get_query_time(), endpoint)
+        threshold = app.config['SLOW_REQUEST_SECONDS']
+        if threshold and elapsed >= threshold:
+            SLOW_REQUESTS.inc(endpoint)
+            log_slow_request(endpoint, elapsed)
+        return response
+
+    @before_render_template.connect_via(app)
+    def start_render(sender, template, context, **extra):
+        g.setdefault('render_started', []).append(time.perf_counter())
+
+    @template_rendered.connect_via(app)
+    def finish_render(sender, template, context, **extra):
+        started = g.get('render_started')
+        if started:
+            TEMPLATE_RENDER.observe(time.perf_counter() - started.pop(), template.name or 'string')
+
+    def metrics_view():
+        token = current_app.config['METRICS_TOKEN']
+        if not token:
+            abort(404)
+        # Compared as bytes: compare_digest rejects non-ASCII str
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                   f"Bearer {token}".encode()):
+            abort(403)
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,245 @@
+"""
+Versioned schema migrations
+
+Existing deployments were created from cp_dbms.sql and never see
+db.create_all() again, so every schema change after that file is listed
+here as a numbered migration. Steps are idempotent and indexes are added
+with ALGORITHM=INPLACE, LOCK=NONE on MySQL, so `flask db-upgrade` can run
+against a live database.
+"""
+import logging
+from datetime import date, datetime
+
+from sqlalchemy import delete, func, inspect, select, update
+from sqlalchemy.exc import DatabaseError
+
+from extensions import db
+from models import (
+    UserBook, ForumPost, ForumComment, EmailOutbox, BookReminder,
+    StoredUpload, SchemaMigration, Book, BorrowedBook, BookHold, DataVersion,
+    ReadingRollup, AuthorRollup
+)
+import analytics
+
+logger = logging.getLogger(__name__)
+
+
+# Migration steps
+def create_table(model):
+    """Step that creates a model's table (with its indexes) if missing"""
+    def step(conn):
+        model.__table__.create(conn, checkfirst=True)
+    step.description = f"create table {model.__tablename__}"
+    return step
+
+def add_column(model, name):
+    """Step that adds one of a model's declared columns if missing"""
+    table = model.__table__
+    column = table.c[name]
+
+    def step(conn):
+        existing = {c['name'] for c in inspect(conn).get_columns(table.name)}
+        if name in existing:
+            return
+        ddl = (f"ALTER TABLE {table.name} ADD COLUMN {name} "
+               f"{column.type.compile(dialect=conn.dialect)}"
+               f"{'' if column.nullable else ' NOT NULL'}")
+        if column.server_default is not None:
+            ddl += f" DEFAULT {column.server_default.arg}"
+        if conn.dialect.name == 'mysql':
+            ddl += ", ALGORITHM=INPLACE, LOCK=NONE"
+        conn.exec_driver_sql(ddl)
+    step.description = f"add column {name} to {table.name}"
+    return step
+
+def add_index(model, name):
+    """Step that adds one of a model's declared indexes if missing"""
+    table = model.__table__
+    index = next(i for i in table.indexes if i.name == name)
+
+    def step(conn):
+        existing = {i['name'] for i in inspect(conn).get_indexes(table.name)}
+        if name in existing:
+            return
+        if conn.dialect.name == 'mysql':
+            columns = ', '.join(c.name for c in index.columns)
+            kind = 'UNIQUE INDEX' if index.unique else 'INDEX'
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table.name} ADD {kind} {name} ({columns}), "
+                f"ALGORITHM=INPLACE, LOCK=NONE"
+            )
+        else:
+            index.create(conn)
+    step.description = f"add index {name} on {table.name}"
+    return step
+
+def execute(sql, description):
+    """Step that runs a data fix-up statement"""
+    def step(conn):
+        conn.exec_driver_sql(sql)
+    step.description = description
+    return step
+
+def merge_duplicate_books(conn):
+    """
+    Fold books sharing a title and author into the lowest id
+
+    Copies are summed and loans and holds are repointed, so the unique
+    (title, author) index can be added.
+    """
+    books = Book.__table__
+    dupes = conn.execute(
+        select(books.c.title, books.c.author, func.min(books.c.id))
+        .group_by(books.c.title, books.c.author)
+        .having(func.count() > 1)
+    ).all()
+    for title, author, keep_id in dupes:
+        ids = conn.execute(select(books.c.id).where(
+            books.c.title == title, books.c.author == author, books.c.id != keep_id
+        )).scalars().all()
+        total, available = conn.execute(
+            select(func.sum(books.c.copies_total), func.sum(books.c.copies_available))
+            .where(books.c.id.in_(ids))
+        ).one()
+        for table in (BorrowedBook.__table__, BookHold.__table__):
+            conn.execute(update(table).where(table.c.book_id.in_(ids)).values(book_id=keep_id))
+        conn.execute(
+            update(books).where(books.c.id == keep_id).ordered_values(
+                (books.c.availability, books.c.copies_available + available > 0),
+                (books.c.copies_available, books.c.copies_available + available),
+                (books.c.copies_total, books.c.copies_total + total),
+            )
+        )
+        conn.execute(delete(books).where(books.c.id.in_(ids)))
+    if dupes:
+        logger.info(f"Merged {len(dupes)} duplicated catalog titles")
+merge_duplicate_books.description = "merge books with the same title and author"
+
+
+MIGRATIONS = [
+    (1, 'email outbox', [
+        create_table(EmailOutbox),
+    ]),
+    (2, 'due-date reminders', [
+        add_index(UserBook, 'ix_user_books_active_user_due'),
+        create_table(BookReminder),
+    ]),
+    (3, 'hot query indexes', [
+        add_index(UserBook, 'ix_user_books_user_borrow_date'),
+        add_index(ForumPost, 'ix_forum_posts_date_posted_id'),
+        add_index(ForumComment, 'ix_forum_comments_post_date_posted'),
+    ]),
+    (4, 'forum image renditions', [
+        add_column(ForumPost, 'photo_status'),
+    ]),
+    (5, 'content-addressed uploads', [
+        create_table(StoredUpload),
+    ]),
+    (6, 'catalog circulation', [
+        add_column(Book, 'copies_total'),
+        add_column(Book, 'copies_available'),
+        # Titles marked unavailable had their single copy out
+        execute("UPDATE books SET copies_available = 0 WHERE availability = 0",
+                "sync copies_available with availability"),
+        # cp_dbms.sql always created borrowed_books; create_all used the
+        # model's old name, borrowedbooks, which no code ever read
+        create_table(BorrowedBook),
+        add_column(BorrowedBook, 'return_date'),
+        add_index(BorrowedBook, 'ix_borrowed_books_user_return'),
+        create_table(BookHold),
+    ]),
+    (7, 'catalog natural key', [
+        merge_duplicate_books,
+        add_index(Book, 'uq_books_title_author'),
+    ]),
+    (8, 'cache version stamps', [
+        create_table(DataVersion),
+    ]),
+    (9, 'reading analytics rollups', [
+        create_table(ReadingRollup),
+        create_table(AuthorRollup),
+        analytics.rebuild,
+    ]),
+    (10, 'forum comment counts', [
+        add_column(ForumPost, 'comment_count'),
+        execute("UPDATE forum_posts SET comment_count = (SELECT COUNT(*) FROM forum_comments "
+                "WHERE forum_comments.post_id = forum_posts.id)",
+                "count existing comments per post"),
+    ]),
+]
+
+
+def applied_versions():
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    return {row.version for row in SchemaMigration.query.all()}
+
+def pending_migrations():
+    applied = applied_versions()
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+def upgrade():
+    """Apply every pending migration in order; returns the versions applied"""
+    done = []
+    for version, name, steps in pending_migrations():
+        logger.info(f"Applying migration {version}: {name}")
+        with db.engine.begin() as conn:
+            for step in steps:
+                step(conn)
+        db.session.add(SchemaMigration(version=version, name=name, applied_at=datetime.utcnow()))
+        db.session.commit()
+        done.append(version)
+    return done
+
+
+# EXPLAIN reporting for the hot route queries
+def hot_queries():
+    """Representative statements issued by the busiest routes"""
+    # Imported here: reminders pulls in the email service and outbox
+    from reminders import due_books_query
+    today = date.today()
+    return {
+        'borrowed_books': select(UserBook)
+            .where(UserBook.user_id == 1)
+            .order_by(UserBook.borrow_date.desc()),
+        'index (active borrowers)': select(func.count(UserBook.user_id.distinct()))
+            .where(UserBook.is_returned == False),
+        'forum (posts)': select(ForumPost)
+            .order_by(ForumPost.date_posted.desc(), ForumPost.id.desc())
+            .limit(21),
+        'forum (latest comments)': select(ForumComment.id)
+            .where(ForumComment.post_id == 1)
+            .order_by(ForumComment.date_posted.desc(), ForumComment.id.desc())
+            .limit(3),
+        'send-reminders': due_books_query(today, today).limit(1000).statement,
+    }
+
+def explain(conn, statement):
+    """Return (columns, rows) of the database's plan for a statement"""
+    compiled = statement.compile(
+        dialect=conn.dialect, compile_kwargs={'render_postcompile': True}
+    )
+    if compiled.positional:
+        params = tuple(compiled.params[key] for key in compiled.positiontup)
+    else:
+        params = compiled.params
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+    result = conn.exec_driver_sql(prefix + str(compiled), params)
+    return list(result.keys()), [tuple(row) for row in result]
+
+def explain_report():
+    """Render EXPLAIN output for every hot query as plain text"""
+    lines = []
+    with db.engine.connect() as conn:
+        for name, statement in hot_queries().items():
+            lines.append(f"== {name}")
+            try:
+                columns, rows = explain(conn, statement)
+            except DatabaseError as e:
+                # e.g. the query's table is created by a pending migration
+                conn.rollback()
+                lines.extend([f"(unavailable: {e.orig})", ''])
+                continue
+            lines.append(' | '.join(columns))
+            lines.extend(' | '.join(str(value) for value in row) for row in rows)
+            lines.append('')
+    return '\n'.join(lines)
@@ -21,16 +21,54 @@ class Book(db.Model):
     title = db.Column(db.String(255), nullable=False)
     author = db.Column(db.String(255), nullable=False)
     availability = db.Column(db.Boolean, nullable=False)
+    # Circulation counters; only changed through circulation.py, which
+    # keeps availability equal to copies_available > 0
+    copies_total = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    copies_available = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     
     borrowed_books = db.relationship('BorrowedBook', backref='book', lazy=True)
 
+    __table_args__ = (
+        # Natural key used to dedupe bulk imports
+        db.Index('uq_books_title_author', 'title', 'author', unique=True),
+    )
+
 class BorrowedBook(db.Model):
-    __tablename__ = 'borrowedbooks'
+    """A loan of one catalog copy; open until return_date is set"""
+    __tablename__ = 'borrowed_books'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), nullable=False)
     borrow_date = db.Column(db.Date, nullable=False)
     due_date = db.Column(db.Date, nullable=False)
+    return_date = db.Column(db.Date, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_borrowed_books_user_return', 'user_id', 'return_date'),
+    )
+
+class BookHold(db.Model):
+    """
+    A place on a title's waitlist
+
+    Holds wait in created_at order. A returned copy goes to the oldest
+    waiting hold, which becomes 'ready' and keeps the copy until
+    ready_until; it then ends 'fulfilled', 'cancelled' or 'expired'.
+    """
+    __tablename__ = 'book_holds'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='waiting')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    ready_until = db.Column(db.DateTime, nullable=True)
+
+    book = db.relationship('Book')
+
+    __table_args__ = (
+        db.Index('ix_book_holds_book_status_created', 'book_id', 'status', 'created_at'),
+        db.Index('ix_book_holds_user_status', 'user_id', 'status'),
+    )
 
 class Review(db.Model):
     __tablename__ = 'reviews'
@@ -49,8 +87,19 @@ class ForumPost(db.Model):
     content = db.Column(db.Text, nullable=False)
     date_posted = db.Column(db.DateTime, default=datetime.utcnow)
     photo_filename = db.Column(db.String(255), nullable=True)
+    # None for legacy single-file photos, else pending/ready/failed
+    photo_status = db.Column(db.String(10), nullable=True)
+    # Kept in step by add_comment and delete_comment
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
-    comments = db.relationship('ForumComment', backref='post', lazy=True, cascade="all, delete-orphan")
+    # delete_post removes comments with one DELETE, so the collection is
+    # never loaded just to cascade
+    comments = db.relationship('ForumComment', backref='post', lazy=True,
+                               cascade="all, delete-orphan", passive_deletes=True)
+
+    __table_args__ = (
+        db.Index('ix_forum_posts_date_posted_id', 'date_posted', 'id'),
+    )
 
 class ForumComment(db.Model):
     __tablename__ = 'forum_comments'
@@ -60,6 +109,10 @@ class ForumComment(db.Model):
     content = db.Column(db.Text, nullable=False)
     date_posted = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_forum_comments_post_date_posted', 'post_id', 'date_posted'),
+    )
+
 class UserBook(db.Model):
     __tablename__ = 'user_books'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -71,3 +124,91 @@ class UserBook(db.Model):
     return_date = db.Column(db.Date, nullable=True)
     is_returned = db.Column(db.Boolean, default=False)
     notes = db.Column(db.Text, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_user_books_active_user_due', 'is_returned', 'user_id', 'due_date'),
+        db.Index('ix_user_books_user_borrow_date', 'user_id', 'borrow_date'),
+    )
+
+class EmailOutbox(db.Model):
+    __tablename__ = 'email_outbox'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+class BookReminder(db.Model):
+    __tablename__ = 'book_reminders'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_book_id = db.Column(db.Integer, db.ForeignKey('user_books.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    sent_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_book_id', 'kind', name='uq_book_reminders_book_kind'),
+    )
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(255), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class StoredUpload(db.Model):
+    __tablename__ = 'stored_uploads'
+    digest = db.Column(db.String(64), primary_key=True)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    size_bytes = db.Column(db.Integer, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class DataVersion(db.Model):
+    """
+    Version stamp for a slice of data behind a cached page or fragment
+
+    Keys are e.g. 'forum', 'post:<id>' or 'user_books:<user id>'; writers
+    bump them in the same transaction as the change, see http_cache.py.
+    """
+    __tablename__ = 'data_versions'
+    key = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+class ReadingRollup(db.Model):
+    """
+    Precomputed borrow counters for the analytics dashboard
+
+    One row per reader (user_id 0 for the whole library) and period,
+    either 'YYYY-MM' or 'all'; maintained by analytics.py.
+    """
+    __tablename__ = 'reading_rollups'
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    period = db.Column(db.String(7), primary_key=True)
+    borrowed = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    returned = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    returned_on_time = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Sum of (return_date - borrow_date) over the period's returns
+    loan_days = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class AuthorRollup(db.Model):
+    """Borrows per reader (0 for the whole library) and author"""
+    __tablename__ = 'reading_author_rollups'
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    author = db.Column(db.String(255), primary_key=True)
+    borrowed = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        db.Index('ix_reading_author_rollups_user_borrowed', 'user_id', 'borrowed'),
+    )
@@ -0,0 +1,221 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, or_
+
+from extensions import db, mail
+from models import EmailOutbox
+from metrics import observe_email
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(recipients, subject, html, commit=True):
+    """
+    Queue an email for delivery by the outbox workers
+
+    Args:
+        recipients: List of email addresses, one outbox row per address
+        subject: Email subject line
+        html: Rendered HTML body
+        commit: Pass False to add the rows to a caller-managed transaction
+    """
+    for recipient in recipients:
+        db.session.add(EmailOutbox(recipient=recipient, subject=subject, html=html))
+    if commit:
+        db.session.commit()
+        worker_pool.notify(current_app._get_current_object())
+
+
+def claim_batch(batch_size, lease_seconds):
+    """
+    Lock up to batch_size due rows and mark them as being sent
+
+    Rows stuck in 'sending' longer than the lease belong to a worker that
+    died mid-batch and are claimed again, so a restart loses nothing.
+    """
+    now = datetime.utcnow()
+    rows = EmailOutbox.query.filter(or_(
+        and_(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now),
+        and_(EmailOutbox.status == 'sending',
+             EmailOutbox.locked_at < now - timedelta(seconds=lease_seconds))
+    )).order_by(EmailOutbox.next_attempt_at).limit(batch_size) \
+        .with_for_update(skip_locked=True).all()
+
+    for row in rows:
+        row.status = 'sending'
+        row.locked_at = now
+    db.session.commit()
+    return rows
+
+
+def schedule_retry(row, error):
+    """Record a failed attempt and back off exponentially"""
+    config = current_app.config
+    row.attempts += 1
+    row.last_error = str(error)
+    row.locked_at = None
+    if row.attempts >= config['OUTBOX_MAX_ATTEMPTS']:
+        row.status = 'failed'
+        logger.error(f"Giving up on email {row.id} to {row.recipient}: {error}")
+    else:
+        delay = min(config['OUTBOX_RETRY_BASE'] * 2 ** (row.attempts - 1),
+                    config['OUTBOX_RETRY_MAX'])
+        row.status = 'pending'
+        row.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+
+
+def send_batch(rows):
+    """Deliver claimed rows over a single SMTP connection"""
+    from flask_mail import Message
+
+    try:
+        with mail.connect() as connection:
+            for row in rows:
+                started = time.perf_counter()
+                try:
+                    connection.send(Message(
+                        row.subject,
+                        sender=current_app.config['MAIL_DEFAULT_SENDER'],
+                        recipients=[row.recipient],
+                        html=row.html
+                    ))
+                    row.status = 'sent'
+                    row.sent_at = datetime.utcnow()
+                    row.locked_at = None
+                    observe_email(time.perf_counter() - started, True)
+                except Exception as e:
+                    observe_email(time.perf_counter() - started, False)
+                    schedule_retry(row, e)
+    except Exception as e:
+        # Connecting or closing failed; retry whatever was not sent
+        logger.error(f"SMTP connection failed: {str(e)}")
+        for row in rows:
+            if row.status == 'sending':
+                schedule_retry(row, e)
+    db.session.commit()
+
+
+def process_batch(batch_size=None):
+    """Claim and send one batch; returns the number of rows handled"""
+    config = current_app.config
+    rows = claim_batch(batch_size or config['OUTBOX_BATCH_SIZE'], config['OUTBOX_LEASE_SECONDS'])
+    if rows:
+        send_batch(rows)
+    return len(rows)
+
+
+def drain():
+    """Send batches until nothing is due; returns the number of rows handled"""
+    total = 0
+    while True:
+        handled = process_batch()
+        if not handled:
+            return total
+        total += handled
+
+
+def send_inline(batch_size):
+    """
+    Send one small batch from the caller's thread, after its commit
+
+    For hosts that freeze background threads once the response is out
+    (EMAIL_WORKERS=0 on serverless): new mail goes out with the request
+    that queued it, and `flask drain-outbox` run on a schedule picks up
+    retries. Errors are logged, never raised into the request.
+    """
+    try:
+        return process_batch(batch_size)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Inline outbox send failed: {str(e)}")
+        return 0
+
+
+class OutboxWorkerPool:
+    """
+    Background threads that drain the email outbox
+
+    Threads are started by each process's first request or enqueue (and
+    again after a fork), so mail left pending by a restart goes out
+    without waiting for new mail. They wake up immediately when mail is
+    queued and otherwise poll every OUTBOX_POLL_INTERVAL seconds for
+    retries.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._pid = None
+
+    def start(self, app, size=None):
+        with self._lock:
+            if self._pid == os.getpid() and any(t.is_alive() for t in self._threads):
+                return
+            size = app.config['EMAIL_WORKERS'] if size is None else size
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._threads = [
+                threading.Thread(target=self._run, args=(app,),
+                                 name=f'outbox-worker-{i}', daemon=True)
+                for i in range(size)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def ensure_started(self, app):
+        """Start this process's workers unless it already has; cheap enough per request"""
+        if self._pid != os.getpid() and app.config['EMAIL_WORKERS'] > 0:
+            self.start(app)
+
+    def notify(self, app):
+        if app.config['EMAIL_WORKERS'] > 0:
+            self.start(app)
+            self._wakeup.set()
+        elif app.config['OUTBOX_INLINE_BATCH'] > 0:
+            send_inline(app.config['OUTBOX_INLINE_BATCH'])
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self, app):
+        while not self._stopping.is_set():
+            handled = 0
+            with app.app_context():
+                try:
+                    handled = drain()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Outbox worker error: {str(e)}")
+            if not handled:
+                self._wakeup.wait(app.config['OUTBOX_POLL_INTERVAL'])
+                self._wakeup.clear()
+
+
+worker_pool = OutboxWorkerPool()
+
+
+def init_app(app):
+    app.config.setdefault('EMAIL_WORKERS', 1)
+    app.config.setdefault('OUTBOX_BATCH_SIZE', 50)
+    app.config.setdefault('OUTBOX_MAX_ATTEMPTS', 5)
+    app.config.setdefault('OUTBOX_RETRY_BASE', 30)
+    app.config.setdefault('OUTBOX_RETRY_MAX', 3600)
+    app.config.setdefault('OUTBOX_LEASE_SECONDS', 300)
+    app.config.setdefault('OUTBOX_POLL_INTERVAL', 5)
+    app.config.setdefault('OUTBOX_INLINE_BATCH', 0)
+
+    # Not started here: a preforking server builds the app in its master,
+    # and threads do not survive the fork
+    @app.before_request
+    def start_outbox_workers():
+        worker_pool.ensure_started(app)
@@ -0,0 +1,355 @@
+"""
+Password hashing off the request thread
+
+Hashing and verification run in a small process pool, so a burst of
+logins costs pool CPU instead of every web worker, and the request
+thread only waits on a future. Admission is bounded: once
+PASSWORD_HASH_QUEUE hashes are in flight, further attempts are turned
+away with HashingBusy straight away rather than piling up.
+
+New hashes use PASSWORD_HASH_METHOD (scrypt by default). A successful
+login whose stored hash used other parameters gets rehashed in the same
+pool job, so cost upgrades roll out as users sign in.
+
+Login and registration attempts are counted per IP and per username
+in sliding windows and refused before any hashing starts. Failed logins
+are also counted per username alone, whatever the address, and past a
+free allowance each further attempt at that account waits a doubling
+delay capped at LOGIN_BACKOFF_MAX seconds: guessing spread over many
+addresses slows to a crawl, while the owner is never locked out for
+longer than the cap.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import (
+    generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+)
+
+# Method name -> werkzeug's defaults for omitted parameters
+METHOD_DEFAULTS = {
+    'scrypt': ['32768', '8', '1'],
+    'pbkdf2': ['sha256', str(DEFAULT_PBKDF2_ITERATIONS)],
+}
+
+
+class HashingBusy(Exception):
+    """Every hashing slot is taken; the client should retry shortly"""
+
+
+def normalize_method(method):
+    """Spell out default parameters, e.g. 'scrypt' -> 'scrypt:32768:8:1'"""
+    name, *params = method.split(':')
+    defaults = METHOD_DEFAULTS.get(name)
+    if defaults is None:
+        return method
+    return ':'.join([name] + params + defaults[len(params):])
+
+
+def hash_job(password, method):
+    return generate_password_hash(password, method)
+
+
+def verify_job(stored, password, method):
+    """
+    Check a password and rehash it if the stored parameters are outdated;
+    runs in a pool process
+
+    Returns:
+        Tuple of (matches, new hash or None)
+    """
+    if not check_password_hash(stored, password):
+        return False, None
+    if normalize_method(stored.split('$', 1)[0]) != method:
+        return True, generate_password_hash(password, method)
+    return True, None
+
+
+class PasswordHasher:
+    """
+    Bounded pool for password hashing
+
+    With PASSWORD_HASH_WORKERS = 0 (e.g. on serverless hosts) hashes run
+    inline, still limited to PASSWORD_HASH_QUEUE at a time. A pool broken
+    by a dead worker is replaced; the job that hit it gets HashingBusy.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._slots = threading.BoundedSemaphore(8)
+        self._dummy = None
+        self.method = normalize_method('scrypt')
+        self.workers = 0
+        self.timeout = 10
+        self.in_flight = 0
+        self.rejected = 0
+
+    def configure(self, method, workers, queue_size, timeout):
+        self.method = normalize_method(method)
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._dummy = None
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _drop_executor(self, executor):
+        """Forget a pool whose worker died, so the next job starts a fresh one"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, fn, *args):
+        """Submit a job, replacing the pool once if a worker has died"""
+        for _ in range(2):
+            executor = None
+            try:
+                executor = self.executor()
+                return executor, executor.submit(fn, *args)
+            except (BrokenProcessPool, OSError):
+                # OSError: the pool or a replacement worker could not be started
+                if executor is not None:
+                    self._drop_executor(executor)
+        raise HashingBusy()
+
+    def _release(self, *_):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def run(self, fn, *args):
+        """Run a hashing job, or raise HashingBusy if no slot is free"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashingBusy()
+        with self._lock:
+            self.in_flight += 1
+        if self.workers == 0:
+            try:
+                return fn(*args)
+            finally:
+                self._release()
+        try:
+            executor, future = self._submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # The slot is held until the job finishes, even if we stop waiting
+        future.add_done_callback(self._release)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise HashingBusy()
+        except BrokenProcessPool:
+            # The worker was killed mid-job (e.g. out of memory)
+            self._drop_executor(executor)
+            raise HashingBusy()
+
+    def hash(self, password):
+        return self.run(hash_job, password, self.method)
+
+    def verify(self, stored, password):
+        """
+        Check a password against a stored hash
+
+        Pass stored=None for an unknown user: a throwaway hash is checked
+        instead, so the response takes as long as for a real account.
+
+        Returns:
+            Tuple of (matches, new hash to store or None)
+        """
+        if stored is None:
+            if self._dummy is None:
+                self._dummy = self.hash(os.urandom(16).hex())
+            self.run(verify_job, self._dummy, password, self.method)
+            return False, None
+        return self.run(verify_job, stored, password, self.method)
+
+    def counters(self):
+        with self._lock:
+            return {'in_flight': self.in_flight, 'rejected': self.rejected}
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+class RateLimiter:
+    """Sliding-window attempt counter per key, bounded in memory"""
+
+    def __init__(self, limit, window, max_keys=10000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._attempts = OrderedDict()
+        self.refused = 0
+
+    def hit(self, key, now=None):
+        """
+        Record an attempt
+
+        Returns:
+            0 if allowed, otherwise seconds until the next attempt would be
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if attempts is None:
+                attempts = self._attempts[key] = deque()
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            self._attempts.move_to_end(key)
+            if len(attempts) >= self.limit:
+                self.refused += 1
+                return max(1, int(attempts[0] + self.window - now) + 1)
+            attempts.append(now)
+            while len(self._attempts) > self.max_keys:
+                self._attempts.popitem(last=False)
+            return 0
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._attempts.clear()
+
+
+class FailureBackoff:
+    """
+    Per-key delay that doubles with every recent failure
+
+    The first `free` failures cost nothing; after that the next attempt
+    must wait base * 2 ** (failures - free - 1) seconds after the latest
+    failure, capped at max_delay. A key's failures are forgotten once it
+    has gone `window` seconds without one. Bounded in memory.
+    """
+
+    def __init__(self, free, base, max_delay, window, max_keys=10000):
+        self.free = free
+        self.base = base
+        self.max_delay = max_delay
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._failures = OrderedDict()
+        self.refused = 0
+
+    def _entry(self, key, now):
+        entry = self._failures.get(key)
+        if entry is not None and entry[1] <= now - self.window:
+            del self._failures[key]
+            return None
+        return entry
+
+    def check(self, key, now=None):
+        """
+        Returns:
+            0 if an attempt is allowed now, otherwise seconds to wait
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entry(key, now)
+            if entry is None or entry[0] <= self.free:
+                return 0
+            count, last = entry
+            delay = min(self.base * 2 ** (count - self.free - 1), self.max_delay)
+            if now - last >= delay:
+                return 0
+            self.refused += 1
+            return max(1, int(last + delay - now) + 1)
+
+    def failed(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entry(key, now)
+            self._failures[key] = ((entry[0] if entry else 0) + 1, now)
+            self._failures.move_to_end(key)
+            while len(self._failures) > self.max_keys:
+                self._failures.popitem(last=False)
+
+    def reset(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._failures.clear()
+
+
+hasher = PasswordHasher()
+login_ip_limiter = RateLimiter(20, 300)
+login_username_limiter = RateLimiter(5, 300)
+register_ip_limiter = RateLimiter(5, 3600)
+login_account_backoff = FailureBackoff(10, 1, 60, 900)
+
+
+def throttle_login(ip, username):
+    """
+    Seconds the client must wait before trying to log in, or 0
+
+    The per-username limit is counted per address too, so guessing at one
+    account from one client is slowed without letting anyone else lock
+    its owner out. Guesses at one account from many addresses run into
+    the account's failure backoff instead, which only ever delays.
+    """
+    name = username.strip().lower()
+    return (login_account_backoff.check(name)
+            or login_ip_limiter.hit(ip)
+            or login_username_limiter.hit((ip, name)))
+
+
+def login_failed(username):
+    login_account_backoff.failed(username.strip().lower())
+
+
+def login_succeeded(ip, username):
+    name = username.strip().lower()
+    login_username_limiter.reset((ip, name))
+    login_account_backoff.reset(name)
+
+
+def throttle_register(ip):
+    return register_ip_limiter.hit(ip)
+
+
+def init_app(app):
+    app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt')
+    app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+    app.config.setdefault('PASSWORD_HASH_QUEUE', 8)
+    app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+    app.config.setdefault('LOGIN_RATE_WINDOW', 300)
+    app.config.setdefault('LOGIN_ATTEMPTS_PER_IP', 20)
+    app.config.setdefault('LOGIN_ATTEMPTS_PER_USERNAME', 5)
+    app.config.setdefault('LOGIN_BACKOFF_FREE_FAILURES', 10)
+    app.config.setdefault('LOGIN_BACKOFF_BASE', 1)
+    app.config.setdefault('LOGIN_BACKOFF_MAX', 60)
+    app.config.setdefault('LOGIN_BACKOFF_WINDOW', 900)
+    app.config.setdefault('REGISTRATIONS_PER_IP_PER_HOUR', 5)
+    hasher.configure(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+                     app.config['PASSWORD_HASH_QUEUE'], app.config['PASSWORD_HASH_TIMEOUT'])
+    login_ip_limiter.limit = app.config['LOGIN_ATTEMPTS_PER_IP']
+    login_username_limiter.limit = app.config['LOGIN_ATTEMPTS_PER_USERNAME']
+    login_ip_limiter.window = login_username_limiter.window = app.config['LOGIN_RATE_WINDOW']
+    register_ip_limiter.limit = app.config['REGISTRATIONS_PER_IP_PER_HOUR']
+    login_account_backoff.free = app.config['LOGIN_BACKOFF_FREE_FAILURES']
+    login_account_backoff.base = app.config['LOGIN_BACKOFF_BASE']
+    login_account_backoff.max_delay = app.config['LOGIN_BACKOFF_MAX']
+    login_account_backoff.window = app.config['LOGIN_BACKOFF_WINDOW']
@@ -0,0 +1,75 @@
+import time
+
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Statements kept per context for the slow-request log
+MAX_RECORDED_STATEMENTS = 100
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    """Count and time every statement executed while an app context is active"""
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if has_app_context():
+        g.query_count = g.get('query_count', 0) + 1
+        g.query_time = g.get('query_time', 0.0) + elapsed
+        statements = g.get('query_statements')
+        if statements is not None and len(statements) < MAX_RECORDED_STATEMENTS:
+            statements.append((elapsed, statement))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _discard_failed_query(context):
+    conn = context.connection
+    if conn is not None and conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+
+
+def get_query_count():
+    """Return the number of SQL statements run in the current context"""
+    return g.get('query_count', 0) if has_app_context() else 0
+
+
+def get_query_time():
+    """Return the seconds spent executing SQL in the current context"""
+    return g.get('query_time', 0.0) if has_app_context() else 0.0
+
+
+def record_statements():
+    """Keep (seconds, statement) pairs for the rest of the current context"""
+    if has_app_context():
+        g.query_statements = []
+
+
+def get_statements():
+    return (g.get('query_statements') or []) if has_app_context() else []
+
+
+def reset_query_count():
+    """Reset the counters, e.g. between two measured calls in one context"""
+    if has_app_context():
+        g.query_count = 0
+        g.query_time = 0.0
+
+
+def init_app(app):
+    """
+    Expose the per-request query count
+
+    When QUERY_COUNT_HEADER is enabled every response carries an
+    X-Query-Count header, so tests and load runs can assert on it.
+    """
+    app.config.setdefault('QUERY_COUNT_HEADER', False)
+
+    @app.after_request
+    def add_query_count_header(response):
+        if app.config['QUERY_COUNT_HEADER']:
+            response.headers['X-Query-Count'] = str(get_query_count())
+        return response
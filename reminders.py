@@ -0,0 +1,165 @@
+import logging
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import case, exists, insert, tuple_
+
+from extensions import db
+from models import User, UserBook, BookReminder
+from email_service import register_template, send_templated_email
+from outbox import worker_pool
+
+logger = logging.getLogger(__name__)
+
+DUE_DIGEST_EMAIL_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <style>
+        body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; }
+        .header { background: #f8f9fa; padding: 20px; text-align: center; }
+        .content { padding: 20px; }
+        .footer { background: #f8f9fa; padding: 20px; text-align: center; }
+        .book-details { background: #f1f1f1; padding: 15px; border-radius: 5px; margin-bottom: 15px; }
+        .overdue { color: #dc3545; }
+    </style>
+</head>
+<body>
+    <div class="header">
+        <h1>Borrowed Book Reminder</h1>
+    </div>
+    <div class="content">
+        <h2>Hello {{username}},</h2>
+        {% if overdue %}
+        <div class="book-details">
+            <h3 class="overdue">Overdue</h3>
+            <ul>
+            {% for book in overdue %}
+                <li><strong>{{book.book_title}}</strong> by {{book.author}}, due {{book.due_date}}</li>
+            {% endfor %}
+            </ul>
+        </div>
+        {% endif %}
+        {% if due_soon %}
+        <div class="book-details">
+            <h3>Due Soon</h3>
+            <ul>
+            {% for book in due_soon %}
+                <li><strong>{{book.book_title}}</strong> by {{book.author}}, due {{book.due_date}}</li>
+            {% endfor %}
+            </ul>
+        </div>
+        {% endif %}
+    </div>
+    <div class="footer">
+        <p>Best regards,<br>Your Library Team</p>
+    </div>
+</body>
+</html>
+"""
+register_template(
+    'due_digest',
+    '{% if overdue %}{{overdue|length}} overdue{% if due_soon %}, {% endif %}{% endif %}'
+    '{% if due_soon %}{{due_soon|length}} due soon{% endif %} - Library Reminder',
+    DUE_DIGEST_EMAIL_TEMPLATE
+)
+
+
+def due_books_query(today, horizon):
+    """
+    Unreturned books due on or before horizon that have not been notified
+
+    A book due before today needs an 'overdue' reminder, otherwise a
+    'due_soon' one; each kind is sent at most once per book. The filter
+    and the (user_id, due_date, id) ordering are both served by the
+    ix_user_books_active_user_due index.
+    """
+    kind = case((UserBook.due_date < today, 'overdue'), else_='due_soon')
+    already_sent = exists().where(
+        BookReminder.user_book_id == UserBook.id,
+        BookReminder.kind == kind
+    )
+    return db.session.query(
+        UserBook.id, UserBook.user_id, UserBook.book_title,
+        UserBook.author, UserBook.due_date, kind.label('kind'),
+        User.username, User.email
+    ).join(User, User.id == UserBook.user_id).filter(
+        UserBook.is_returned == False,
+        UserBook.due_date <= horizon,
+        ~already_sent
+    ).order_by(UserBook.user_id, UserBook.due_date, UserBook.id)
+
+
+def iter_due_books(today, horizon, batch_size):
+    """Stream due_books_query in keyset batches instead of loading it all"""
+    last = None
+    while True:
+        query = due_books_query(today, horizon)
+        if last is not None:
+            query = query.filter(
+                tuple_(UserBook.user_id, UserBook.due_date, UserBook.id) > last
+            )
+        rows = query.limit(batch_size).all()
+        if not rows:
+            return
+        yield rows
+        tail = rows[-1]
+        last = (tail.user_id, tail.due_date, tail.id)
+
+
+def queue_digest(rows):
+    """Queue one digest email for a user's rows and record the reminders"""
+    first = rows[0]
+    books = [
+        dict(book_title=row.book_title, author=row.author,
+             due_date=row.due_date.strftime('%Y-%m-%d'))
+        for row in rows
+    ]
+    send_templated_email(
+        'due_digest', [first.email], commit=False,
+        username=first.username,
+        overdue=[book for book, row in zip(books, rows) if row.kind == 'overdue'],
+        due_soon=[book for book, row in zip(books, rows) if row.kind == 'due_soon']
+    )
+    now = datetime.utcnow()
+    db.session.execute(insert(BookReminder), [
+        dict(user_book_id=row.id, kind=row.kind, sent_at=now) for row in rows
+    ])
+
+
+def send_due_reminders(days=3, batch_size=1000, today=None):
+    """
+    Queue one digest per user for books due within `days` or overdue
+
+    Every digest and its reminder records are committed together, so a
+    rerun (or a crash halfway through) never notifies a book twice.
+
+    Returns:
+        Tuple of (users notified, books included)
+    """
+    today = today or datetime.utcnow().date()
+    horizon = today + timedelta(days=days)
+    users = books = 0
+    group = []
+
+    for rows in iter_due_books(today, horizon, batch_size):
+        for row in rows:
+            if group and group[0].user_id != row.user_id:
+                queue_digest(group)
+                users += 1
+                books += len(group)
+                group = []
+            group.append(row)
+        # The last user's rows may continue in the next batch
+        db.session.commit()
+
+    if group:
+        queue_digest(group)
+        users += 1
+        books += len(group)
+        db.session.commit()
+
+    if users:
+        worker_pool.notify(current_app._get_current_object())
+    logger.info(f"Queued reminders for {books} books to {users} users")
+    return users, books
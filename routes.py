@@ -1,51 +1,190 @@
 import logging
-import os
-import uuid
 from datetime import datetime
-from PIL import Image
+from functools import wraps
 from flask import (
     render_template, redirect, url_for, flash, 
-    request, current_app
+    request, current_app, abort, jsonify
 )
+from markupsafe import Markup
 from flask_login import (
     login_user, logout_user, login_required, 
     current_user
 )
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from sqlalchemy import and_, or_, select, union_all, update
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
 from app import app
 from extensions import db
 from models import (
     User, Book, BorrowedBook, ForumPost, 
-    ForumComment, UserBook
+    ForumComment, UserBook, BookHold
 )
 from email_service import (
     send_welcome_email, send_borrowed_book_notification
 )
+from stats import stats
+from image_pipeline import pipeline, photo_status_for
+import search_index
+from search_index import (
+    index_documents, remove_documents, post_doc, comment_doc, user_book_doc
+)
+from upload_storage import (
+    UploadRejected, stage_upload, acquire, release, remove_orphaned, remove_legacy_file
+)
+from circulation import (
+    CirculationError, ACTIVE_HOLD_STATUSES, checkout, return_loan, place_hold, cancel_hold,
+    notify_mail_workers
+)
+import user_book_batches
+from user_book_batches import BatchRejected, book_json
+import passwords
+import analytics
+from live import publish
+from passwords import HashingBusy
+from http_cache import (
+    FORUM_KEY, post_key, user_books_key, bump, versions, conditional_response, fragments
+)
 
 # Configuration
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
 
-UPLOAD_FOLDER = 'static/forum_uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
 
 # Helper Functions
 def allowed_file(filename):
     """Check if the file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_image(file, max_size=(800, 600), quality=85):
-    """Process and optimize uploaded images"""
-    img = Image.open(file)
-    img.thumbnail(max_size, Image.LANCZOS)
-    
-    filename = f"{uuid.uuid4()}.jpg"
-    filepath = os.path.join(current_app.root_path, UPLOAD_FOLDER, filename)
-    
-    img.save(filepath, optimize=True, quality=quality)
-    return filename
+def wants_json():
+    """True for fetch callers that asked for JSON instead of a page"""
+    return request.accept_mimetypes.best == 'application/json'
+
+def write_response(message, category, status=200, **payload):
+    """
+    Finish a forum write: JSON for fetch callers, otherwise flash the
+    message and go back to the forum
+    """
+    if wants_json():
+        if status >= 400:
+            return jsonify(error=message), status
+        return jsonify(message=message, **payload), status
+    flash(message, category)
+    return redirect(url_for('forum'))
+
+def comment_json(comment, username):
+    return {
+        'id': comment.id,
+        'post_id': comment.post_id,
+        'user_id': comment.user_id,
+        'username': username,
+        'content': comment.content,
+        'date_posted': comment.date_posted.strftime('%Y-%m-%d %H:%M'),
+    }
+
+def encode_cursor(row):
+    """Build a keyset cursor from a post's or comment's (date_posted, id)"""
+    return f"{row.date_posted.strftime(CURSOR_DATE_FORMAT)}-{row.id}"
+
+def decode_cursor(cursor):
+    """Parse a keyset cursor back into (date_posted, id)"""
+    date_part, _, id_part = cursor.rpartition('-')
+    return datetime.strptime(date_part, CURSOR_DATE_FORMAT), int(id_part)
+
+def forum_page(cursor=None, page_size=20):
+    """
+    Load one page of the forum feed's posts
+
+    Authors and comments are only needed for cards missing from the
+    fragment cache; post_cards loads them for those posts alone.
+
+    Returns:
+        Tuple of (posts, next_cursor); next_cursor is None on the last page
+    """
+    query = ForumPost.query
+    if cursor:
+        query = query.filter(older_than(ForumPost.date_posted, ForumPost.id, cursor))
+    posts = query.order_by(
+        ForumPost.date_posted.desc(), ForumPost.id.desc()
+    ).limit(page_size + 1).all()
+
+    next_cursor = None
+    if len(posts) > page_size:
+        posts = posts[:page_size]
+        next_cursor = encode_cursor(posts[-1])
+    return posts, next_cursor
+
+def older_than(column_date, column_id, cursor):
+    """Keyset filter for rows before a (date_posted, id) cursor"""
+    date_posted, row_id = decode_cursor(cursor)
+    return or_(column_date < date_posted, and_(column_date == date_posted, column_id < row_id))
+
+def latest_comments_query(post_id, limit, cursor=None):
+    """Ids of a post's newest comments, walking ix_forum_comments_post_date_posted"""
+    query = select(ForumComment.id).where(ForumComment.post_id == post_id)
+    if cursor:
+        query = query.where(older_than(ForumComment.date_posted, ForumComment.id, cursor))
+    return query.order_by(ForumComment.date_posted.desc(), ForumComment.id.desc()).limit(limit)
+
+def load_card_data(posts):
+    """
+    Load authors and each post's latest comments in two SELECTs
+
+    Only the newest FORUM_COMMENT_PREVIEW comments of each post are read,
+    one index range per post, however long the thread; the rest load
+    on demand from post_comments.
+    """
+    preview = current_app.config['FORUM_COMMENT_PREVIEW']
+    commented = [post.id for post in posts if post.comment_count]
+    comments = []
+    if commented and preview:
+        branches = [select(latest_comments_query(post_id, preview).subquery().c.id)
+                    for post_id in commented]
+        ids = branches[0] if len(branches) == 1 else union_all(*branches)
+        comments = ForumComment.query.filter(ForumComment.id.in_(ids)).order_by(
+            ForumComment.date_posted, ForumComment.id
+        ).all()
+    user_ids = {post.user_id for post in posts} | {comment.user_id for comment in comments}
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
+    by_post = {post.id: [] for post in posts}
+    for comment in comments:
+        set_committed_value(comment, 'user', users.get(comment.user_id))
+        by_post[comment.post_id].append(comment)
+    for post in posts:
+        set_committed_value(post, 'user', users.get(post.user_id))
+        post.latest_comments = by_post[post.id]
+        post.earlier_cursor = (encode_cursor(by_post[post.id][0])
+                               if post.comment_count > len(by_post[post.id]) and by_post[post.id]
+                               else None)
+
+def post_cards(posts):
+    """
+    Rendered card HTML for each post, keyed by post id
+
+    Cards are cached per viewer under the post's version stamp, which is
+    read before any card data so a card can never be stored under a
+    newer stamp than its content.
+    """
+    stamps = versions([post_key(post.id) for post in posts])
+    viewer = current_user.get_id()
+    cards, stale = {}, []
+    for post in posts:
+        html = fragments.get(post_key(post.id), stamps[post_key(post.id)][0], viewer)
+        if html is None:
+            stale.append(post)
+        else:
+            cards[post.id] = html
+    if stale:
+        load_card_data(stale)
+        for post in stale:
+            html = Markup(render_template('post_card.html', post=post))
+            fragments.put(post_key(post.id), stamps[post_key(post.id)][0], viewer, html)
+            cards[post.id] = html
+    return cards
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -55,6 +194,10 @@ def register():
         return redirect(url_for('index'))
         
     if request.method == 'POST':
+        retry_after = passwords.throttle_register(request.remote_addr)
+        if retry_after:
+            flash('Too many registrations from your network. Please try again later.', 'danger')
+            return render_template('register.html'), 429, {'Retry-After': str(retry_after)}
         try:
             username = request.form.get('username')
             email = request.form.get('email')
@@ -63,26 +206,25 @@ def register():
             new_user = User(
                 username=username,
                 email=email,
-                password=generate_password_hash(password, method='pbkdf2:sha256'),
+                password=passwords.hasher.hash(password),
                 created_at=datetime.utcnow()
             )
 
             db.session.add(new_user)
+            # Queued in the same transaction, so the welcome mail exists
+            # exactly when the account does
+            send_welcome_email(new_user, commit=False)
             db.session.commit()
-
-            try:
-                email_sent = send_welcome_email(new_user)
-                if email_sent:
-                    flash('Registration successful! Please check your email for login details.', 'success')
-                else:
-                    flash('Registration successful! However, welcome email could not be sent.', 'warning')
-            except Exception as e:
-                logger.error(f"Email sending failed: {str(e)}")
-                flash('Registration successful! However, there was an issue sending the welcome email.', 'warning')
+            stats.adjust('users_count', 1)
+            notify_mail_workers()
+            flash('Registration successful! Please check your email for login details.', 'success')
 
             login_user(new_user)
             return redirect(url_for('index'))
 
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'warning')
+            return render_template('register.html'), 503, {'Retry-After': '1'}
         except Exception as e:
             db.session.rollback()
             logger.error(f"Registration error: {str(e)}")
@@ -97,12 +239,32 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        # Refused before any hashing work is spent on the attempt
+        retry_after = passwords.throttle_login(request.remote_addr, username)
+        if retry_after:
+            flash('Too many login attempts. Please try again later.', 'danger')
+            return render_template('login.html'), 429, {'Retry-After': str(retry_after)}
         user = User.query.filter_by(username=username).first()
+        try:
+            matches, new_hash = passwords.hasher.verify(user.password if user else None, password)
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'warning')
+            return render_template('login.html'), 503, {'Retry-After': '1'}
         
-        if user and check_password_hash(user.password, password):
+        if user and matches:
+            if new_hash:
+                # Stored with outdated parameters; upgrade while we have the password
+                user.password = new_hash
+                try:
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Password rehash failed for user {user.id}: {str(e)}")
+            passwords.login_succeeded(request.remote_addr, username)
             login_user(user)
             return redirect(url_for('index'))
-            
+
+        passwords.login_failed(username)
         flash('Invalid username or password', 'danger')
     return render_template('login.html')
 
@@ -117,67 +279,210 @@ def logout():
 @app.route('/forum')
 def forum():
     """Forum main page route"""
-    posts = ForumPost.query.order_by(ForumPost.date_posted.desc()).all()
-    return render_template('forum.html', posts=posts)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except ValueError:
+            abort(400)
+
+    def render():
+        posts, next_cursor = forum_page(cursor, current_app.config['FORUM_PAGE_SIZE'])
+        return render_template('forum.html', posts=posts, cards=post_cards(posts),
+                               cursor=cursor, next_cursor=next_cursor)
+
+    version, updated_at = versions([FORUM_KEY])[FORUM_KEY]
+    return conditional_response(('forum', version, cursor, current_user.get_id()), render,
+                                last_modified=updated_at)
+
+@app.route('/forum/post/<int:post_id>')
+def view_post(post_id):
+    """Single forum post route"""
+    def render():
+        post = ForumPost.query.get_or_404(post_id)
+        return render_template('forum.html', posts=[post], cards=post_cards([post]),
+                               cursor=None, next_cursor=None)
+
+    version, updated_at = versions([post_key(post_id)])[post_key(post_id)]
+    return conditional_response(('post', post_id, version, current_user.get_id()), render,
+                                last_modified=updated_at)
+
+@app.route('/forum/post/<int:post_id>/card')
+def post_card(post_id):
+    """One rendered post card, for pages patching in live updates"""
+    def render():
+        post = ForumPost.query.get_or_404(post_id)
+        return post_cards([post])[post.id]
+
+    version, updated_at = versions([post_key(post_id)])[post_key(post_id)]
+    return conditional_response(('card', post_id, version, current_user.get_id()), render,
+                                last_modified=updated_at)
+
+@app.route('/forum/post/<int:post_id>/comments')
+def post_comments(post_id):
+    """
+    Older comments of a post, as JSON
+
+    `before` is the cursor of the oldest comment the page already shows;
+    comments come back oldest first with the cursor for the next batch.
+    """
+    before = request.args.get('before')
+    if before:
+        try:
+            decode_cursor(before)
+        except ValueError:
+            abort(400)
+    post = ForumPost.query.get_or_404(post_id)
+    limit = current_app.config['FORUM_COMMENT_PAGE_SIZE']
+    ids = db.session.execute(latest_comments_query(post.id, limit + 1, before)).scalars().all()
+    comments = ForumComment.query.options(selectinload(ForumComment.user)).filter(
+        ForumComment.id.in_(ids[:limit])
+    ).order_by(ForumComment.date_posted, ForumComment.id).all() if ids else []
+    return jsonify(
+        comments=[comment_json(comment, comment.user.username) for comment in comments],
+        next_cursor=encode_cursor(comments[0]) if len(ids) > limit else None,
+        comment_count=post.comment_count,
+    )
 
 @app.route('/forum/post', methods=['POST'])
 @login_required
 def create_post():
     """Create new forum post route"""
+    staged = None
     try:
         title = request.form.get('title')
         content = request.form.get('content')
         photo = request.files.get('photo')
         
+        # Store the raw upload under its content hash; renditions are
+        # built in the background, once per distinct image
         photo_filename = None
+        photo_status = None
+        needs_processing = False
         if photo and allowed_file(photo.filename):
-            photo_filename = process_image(photo)
+            staged = stage_upload(photo)
+            needs_processing = acquire(staged)
+            photo_filename = staged.digest
+            photo_status = 'pending' if needs_processing else photo_status_for(photo_filename)
         
         post = ForumPost(
             user_id=current_user.id,
             title=title,
             content=content,
-            photo_filename=photo_filename
+            photo_filename=photo_filename,
+            photo_status=photo_status
         )
         db.session.add(post)
+        bump(FORUM_KEY)
+        db.session.flush()
+        post_id = post.id
+        document = post_doc(post)
         db.session.commit()
-        flash("Post created successfully!", 'success')
         
+    except (UploadRejected, RequestEntityTooLarge) as e:
+        db.session.rollback()
+        message = str(e) if isinstance(e, UploadRejected) else 'Image is too large.'
+        return write_response(message, 'danger', 400)
     except Exception as e:
+        if staged:
+            staged.discard()
         db.session.rollback()
         logger.error(f"Error creating post: {str(e)}")
-        flash("An error occurred. Please try again.", 'danger')
-        
-    return redirect(url_for('forum'))
+        return write_response("An error occurred. Please try again.", 'danger', 500)
+
+    # The post is committed and its upload is referenced: nothing below
+    # may discard the file or turn the response into an error
+    try:
+        if needs_processing:
+            pipeline.submit(photo_filename)
+        stats.adjust('forum_posts_count', 1)
+        index_documents([document])
+        publish('post_created', post_id=post_id)
+    except Exception as e:
+        logger.error(f"Error after creating post {post_id}: {str(e)}")
+    return write_response("Post created successfully!", 'success', 201, post={'id': post_id})
+
+def change_comment_count(post_id, delta):
+    """
+    Adjust a post's comment_count in the current transaction
+
+    Returns:
+        The new count, or None if the post does not exist
+    """
+    if delta:
+        changed = db.session.execute(
+            update(ForumPost).where(ForumPost.id == post_id)
+            .values(comment_count=ForumPost.comment_count + delta)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not changed:
+            return None
+    return db.session.execute(
+        select(ForumPost.comment_count).where(ForumPost.id == post_id)
+    ).scalar()
 
 @app.route('/forum/comment/<int:post_id>', methods=['POST'])
 @login_required
 def add_comment(post_id):
     """Add comment to forum post route"""
-    content = request.form.get('content')
-    comment = ForumComment(post_id=post_id, user_id=current_user.id, content=content)
+    content = (request.form.get('content') or '').strip()
+    if not content:
+        return write_response("Comment cannot be empty.", 'danger', 400)
+    comment = ForumComment(post_id=post_id, user_id=current_user.id, content=content,
+                           date_posted=datetime.utcnow())
     try:
+        comment_count = change_comment_count(post_id, 1)
+        if comment_count is None:
+            db.session.rollback()
+            return write_response('Post not found.', 'danger', 404)
         db.session.add(comment)
+        bump(FORUM_KEY, post_key(post_id))
         db.session.commit()
-        flash("Comment added successfully!", 'success')
+        index_documents([comment_doc(comment)])
     except Exception as e:
         db.session.rollback()
-        flash("An error occurred. Please try again.", 'danger')
-    return redirect(url_for('forum'))
+        logger.error(f"Error adding comment to post {post_id}: {str(e)}")
+        return write_response("An error occurred. Please try again.", 'danger', 500)
+    data = comment_json(comment, current_user.username)
+    publish('comment_added', post_id=post_id, comment=data, comment_count=comment_count)
+    return write_response("Comment added successfully!", 'success', 201, comment=data,
+                          comment_count=comment_count)
 
 @app.route('/forum/delete_post/<int:post_id>', methods=['POST'])
 @login_required
 def delete_post(post_id):
     """Delete forum post route"""
+    post = db.session.get(ForumPost, post_id)
+    if post is None:
+        return write_response('Post not found.', 'danger', 404)
     try:
-        post = ForumPost.query.get_or_404(post_id)
+        legacy_photo = post.photo_filename if post.photo_status is None else None
+        orphaned = None
+        if post.photo_filename and not legacy_photo and release(post.photo_filename):
+            orphaned = post.photo_filename
+        comment_ids = db.session.execute(
+            select(ForumComment.id).where(ForumComment.post_id == post_id)
+        ).scalars().all()
+        db.session.execute(ForumComment.__table__.delete().where(ForumComment.post_id == post_id))
         db.session.delete(post)
+        # Bumped rather than dropped, so a reused id never matches a
+        # stamp cached for the deleted post
+        bump(FORUM_KEY, post_key(post_id))
         db.session.commit()
-        flash('Post deleted successfully', 'success')
+        fragments.invalidate(post_key(post_id))
+        remove_documents('post', [post_id])
+        remove_documents('comment', comment_ids)
+        if legacy_photo:
+            remove_legacy_file(legacy_photo)
+        if orphaned:
+            remove_orphaned(orphaned)
+        stats.adjust('forum_posts_count', -1)
     except Exception as e:
+        db.session.rollback()
         logger.error(f'Error deleting post: {e}')
-        flash('An error occurred while deleting the post', 'danger')
-    return redirect(url_for('forum'))
+        return write_response('An error occurred while deleting the post', 'danger', 500)
+    publish('post_deleted', post_id=post_id)
+    return write_response('Post deleted successfully', 'success')
 
 @app.route('/forum/delete_comment/<int:comment_id>', methods=['POST'])
 @login_required
@@ -185,17 +490,46 @@ def delete_comment(comment_id):
     """Delete forum comment route"""
     comment = ForumComment.query.get_or_404(comment_id)
     if comment.user_id != current_user.id:
-        flash('You can only delete your own comments.', 'danger')
-        return redirect(url_for('forum'))
+        return write_response('You can only delete your own comments.', 'danger', 403)
         
+    post_id = comment.post_id
     try:
-        db.session.delete(comment)
+        # Counted only if this request is the one that removed the row
+        deleted = db.session.execute(
+            ForumComment.__table__.delete().where(ForumComment.id == comment_id)
+        ).rowcount
+        comment_count = change_comment_count(post_id, -deleted)
+        bump(FORUM_KEY, post_key(post_id))
         db.session.commit()
-        flash("Comment deleted successfully!", 'success')
+        remove_documents('comment', [comment_id])
     except Exception as e:
         db.session.rollback()
-        flash("An error occurred. Please try again.", 'danger')
-    return redirect(url_for('forum'))
+        logger.error(f"Error deleting comment {comment_id}: {str(e)}")
+        return write_response("An error occurred. Please try again.", 'danger', 500)
+    publish('comment_deleted', post_id=post_id, comment_id=comment_id, comment_count=comment_count)
+    return write_response("Comment deleted successfully!", 'success', comment_count=comment_count)
+
+@app.route('/search')
+def search():
+    """Full-text search across the catalog, borrowed books and forum"""
+    query = request.args.get('q', '').strip()
+    kind = request.args.get('kind') or None
+    if kind not in search_index.KINDS:
+        kind = None
+    page = request.args.get('page', 1, type=int)
+    results, has_next = [], False
+    if query:
+        viewer_id = current_user.id if current_user.is_authenticated else None
+        try:
+            results, has_next = search_index.backend.search(
+                query, viewer_id=viewer_id, kind=kind, page=max(page, 1),
+                per_page=current_app.config['SEARCH_PAGE_SIZE']
+            )
+        except Exception as e:
+            logger.error(f"Search error: {str(e)}")
+            flash('Search is temporarily unavailable.', 'danger')
+    return render_template('search.html', query=query, kind=kind, page=page,
+                           results=results, has_next=has_next)
 
 # Book Management Routes
 @app.route('/add_borrowed_book', methods=['GET', 'POST'])
@@ -220,24 +554,19 @@ def add_borrowed_book():
             )
             
             db.session.add(new_borrowed_book)
-            db.session.commit()
-
-            book_details = {
+            analytics.record_borrows([new_borrowed_book])
+            bump(user_books_key(current_user.id))
+            send_borrowed_book_notification(current_user, {
                 'book_title': title,
                 'author': author,
                 'borrow_date': borrow_date.strftime('%Y-%m-%d'),
                 'due_date': due_date.strftime('%Y-%m-%d')
-            }
-
-            try:
-                email_sent = send_borrowed_book_notification(current_user, book_details)
-                if email_sent:
-                    flash('Book added to your borrowed list. A notification email has been sent.', 'success')
-                else:
-                    flash('Book added to your borrowed list. However, the notification email could not be sent.', 'warning')
-            except Exception as e:
-                logger.error(f"Email sending failed: {str(e)}")
-                flash('Book added to your borrowed list. However, there was an issue sending the notification email.', 'warning')
+            }, commit=False)
+            db.session.commit()
+            stats.borrow_started(current_user.id)
+            index_documents([user_book_doc(new_borrowed_book)])
+            notify_mail_workers()
+            flash('Book added to your borrowed list. A notification email has been sent.', 'success')
 
             return redirect(url_for('borrowed_books'))
         except ValueError:
@@ -253,9 +582,26 @@ def add_borrowed_book():
 @login_required
 def borrowed_books():
     """View borrowed books route"""
-    books = UserBook.query.filter_by(user_id=current_user.id).order_by(UserBook.borrow_date.desc()).all()
     current_date = datetime.utcnow().date()
-    return render_template('borrowed_books.html', books=books, current_date=current_date)
+
+    def render():
+        books = UserBook.query.filter_by(user_id=current_user.id).order_by(UserBook.borrow_date.desc()).all()
+        loans = BorrowedBook.query.options(selectinload(BorrowedBook.book)).filter_by(
+            user_id=current_user.id, return_date=None
+        ).order_by(BorrowedBook.due_date).all()
+        holds = BookHold.query.options(selectinload(BookHold.book)).filter(
+            BookHold.user_id == current_user.id,
+            BookHold.status.in_(ACTIVE_HOLD_STATUSES)
+        ).order_by(BookHold.created_at).all()
+        return render_template('borrowed_books.html', books=books, loans=loans, holds=holds,
+                               current_date=current_date)
+
+    # Overdue badges change with the date, so it is part of the ETag and
+    # Last-Modified is not sent
+    key = user_books_key(current_user.id)
+    version, _ = versions([key])[key]
+    return conditional_response(('user_books', version, current_date.isoformat(),
+                                 current_user.get_id()), render)
 
 @app.route('/mark_returned/<int:book_id>', methods=['POST'])
 @login_required
@@ -267,11 +613,25 @@ def mark_returned(book_id):
         flash('Unauthorized', 'danger')
         return redirect(url_for('borrowed_books'))
     
-    book.is_returned = True
-    book.return_date = datetime.utcnow()
-    
+    today = datetime.utcnow().date()
     try:
+        # Only the request whose update flips the flag counts the return,
+        # so a double submit cannot add it to the rollups twice
+        flipped = db.session.execute(
+            update(UserBook)
+            .where(UserBook.id == book.id,
+                   or_(UserBook.is_returned == False, UserBook.is_returned.is_(None)))  # noqa: E712
+            .values(is_returned=True, return_date=today)
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+        if flipped:
+            set_committed_value(book, 'is_returned', True)
+            set_committed_value(book, 'return_date', today)
+            analytics.record_returns([book])
+        bump(user_books_key(current_user.id))
         db.session.commit()
+        if flipped:
+            stats.borrow_ended(current_user.id)
         flash('Book marked as returned', 'success')
     except:
         db.session.rollback()
@@ -279,26 +639,200 @@ def mark_returned(book_id):
     
     return redirect(url_for('borrowed_books'))
 
+@app.route('/analytics')
+@login_required
+def reading_analytics():
+    """Reading history dashboard for the user and the whole library"""
+    try:
+        mine = analytics.summary(current_user.id)
+        library = analytics.summary(analytics.LIBRARY)
+    except Exception as e:
+        logger.error(f"Error loading analytics: {str(e)}")
+        flash('Error loading reading analytics', 'danger')
+        return redirect(url_for('borrowed_books'))
+    return render_template('analytics.html', mine=mine, library=library)
+
+# Borrowed books JSON API
+def api_login_required(view):
+    """Like login_required, but answers 401 JSON instead of redirecting"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return jsonify(error='Authentication required.'), 401
+        return view(*args, **kwargs)
+    return wrapped
+
+def json_body(field):
+    """The named list from a JSON request body, or None"""
+    body = request.get_json(silent=True)
+    return body.get(field) if isinstance(body, dict) else None
+
+@app.route('/api/user_books')
+@api_login_required
+def api_list_user_books():
+    """
+    List the user's books, newest borrow first
+
+    Query args: status (active, returned or overdue), due_before
+    (YYYY-MM-DD), limit, and cursor from the previous page's next_cursor.
+    """
+    today = datetime.utcnow().date()
+    status = request.args.get('status') or None
+    if status is not None and status not in user_book_batches.STATUSES:
+        return jsonify(error=f"status must be one of {', '.join(user_book_batches.STATUSES)}"), 400
+    try:
+        due_before = request.args.get('due_before')
+        due_before = user_book_batches.parse_date(due_before, 'due_before') if due_before else None
+        cursor = request.args.get('cursor') or None
+        if cursor:
+            user_book_batches.decode_cursor(cursor)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int)
+    limit = min(max(limit, 1), current_app.config['API_MAX_PAGE_SIZE'])
+    books, next_cursor = user_book_batches.list_books(
+        current_user.id, status=status, due_before=due_before, cursor=cursor, limit=limit, today=today
+    )
+    return jsonify(books=[book_json(book, today) for book in books], next_cursor=next_cursor)
+
+@app.route('/api/user_books', methods=['POST'])
+@api_login_required
+def api_add_user_books():
+    """Add a batch of borrowed books: {"books": [{title, author, due_date, ...}]}"""
+    try:
+        books = user_book_batches.add_books(current_user, json_body('books'))
+    except BatchRejected as e:
+        db.session.rollback()
+        return jsonify(error=str(e), errors=e.errors), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error adding borrowed books batch: {str(e)}")
+        return jsonify(error='Error adding books'), 500
+    stats.borrow_started(current_user.id, count=len(books))
+    index_documents([user_book_doc(book) for book in books])
+    notify_mail_workers()
+    return jsonify(books=[book_json(book) for book in books]), 201
+
+@app.route('/api/user_books/returns', methods=['POST'])
+@api_login_required
+def api_return_user_books():
+    """Mark a batch of books returned: {"ids": [...]}"""
+    try:
+        result = user_book_batches.return_books(current_user.id, json_body('ids'))
+    except BatchRejected as e:
+        db.session.rollback()
+        return jsonify(error=str(e), errors=e.errors), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error returning borrowed books batch: {str(e)}")
+        return jsonify(error='Error marking books as returned'), 500
+    if result['returned']:
+        stats.borrow_ended(current_user.id)
+    return jsonify(result)
+
+# Catalog Routes
+def user_holds(book_ids):
+    """Map book id -> the current user's active hold among book_ids"""
+    if not current_user.is_authenticated or not book_ids:
+        return {}
+    holds = BookHold.query.filter(
+        BookHold.user_id == current_user.id,
+        BookHold.book_id.in_(book_ids),
+        BookHold.status.in_(ACTIVE_HOLD_STATUSES)
+    ).all()
+    return {hold.book_id: hold for hold in holds}
+
+@app.route('/catalog')
+def catalog():
+    """Library catalog with live copy counts"""
+    page = request.args.get('page', 1, type=int)
+    books = Book.query.order_by(Book.title, Book.id).paginate(
+        page=page, per_page=current_app.config['CATALOG_PAGE_SIZE'], error_out=False
+    )
+    holds = user_holds([book.id for book in books.items])
+    return render_template('catalog.html', books=books.items, pagination=books, holds=holds)
+
+@app.route('/catalog/<int:book_id>')
+def view_book(book_id):
+    """Single catalog entry route"""
+    book = Book.query.get_or_404(book_id)
+    return render_template('catalog.html', books=[book], pagination=None,
+                           holds=user_holds([book.id]))
+
+@app.route('/catalog/<int:book_id>/checkout', methods=['POST'])
+@login_required
+def checkout_book(book_id):
+    """Borrow a copy of a catalog book"""
+    book = Book.query.get_or_404(book_id)
+    try:
+        loan = checkout(book.id, current_user.id)
+        flash(f'You borrowed "{book.title}". It is due {loan.due_date.strftime("%Y-%m-%d")}.', 'success')
+        return redirect(url_for('borrowed_books'))
+    except CirculationError as e:
+        flash(str(e), 'warning')
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error checking out book {book_id}: {str(e)}")
+        flash('Error borrowing book', 'danger')
+    return redirect(url_for('view_book', book_id=book_id))
+
+@app.route('/catalog/<int:book_id>/hold', methods=['POST'])
+@login_required
+def hold_book(book_id):
+    """Join the waitlist for a catalog book"""
+    try:
+        place_hold(book_id, current_user.id)
+        flash('You have been added to the waitlist.', 'success')
+    except CirculationError as e:
+        flash(str(e), 'warning')
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error placing hold on book {book_id}: {str(e)}")
+        flash('Error placing hold', 'danger')
+    return redirect(url_for('view_book', book_id=book_id))
+
+@app.route('/holds/<int:hold_id>/cancel', methods=['POST'])
+@login_required
+def cancel_book_hold(hold_id):
+    """Leave a waitlist"""
+    try:
+        cancel_hold(hold_id, current_user.id)
+        flash('Hold cancelled', 'success')
+    except CirculationError as e:
+        flash(str(e), 'warning')
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error cancelling hold {hold_id}: {str(e)}")
+        flash('Error cancelling hold', 'danger')
+    return redirect(url_for('borrowed_books'))
+
+@app.route('/loans/<int:loan_id>/return', methods=['POST'])
+@login_required
+def return_book(loan_id):
+    """Return a catalog loan"""
+    try:
+        return_loan(loan_id, current_user.id)
+        flash('Book returned', 'success')
+    except CirculationError as e:
+        flash(str(e), 'warning')
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error returning loan {loan_id}: {str(e)}")
+        flash('Error returning book', 'danger')
+    return redirect(url_for('borrowed_books'))
+
 @app.route('/')
 def index():
     """Enhanced home page route with statistics"""
     try:
-        # Gather statistics
-        users_count = User.query.count()
-        books_count = Book.query.count()
-        active_borrowers = UserBook.query.filter_by(is_returned=False).distinct(UserBook.user_id).count()
-        forum_posts_count = ForumPost.query.count()
-        
-        # Get available books
-        books = Book.query.all()
-        
-        return render_template('index.html',
-                             books=books,
-                             users_count=users_count,
-                             books_count=books_count,
-                             active_borrowers=active_borrowers,
-                             forum_posts_count=forum_posts_count)
+        # Statistics come from the in-process cache, not per-hit COUNTs,
+        # so the ETag costs no query at all
+        counts = stats.get()
+        return conditional_response(
+            ('index', sorted(counts.items()), current_user.get_id()),
+            lambda: render_template('index.html', **counts)
+        )
     except Exception as e:
         logger.error(f"Error loading index page: {str(e)}")
         flash('Error loading page data', 'danger')
-        return render_template('index.html', books=[])
\ No newline at end of file
+        return render_template('index.html')
\ No newline at end of file
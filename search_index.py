@@ -0,0 +1,461 @@
+"""
+Full-text search over the catalog, borrowed books and forum
+
+Documents live in an SQLite FTS5 sidecar file in the instance folder, kept in
+sync by the write routes and rebuilt with `flask search-reindex`. MySQL
+stays the source of truth; the index can always be thrown away.
+
+The sidecar only works where every worker shares one persistent disk. A
+serverless instance would start from an empty temp dir on every cold
+start and only ever see its own writes, so with SEARCH_BACKEND=database
+(the default on DB_SERVERLESS hosts) queries run against the tables
+themselves with LIKE instead, ranked the same way, and the sync hooks do
+nothing.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+from markupsafe import Markup, escape
+
+from sqlalchemy import or_
+
+from extensions import db
+from models import Book, UserBook, ForumPost, ForumComment
+
+logger = logging.getLogger(__name__)
+
+# Highlight markers that cannot occur in indexed text, swapped for
+# <mark> tags only after the text itself has been escaped
+MARK_START, MARK_END = '\x02', '\x03'
+
+# Rowids are derived from (kind, id) so updates and deletes hit one row
+KINDS = {'book': 1, 'user_book': 2, 'post': 3, 'comment': 4}
+KIND_SLOTS = 8
+
+# Ranking: title hits count ten times body hits; the averages only
+# normalise field length, so rough values are fine
+TITLE_WEIGHT = 10.0
+AVG_TITLE_WORDS = 6
+AVG_BODY_WORDS = 40
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+    title, body,
+    kind UNINDEXED, ref_id UNINDEXED, owner_id UNINDEXED, post_id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+
+def doc_rowid(kind, ref_id):
+    return ref_id * KIND_SLOTS + KINDS[kind]
+
+
+def render_highlight(text):
+    """Escape indexed text and turn the highlight markers into <mark>"""
+    return Markup(str(escape(text)).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def fold(text):
+    """Lower-case and strip diacritics, like the unicode61 tokenizer"""
+    text = text.lower()
+    if text.isascii():
+        return text
+    return ''.join(c for c in unicodedata.normalize('NFKD', text)
+                   if not unicodedata.combining(c))
+
+
+def parse_query(query):
+    """
+    Turn free text into a safe FTS5 expression plus term patterns
+
+    Every word must match. A trailing * asks for a prefix match on the
+    last word; it is opt-in because long prefixes make FTS5 merge every
+    matching doclist up front.
+
+    Returns:
+        Tuple of (expression, patterns), or (None, []) for an empty query
+    """
+    words = re.findall(r'\w+', fold(query))
+    if not words:
+        return None, []
+    prefix = query.rstrip().endswith('*')
+    terms = [f'"{word}"' for word in words]
+    patterns = [re.compile(rf'\b{re.escape(word)}\b') for word in words]
+    if prefix:
+        terms[-1] += '*'
+        patterns[-1] = re.compile(rf'\b{re.escape(words[-1])}\w*')
+    return ' '.join(terms), patterns
+
+
+def field_score(text, patterns, avg_length, k1=1.2, b=0.75):
+    """BM25 term-frequency part for one field; every term's idf is 1"""
+    text = fold(text)
+    length = text.count(' ') + 1
+    norm = k1 * (1 - b + b * length / avg_length)
+    score = 0.0
+    for pattern in patterns:
+        tf = len(pattern.findall(text))
+        score += tf * (k1 + 1) / (tf + norm)
+    return score
+
+
+def rank_page(candidates, patterns, window, older, page, per_page):
+    """
+    Rank each kind's newest matches together and cut out one page
+
+    Args:
+        candidates: kind -> up to window + 1 (rowid, title, body) rows,
+            newest first
+        older: Called as older(cutoffs, offset, limit) for the rowids of
+            matches below each overflowing kind's cutoff rowid, newest
+            first, once a page reaches past the ranked matches
+
+    Returns:
+        Tuple of (page rowids, ranked rowids, has_next)
+    """
+    pool, cutoffs = [], {}
+    for kind, rows in candidates.items():
+        if len(rows) > window:
+            rows = rows[:window]
+            cutoffs[kind] = rows[-1][0]
+        pool += rows
+    ranked = sorted(pool, key=lambda row: (
+        -(TITLE_WEIGHT * field_score(row[1], patterns, AVG_TITLE_WORDS)
+          + field_score(row[2], patterns, AVG_BODY_WORDS)),
+        -row[0]
+    ))
+    start = (page - 1) * per_page
+    page_rowids = [row[0] for row in ranked[start:start + per_page]]
+    has_next = len(ranked) > start + per_page
+    if cutoffs and not has_next:
+        # The page reaches past the windows: continue in rowid order
+        # below each kind's oldest ranked candidate
+        wanted = per_page - len(page_rowids)
+        rowids = older(cutoffs, max(0, start - len(ranked)), wanted + 1)
+        page_rowids += rowids[:wanted]
+        has_next = len(rowids) > wanted
+    return page_rowids, {row[0] for row in pool}, has_next
+
+
+class SearchIndex:
+    """Thin wrapper around one FTS5 database with a connection per thread"""
+
+    def __init__(self, path=None, rank_window=500):
+        self.path = path
+        self.rank_window = rank_window
+        self._local = threading.local()
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def upsert_many(self, docs):
+        """
+        Insert or replace documents
+
+        Args:
+            docs: Iterable of dicts with kind, ref_id, title, body and the
+                optional owner_id (private documents) and post_id
+        """
+        rows = [(
+            doc_rowid(doc['kind'], doc['ref_id']), doc['title'] or '', doc['body'] or '',
+            doc['kind'], doc['ref_id'], doc.get('owner_id'), doc.get('post_id')
+        ) for doc in docs]
+        conn = self.connection()
+        with conn:
+            conn.executemany('DELETE FROM documents WHERE rowid = ?', [(row[0],) for row in rows])
+            conn.executemany(
+                'INSERT INTO documents (rowid, title, body, kind, ref_id, owner_id, post_id) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+            )
+
+    def delete_many(self, kind, ref_ids):
+        conn = self.connection()
+        with conn:
+            conn.executemany('DELETE FROM documents WHERE rowid = ?',
+                             [(doc_rowid(kind, ref_id),) for ref_id in ref_ids])
+
+    def clear(self):
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM documents')
+
+    def optimize(self):
+        conn = self.connection()
+        with conn:
+            conn.execute("INSERT INTO documents (documents) VALUES ('optimize')")
+
+    def search(self, query, viewer_id=None, kind=None, page=1, per_page=20):
+        """
+        Ranked search; returns (results, has_next)
+
+        FTS5's bm25() first counts every document containing each term,
+        which for common words is most of the index. Instead the newest
+        rank_window matches of each kind are read in rowid order, where
+        FTS5 can stop early, and scored here with BM25's term-frequency
+        and length terms. Every candidate contains every term, so idf
+        would only reweight terms against each other and is left out.
+        Titles weigh ten times bodies, and private documents (borrowed
+        books) are only returned to their owner.
+
+        Windows are per kind because rowids interleave kinds by id: a
+        shared window would let a busy forum push every catalog match
+        out of the ranking. Matches older than their kind's window are
+        still paged through, newest first and unranked; their results
+        carry ranked=False.
+        """
+        expression, patterns = parse_query(query)
+        if expression is None:
+            return [], False
+        conn = self.connection()
+        sql = ("SELECT rowid, title, body FROM documents WHERE documents MATCH ? "
+               "AND (owner_id IS NULL OR owner_id = ?)")
+        params = [expression, viewer_id]
+        # One extra row per kind tells whether anything lies beyond its window
+        candidates = {
+            name: conn.execute(sql + " AND kind = ? ORDER BY rowid DESC LIMIT ?",
+                               params + [name, self.rank_window + 1]).fetchall()
+            for name in ([kind] if kind else KINDS)
+        }
+
+        def older(cutoffs, offset, limit):
+            below = ' OR '.join('(kind = ? AND rowid < ?)' for _ in cutoffs)
+            return [row[0] for row in conn.execute(
+                sql + f" AND ({below}) ORDER BY rowid DESC LIMIT ? OFFSET ?",
+                params + [value for item in cutoffs.items() for value in item] + [limit, offset]
+            ).fetchall()]
+
+        page_rowids, ranked_rowids, has_next = rank_page(
+            candidates, patterns, self.rank_window, older, page, per_page)
+        if not page_rowids:
+            return [], False
+
+        # Highlighting needs FTS5's phrase positions, so only the page's
+        # rows are fetched through it
+        rows = conn.execute(
+            "SELECT rowid, kind, ref_id, post_id, "
+            "highlight(documents, 0, ?, ?), "
+            "snippet(documents, 1, ?, ?, '\u2026', 24) "
+            "FROM documents WHERE documents MATCH ? "
+            f"AND rowid IN ({', '.join('?' * len(page_rowids))})",
+            [MARK_START, MARK_END, MARK_START, MARK_END, expression] + page_rowids
+        ).fetchall()
+        by_rowid = {row[0]: row for row in rows}
+        results = [
+            dict(kind=row[1], ref_id=row[2], post_id=row[3], ranked=row[0] in ranked_rowids,
+                 title=render_highlight(row[4]), snippet=render_highlight(row[5]))
+            for row in (by_rowid[rowid] for rowid in page_rowids if rowid in by_rowid)
+        ]
+        return results, has_next
+
+
+class DatabaseSearch:
+    """
+    Search straight against the database, for hosts without a shared disk
+
+    Every word must appear, as a substring, in one of a document's
+    fields. Each kind's newest rank_window matches are read by primary
+    key, which lets the database stop early, and ranked by rank_page
+    like the index's; highlighting is done here as well.
+    """
+
+    # kind -> (model, title column, body columns, post id column)
+    SOURCES = {
+        'book': (Book, Book.title, (Book.author,), None),
+        'user_book': (UserBook, UserBook.book_title, (UserBook.author, UserBook.notes), None),
+        'post': (ForumPost, ForumPost.title, (ForumPost.content,), ForumPost.id),
+        'comment': (ForumComment, None, (ForumComment.content,), ForumComment.post_id),
+    }
+
+    def __init__(self, rank_window=500):
+        self.rank_window = rank_window
+
+    def matches(self, kind, words, viewer_id):
+        model, title, body, _ = self.SOURCES[kind]
+        fields = ([title] if title is not None else []) + list(body)
+        query = db.session.query(model.id).filter(*[
+            or_(*[field.ilike(f"%{like_escape(word)}%", escape='\\') for field in fields])
+            for word in words
+        ])
+        if kind == 'user_book':
+            query = query.filter(UserBook.user_id == viewer_id)
+        return query
+
+    @staticmethod
+    def columns(kind):
+        model, title, body, post_id = DatabaseSearch.SOURCES[kind]
+        return [model.id, title if title is not None else db.literal(''),
+                post_id if post_id is not None else db.literal(None)] + list(body)
+
+    def search(self, query, viewer_id=None, kind=None, page=1, per_page=20):
+        """Ranked search; returns (results, has_next) like SearchIndex.search"""
+        expression, patterns = parse_query(query)
+        if expression is None:
+            return [], False
+        # As typed: the columns are not folded, so stripping accents here
+        # would stop "café" from ever matching itself
+        words = re.findall(r'\w+', query)
+        kinds = [kind] if kind else list(KINDS)
+        if viewer_id is None and 'user_book' in kinds:
+            kinds.remove('user_book')
+
+        candidates = {}
+        for name in kinds:
+            model = self.SOURCES[name][0]
+            rows = self.matches(name, words, viewer_id) \
+                .with_entities(*self.columns(name)) \
+                .order_by(model.id.desc()).limit(self.rank_window + 1).all()
+            candidates[name] = [
+                (doc_rowid(name, row[0]), row[1] or '', ' '.join(field or '' for field in row[3:]))
+                for row in rows
+            ]
+
+        def older(cutoffs, offset, limit):
+            rowids = []
+            for name, cutoff in cutoffs.items():
+                model = self.SOURCES[name][0]
+                ids = self.matches(name, words, viewer_id) \
+                    .filter(model.id < cutoff // KIND_SLOTS) \
+                    .order_by(model.id.desc()).limit(offset + limit).all()
+                rowids += [doc_rowid(name, row[0]) for row in ids]
+            return sorted(rowids, reverse=True)[offset:offset + limit]
+
+        page_rowids, ranked_rowids, has_next = rank_page(
+            candidates, patterns, self.rank_window, older, page, per_page)
+        if not page_rowids:
+            return [], False
+
+        names = {number: name for name, number in KINDS.items()}
+        wanted = {}
+        for rowid in page_rowids:
+            wanted.setdefault(names[rowid % KIND_SLOTS], []).append(rowid // KIND_SLOTS)
+        by_rowid = {}
+        for name, ids in wanted.items():
+            model = self.SOURCES[name][0]
+            for row in db.session.query(*self.columns(name)).filter(model.id.in_(ids)):
+                by_rowid[doc_rowid(name, row[0])] = (name, row)
+
+        marker = re.compile('|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True)),
+                            re.IGNORECASE)
+        results = []
+        for rowid in page_rowids:
+            if rowid not in by_rowid:
+                continue
+            name, row = by_rowid[rowid]
+            body = ' '.join(field or '' for field in row[3:])
+            results.append(dict(
+                kind=name, ref_id=row[0], post_id=row[2], ranked=rowid in ranked_rowids,
+                title=render_highlight(mark(row[1] or '', marker)),
+                snippet=render_highlight(mark(excerpt(body, marker), marker))
+            ))
+        return results, has_next
+
+
+def like_escape(word):
+    return word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def mark(text, marker):
+    return marker.sub(lambda match: f"{MARK_START}{match.group(0)}{MARK_END}", text)
+
+
+def excerpt(text, marker, words=24):
+    """Up to `words` words of text around the first match, like FTS5's snippet()"""
+    tokens = text.split()
+    if len(tokens) <= words:
+        return text
+    match = marker.search(text)
+    position = len(text[:match.start()].split()) if match else 0
+    begin = max(0, min(position - words // 2, len(tokens) - words))
+    return ('\u2026 ' if begin else '') + ' '.join(tokens[begin:begin + words]) \
+        + (' \u2026' if begin + words < len(tokens) else '')
+
+
+index = SearchIndex()
+# Serves /search: the index, or a DatabaseSearch when SEARCH_BACKEND=database
+backend = index
+
+
+# Document builders, one per indexed model
+def book_doc(book):
+    return dict(kind='book', ref_id=book.id, title=book.title, body=book.author)
+
+def user_book_doc(user_book):
+    return dict(kind='user_book', ref_id=user_book.id, title=user_book.book_title,
+                body=f"{user_book.author} {user_book.notes or ''}", owner_id=user_book.user_id)
+
+def post_doc(post):
+    return dict(kind='post', ref_id=post.id, title=post.title, body=post.content,
+                post_id=post.id)
+
+def comment_doc(comment):
+    return dict(kind='comment', ref_id=comment.id, title='', body=comment.content,
+                post_id=comment.post_id)
+
+
+def index_documents(docs):
+    """Sync hook for the write routes; indexing errors never fail a request"""
+    if backend is not index:
+        return
+    try:
+        index.upsert_many(docs)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Search indexing failed: {str(e)}")
+
+def remove_documents(kind, ref_ids):
+    if backend is not index:
+        return
+    try:
+        index.delete_many(kind, ref_ids)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Search index delete failed: {str(e)}")
+
+
+def rebuild(batch_size=5000):
+    """Rebuild the whole index from the database; returns documents indexed"""
+    index.clear()
+    total = 0
+    for model, to_doc in ((Book, book_doc), (UserBook, user_book_doc),
+                          (ForumPost, post_doc), (ForumComment, comment_doc)):
+        last_id = 0
+        while True:
+            rows = model.query.filter(model.id > last_id).order_by(model.id) \
+                .limit(batch_size).all()
+            if not rows:
+                break
+            index.upsert_many([to_doc(row) for row in rows])
+            total += len(rows)
+            last_id = rows[-1].id
+            db.session.expunge_all()
+    index.optimize()
+    return total
+
+
+def init_app(app):
+    global backend
+    app.config.setdefault('SEARCH_BACKEND', 'index')
+    app.config.setdefault('SEARCH_INDEX_PATH', os.path.join(app.instance_path, 'search.db'))
+    app.config.setdefault('SEARCH_PAGE_SIZE', 20)
+    app.config.setdefault('SEARCH_RANK_WINDOW', 500)
+    if app.config['SEARCH_BACKEND'] not in ('index', 'database'):
+        raise ValueError(f"SEARCH_BACKEND must be 'index' or 'database', not {app.config['SEARCH_BACKEND']!r}")
+    index.path = app.config['SEARCH_INDEX_PATH']
+    index.rank_window = app.config['SEARCH_RANK_WINDOW']
+    if app.config['SEARCH_BACKEND'] == 'database':
+        backend = DatabaseSearch(app.config['SEARCH_RANK_WINDOW'])
+    else:
+        backend = index
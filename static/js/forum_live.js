@@ -0,0 +1,263 @@
+// Live forum updates: forms post with fetch and the page patches itself
+// from /forum/events instead of reloading the whole feed.
+(function () {
+    'use strict';
+
+    var feed = document.getElementById('forum-feed');
+    if (!feed || !window.fetch) {
+        return;
+    }
+    var userId = feed.dataset.userId;
+
+    function cardUrl(postId) {
+        return feed.dataset.cardUrl.replace('/0/card', '/' + postId + '/card');
+    }
+
+    function findPost(postId) {
+        return document.getElementById('post-' + postId);
+    }
+
+    function refreshCard(postId, insert) {
+        return fetch(cardUrl(postId), {credentials: 'same-origin'}).then(function (response) {
+            if (response.status === 404) {
+                removePost(postId);
+                return;
+            }
+            if (!response.ok) {
+                return;
+            }
+            return response.text().then(function (html) {
+                var holder = document.createElement('div');
+                holder.innerHTML = html.trim();
+                var card = holder.firstElementChild;
+                var existing = findPost(postId);
+                if (existing) {
+                    existing.replaceWith(card);
+                } else if (insert) {
+                    var empty = document.getElementById('forum-empty');
+                    if (empty) {
+                        empty.remove();
+                    }
+                    var resync = document.getElementById('forum-resync');
+                    resync.after(card);
+                }
+            });
+        });
+    }
+
+    function removePost(postId) {
+        var post = findPost(postId);
+        if (post) {
+            post.remove();
+        }
+    }
+
+    function removeComment(commentId) {
+        var comment = document.getElementById('comment-' + commentId);
+        if (comment) {
+            comment.remove();
+        }
+    }
+
+    function setCommentCount(postId, count) {
+        var post = findPost(postId);
+        var label = post && post.querySelector('.js-comment-count');
+        if (label && typeof count === 'number') {
+            label.textContent = count + (count === 1 ? ' comment' : ' comments');
+        }
+    }
+
+    function commentSection(postId) {
+        return document.querySelector('.comment-section[data-post-id="' + postId + '"]');
+    }
+
+    function commentElement(comment) {
+        var row = document.createElement('div');
+        row.className = 'comment d-flex justify-content-between align-items-start';
+        row.id = 'comment-' + comment.id;
+        var body = document.createElement('div');
+        var text = document.createElement('p');
+        text.className = 'mb-1';
+        var name = document.createElement('strong');
+        name.textContent = comment.username;
+        text.appendChild(name);
+        text.appendChild(document.createTextNode(': ' + comment.content));
+        var date = document.createElement('small');
+        date.className = 'text-muted';
+        date.textContent = comment.date_posted;
+        body.appendChild(text);
+        body.appendChild(date);
+        row.appendChild(body);
+        if (String(comment.user_id) === userId) {
+            var form = document.createElement('form');
+            form.method = 'POST';
+            form.action = feed.dataset.deleteCommentUrl.replace(/\/0$/, '/' + comment.id);
+            form.className = 'ms-2 js-delete-comment';
+            var button = document.createElement('button');
+            button.type = 'submit';
+            button.className = 'btn btn-danger btn-sm';
+            button.textContent = 'Delete';
+            button.addEventListener('click', function (event) {
+                if (!window.confirm('Are you sure you want to delete this comment?')) {
+                    event.preventDefault();
+                }
+            });
+            form.appendChild(button);
+            row.appendChild(form);
+        }
+        return row;
+    }
+
+    function addComment(comment) {
+        var section = commentSection(comment.post_id);
+        if (section && !document.getElementById('comment-' + comment.id)) {
+            section.appendChild(commentElement(comment));
+        }
+    }
+
+    function loadEarlier(button) {
+        button.disabled = true;
+        var url = button.dataset.url + '?before=' + encodeURIComponent(button.dataset.cursor);
+        fetch(url, {credentials: 'same-origin', headers: {'Accept': 'application/json'}})
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+                return response.json();
+            })
+            .then(function (data) {
+                var section = button.nextElementSibling;
+                var first = section.firstChild;
+                data.comments.forEach(function (comment) {
+                    if (!document.getElementById('comment-' + comment.id)) {
+                        section.insertBefore(commentElement(comment), first);
+                    }
+                });
+                if (data.next_cursor) {
+                    button.dataset.cursor = data.next_cursor;
+                    button.disabled = false;
+                } else {
+                    button.remove();
+                }
+            })
+            .catch(function () {
+                button.disabled = false;
+                showError();
+            });
+    }
+
+    document.addEventListener('click', function (event) {
+        var button = event.target.closest('.js-earlier-comments');
+        if (button) {
+            loadEarlier(button);
+        }
+    });
+
+    function showError(message) {
+        window.alert(message || 'An error occurred. Please try again.');
+    }
+
+    function submitForm(form) {
+        var button = form.querySelector('button[type="submit"]');
+        if (button) {
+            button.disabled = true;
+        }
+        return fetch(form.action, {
+            method: 'POST',
+            body: new FormData(form),
+            credentials: 'same-origin',
+            headers: {'Accept': 'application/json'}
+        }).then(function (response) {
+            if (response.redirected) {
+                // Session expired: the login page will take it from here
+                window.location = response.url;
+                return null;
+            }
+            return response.json().then(function (data) {
+                if (!response.ok) {
+                    showError(data.error);
+                    return null;
+                }
+                return data;
+            });
+        }).catch(function () {
+            showError();
+            return null;
+        }).finally(function () {
+            if (button) {
+                button.disabled = false;
+            }
+        });
+    }
+
+    document.addEventListener('submit', function (event) {
+        var form = event.target;
+        var handler;
+        if (form.classList.contains('js-comment-form')) {
+            handler = function (data) {
+                addComment(data.comment);
+                setCommentCount(data.comment.post_id, data.comment_count);
+                form.reset();
+            };
+        } else if (form.classList.contains('js-delete-comment')) {
+            handler = function (data) {
+                var post = form.closest('.forum-post');
+                removeComment(form.action.split('/').pop());
+                if (post) {
+                    setCommentCount(post.id.replace('post-', ''), data.comment_count);
+                }
+            };
+        } else if (form.classList.contains('js-delete-post')) {
+            handler = function () {
+                removePost(form.action.split('/').pop());
+            };
+        } else if (form.classList.contains('js-create-post')) {
+            handler = function (data) {
+                form.reset();
+                return refreshCard(data.post.id, true);
+            };
+        } else {
+            return;
+        }
+        event.preventDefault();
+        submitForm(form).then(function (data) {
+            if (data) {
+                return handler(data);
+            }
+        });
+    });
+
+    if (!('live' in feed.dataset) || !window.EventSource) {
+        return;
+    }
+    var source = new EventSource(feed.dataset.eventsUrl);
+
+    function on(kind, handler) {
+        source.addEventListener(kind, function (event) {
+            handler(JSON.parse(event.data));
+        });
+    }
+
+    on('comment_added', function (data) {
+        addComment(data.comment);
+        setCommentCount(data.post_id, data.comment_count);
+    });
+    on('comment_deleted', function (data) {
+        removeComment(data.comment_id);
+        setCommentCount(data.post_id, data.comment_count);
+    });
+    on('post_created', function (data) {
+        if (!findPost(data.post_id)) {
+            refreshCard(data.post_id, true);
+        }
+    });
+    on('post_updated', function (data) {
+        refreshCard(data.post_id, false);
+    });
+    on('post_deleted', function (data) {
+        removePost(data.post_id);
+    });
+    on('resync', function () {
+        document.getElementById('forum-resync').classList.remove('d-none');
+    });
+})();
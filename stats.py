@@ -0,0 +1,93 @@
+import threading
+import time
+
+from sqlalchemy import func, or_
+
+from extensions import db
+from models import User, Book, UserBook, ForumPost
+
+# Rows written before is_returned had a default hold NULL; they are on
+# loan too, the same as in the return route's update
+UNRETURNED = or_(UserBook.is_returned == False, UserBook.is_returned.is_(None))  # noqa: E712
+
+
+def query_counts():
+    """Run the aggregate queries behind the home page statistics"""
+    return {
+        'users_count': db.session.query(func.count(User.id)).scalar(),
+        'books_count': db.session.query(func.count(Book.id)).scalar(),
+        'active_borrowers': db.session.query(func.count(UserBook.user_id.distinct()))
+            .filter(UNRETURNED).scalar(),
+        'forum_posts_count': db.session.query(func.count(ForumPost.id)).scalar(),
+    }
+
+
+def active_borrow_count(user_id, limit=2):
+    """Count a user's unreturned books, stopping after `limit` rows"""
+    rows = db.session.query(UserBook.id).filter(
+        UserBook.user_id == user_id,
+        UNRETURNED
+    ).limit(limit).all()
+    return len(rows)
+
+
+class StatsCache:
+    """
+    In-process cache of the home page counters
+
+    Write routes adjust the counters in place, so reads within the TTL
+    never touch the database. Once the TTL expires the next read
+    reconciles every counter against the database, which also bounds the
+    drift between worker processes that only see their own writes.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._counts = None
+        self._loaded_at = 0.0
+
+    def is_loaded(self):
+        return self._counts is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def get(self):
+        """Return a snapshot of the counters, reconciling if stale"""
+        if not self.is_loaded():
+            self.reconcile()
+        with self._lock:
+            return dict(self._counts)
+
+    def reconcile(self):
+        """Reload every counter from the database"""
+        counts = query_counts()
+        with self._lock:
+            self._counts = counts
+            self._loaded_at = time.monotonic()
+
+    def adjust(self, name, delta=1):
+        """Apply an incremental change; a no-op until the cache is loaded"""
+        with self._lock:
+            if self._counts is not None:
+                self._counts[name] = max(0, self._counts[name] + delta)
+
+    def invalidate(self):
+        with self._lock:
+            self._counts = None
+
+    def borrow_started(self, user_id, count=1):
+        """Call after committing `count` new UserBooks for user_id"""
+        if self.is_loaded() and active_borrow_count(user_id, limit=count + 1) == count:
+            self.adjust('active_borrowers', 1)
+
+    def borrow_ended(self, user_id):
+        """Call after committing a return for user_id"""
+        if self.is_loaded() and active_borrow_count(user_id) == 0:
+            self.adjust('active_borrowers', -1)
+
+
+stats = StatsCache()
+
+
+def init_app(app):
+    app.config.setdefault('STATS_TTL', 300)
+    stats.ttl = app.config['STATS_TTL']
@@ -0,0 +1,72 @@
+"""
+Shared fixtures
+
+The app is built once, at import, from the environment, so the settings
+below are in place before anything imports app. Every test gets an
+empty SQLite database and cold in-process caches.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORKDIR = tempfile.mkdtemp(prefix='library-tests-')
+for name in ('VERCEL', 'DB_SERVERLESS', 'USER_CACHE_URL', 'LIVE_EVENTS_URL', 'MAIL_SERVER'):
+    os.environ.pop(name, None)
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(WORKDIR, 'test.db')}",
+    'SECRET_KEY': 'test',
+    'QUERY_COUNT_HEADER': '1',
+    'SEARCH_INDEX_PATH': os.path.join(WORKDIR, 'search.db'),
+    # Uploads and renditions stay out of the source tree
+    'IMAGE_UPLOAD_FOLDER': os.path.join(WORKDIR, 'forum_uploads'),
+    'IMAGE_RAW_FOLDER': os.path.join(WORKDIR, 'raw'),
+    # Tests drive the outbox and image pipeline themselves
+    'EMAIL_WORKERS': '0',
+    'IMAGE_WORKERS': '0',
+    # Inline and cheap: no forked pool inheriting the tests' sockets
+    'PASSWORD_HASH_WORKERS': '0',
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+})
+
+
+@pytest.fixture
+def app():
+    from app import app
+    from extensions import db
+    import passwords
+    from http_cache import fragments
+    from stats import stats
+    from user_cache import user_cache
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    fragments.clear()
+    stats.invalidate()
+    user_cache.clear()
+    for limiter in (passwords.login_ip_limiter, passwords.login_username_limiter,
+                    passwords.register_ip_limiter):
+        limiter.clear()
+    passwords.login_account_backoff.clear()
+    # No app context stays pushed, so each request gets its own g and
+    # session, exactly as in production
+    yield app
+    with app.app_context():
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def log_in(client, user_id):
+    """Sign the test client in as user_id without going through /login"""
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
@@ -0,0 +1,37 @@
+"""Fingerprinted assets are served precompressed and cached immutably"""
+import pytest
+
+import assets
+
+
+@pytest.mark.parametrize('accept, encoding', [
+    ('br, gzip', 'br'),
+    ('gzip', 'gzip'),
+    ('identity', None),
+])
+def test_dist_assets_negotiate_the_committed_encodings(client, accept, encoding):
+    url = f"/static/{assets.manifest['css/style.css']}"
+    response = client.get(url, headers={'Accept-Encoding': accept})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == encoding
+    assert response.mimetype == 'text/css'
+    assert 'Accept-Encoding' in response.vary
+    assert response.cache_control.immutable
+
+
+def test_committed_build_is_up_to_date(app):
+    assert assets.stale(app.static_folder, assets.manifest) == []
+
+
+def test_uploads_are_served_from_the_upload_folder(app, client):
+    import os
+
+    folder = app.config['IMAGE_UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'abc_thumb.jpg'), 'wb') as f:
+        f.write(b'\xff\xd8\xff')
+    response = client.get('/static/forum_uploads/abc_thumb.jpg')
+    assert response.status_code == 200
+    assert response.data == b'\xff\xd8\xff'
+    assert response.cache_control.immutable
+    assert not os.path.exists(os.path.join(app.static_folder, 'forum_uploads', 'abc_thumb.jpg'))
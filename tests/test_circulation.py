@@ -0,0 +1,132 @@
+"""
+Concurrent checkouts never lend a copy twice
+
+Threads race through circulation.checkout against a title with fewer
+copies than borrowers, each in its own app context and connection, and
+the copy counts must add up afterwards. benchmarks/circulation.py runs
+the same races at length, and against MySQL.
+"""
+import threading
+
+import pytest
+
+COPIES = 3
+THREADS = 8
+
+
+@pytest.fixture
+def hot_title(app):
+    """A title with COPIES copies and two users per thread"""
+    from extensions import db
+    from models import Book, User
+
+    with app.app_context():
+        users = [User(username=f'reader{i}', email=f'reader{i}@example.com', password='x')
+                 for i in range(THREADS * 2)]
+        book = Book(title='Hot Title', author='Popular Author', availability=True,
+                    copies_total=COPIES, copies_available=COPIES)
+        db.session.add_all(users + [book])
+        db.session.commit()
+        return book.id, [user.id for user in users]
+
+
+def race(app, worker):
+    """Start worker(index) in THREADS threads at once; returns their exceptions"""
+    from extensions import db
+
+    start = threading.Barrier(THREADS)
+    errors = []
+
+    def run(index):
+        with app.app_context():
+            start.wait()
+            try:
+                worker(index)
+            except Exception as e:
+                db.session.rollback()
+                errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def copy_counts(app, book_id):
+    from sqlalchemy import func
+
+    from extensions import db
+    from models import Book, BookHold, BorrowedBook
+
+    with app.app_context():
+        book = db.session.get(Book, book_id)
+        loans = db.session.query(func.count(BorrowedBook.id)).filter(
+            BorrowedBook.book_id == book_id, BorrowedBook.return_date.is_(None)).scalar()
+        ready = db.session.query(func.count(BookHold.id)).filter(
+            BookHold.book_id == book_id, BookHold.status == 'ready').scalar()
+        return book.copies_total, book.copies_available, loans, ready
+
+
+def test_rush_lends_each_copy_once(app, hot_title):
+    import circulation
+
+    book_id, user_ids = hot_title
+    lent, refused = [], []
+
+    def borrow(index):
+        for _ in range(5):
+            try:
+                lent.append(circulation.checkout(book_id, user_ids[index]).id)
+            except circulation.CirculationError:
+                refused.append(index)
+
+    assert race(app, borrow) == []
+    assert len(lent) == COPIES
+    assert len(refused) == THREADS * 5 - COPIES
+    total, available, loans, ready = copy_counts(app, book_id)
+    assert (available, loans, ready) == (0, COPIES, 0)
+
+
+def test_borrow_return_churn_keeps_counts(app, hot_title):
+    import circulation
+    from extensions import db
+    from models import BookHold
+
+    book_id, user_ids = hot_title
+    checkouts = []
+
+    def churn(index):
+        # Every fourth thread waits on a hold and borrows the copy set
+        # aside for it; the rest borrow and return straight away
+        waiter = index % 4 == 0
+        user_id = user_ids[THREADS + index] if waiter else user_ids[index]
+        for _ in range(20):
+            if waiter:
+                status = db.session.query(BookHold.status).filter(
+                    BookHold.user_id == user_id,
+                    BookHold.status.in_(circulation.ACTIVE_HOLD_STATUSES)
+                ).scalar()
+                db.session.rollback()
+                if status == 'waiting':
+                    continue
+                if status is None:
+                    try:
+                        circulation.place_hold(book_id, user_id)
+                        continue
+                    except circulation.CirculationError:
+                        pass  # a copy is on the shelf, borrow it
+            try:
+                loan = circulation.checkout(book_id, user_id)
+            except circulation.CirculationError:
+                continue
+            checkouts.append(loan.id)
+            circulation.return_loan(loan.id, user_id)
+
+    assert race(app, churn) == []
+    assert checkouts
+    total, available, loans, ready = copy_counts(app, book_id)
+    assert available >= 0
+    assert loans == 0
+    assert available + ready == total == COPIES
@@ -0,0 +1,23 @@
+"""/metrics is hidden without a token and guarded by it otherwise"""
+import pytest
+
+
+@pytest.fixture
+def token(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'secret')
+    return 'secret'
+
+
+def test_hidden_without_a_token(client):
+    assert client.get('/metrics').status_code == 404
+
+
+@pytest.mark.parametrize('header', ['', 'Bearer wrong', 'Bearer café'])
+def test_refuses_other_credentials(client, token, header):
+    assert client.get('/metrics', headers={'Authorization': header}).status_code == 403
+
+
+def test_serves_with_the_token(client, token):
+    response = client.get('/metrics', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    assert b'rate_limit_refused_total' in response.data
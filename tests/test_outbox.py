@@ -0,0 +1,186 @@
+"""
+The email outbox, drained against a local SMTP sink
+
+Mail is queued in the same transaction as the write it announces and
+delivered by outbox.drain(); these tests call drain() directly, since
+EMAIL_WORKERS is 0 under test.
+"""
+import socket
+from datetime import datetime, timedelta
+
+import pytest
+
+controller = pytest.importorskip('aiosmtpd.controller')
+
+from conftest import log_in
+
+
+class Sink:
+    """aiosmtpd handler that keeps what it receives, or refuses it"""
+
+    def __init__(self):
+        self.messages = []
+        self.refuse = False
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.refuse:
+            return '451 Try again later'
+        self.messages.append(envelope)
+        return '250 OK'
+
+
+def point_mail_at(app, **config):
+    """Change MAIL_* settings; Flask-Mail is set up again on the next send"""
+    app.config.update(config)
+    app.extensions.pop('mail', None)
+
+
+@pytest.fixture
+def sink(app):
+    handler = Sink()
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    smtp = controller.Controller(handler, hostname='127.0.0.1', port=port)
+    smtp.start()
+    saved = {name: app.config[name] for name in ('MAIL_SERVER', 'MAIL_PORT', 'MAIL_USE_TLS',
+                                                  'MAIL_DEFAULT_SENDER', 'OUTBOX_MAX_ATTEMPTS')}
+    point_mail_at(app, MAIL_SERVER='127.0.0.1', MAIL_PORT=smtp.port, MAIL_USE_TLS=False,
+                  MAIL_DEFAULT_SENDER='library@example.com', OUTBOX_MAX_ATTEMPTS=3)
+    yield handler
+    smtp.stop()
+    point_mail_at(app, **saved)
+
+
+def outbox_rows(app):
+    from models import EmailOutbox
+
+    with app.app_context():
+        return EmailOutbox.query.order_by(EmailOutbox.id).all()
+
+
+def drain(app):
+    import outbox
+
+    with app.app_context():
+        return outbox.drain()
+
+
+def make_due(app):
+    from extensions import db
+    from models import EmailOutbox
+
+    with app.app_context():
+        EmailOutbox.query.update({'next_attempt_at': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+
+
+def register(client, username):
+    return client.post('/register', data={'username': username, 'email': f'{username}@example.com',
+                                          'password': 'secret'})
+
+
+def test_registration_queues_and_drain_delivers(app, client, sink):
+    assert register(client, 'reader').status_code == 302
+    [row] = outbox_rows(app)
+    assert (row.recipient, row.status) == ('reader@example.com', 'pending')
+
+    assert drain(app) == 1
+    [row] = outbox_rows(app)
+    assert row.status == 'sent' and row.sent_at is not None
+    [message] = sink.messages
+    assert message.rcpt_tos == ['reader@example.com']
+    assert b'Welcome to Our Library!' in message.content
+
+
+def test_failed_registration_queues_nothing(app, client, sink):
+    register(client, 'reader')
+    client.get('/logout')
+    register(client, 'reader')
+    assert len(outbox_rows(app)) == 1
+
+
+def test_borrowed_book_mail_is_queued_with_the_book(app, client, sink):
+    from extensions import db
+    from models import User
+
+    with app.app_context():
+        user = User(username='reader', email='reader@example.com', password='x')
+        db.session.add(user)
+        db.session.commit()
+        log_in(client, user.id)
+    client.post('/add_borrowed_book', data={'title': 'Dune', 'author': 'Herbert',
+                                            'due_date': '2030-01-01'})
+    [row] = outbox_rows(app)
+    assert row.subject == 'New Borrowed Book Notification'
+    assert drain(app) == 1
+    assert b'Dune' in sink.messages[0].content
+
+
+def test_refused_mail_backs_off_then_gives_up(app, client, sink):
+    base = app.config['OUTBOX_RETRY_BASE']
+    register(client, 'reader')
+    sink.refuse = True
+
+    for attempt in (1, 2):
+        started = datetime.utcnow()
+        assert drain(app) == 1
+        [row] = outbox_rows(app)
+        assert (row.status, row.attempts) == ('pending', attempt)
+        assert '451' in row.last_error
+        # Doubles every attempt
+        delay = (row.next_attempt_at - started).total_seconds()
+        assert base * 2 ** (attempt - 1) <= delay < base * 2 ** (attempt - 1) + 5
+        # Not due again until the backoff expires
+        assert drain(app) == 0
+        make_due(app)
+
+    assert drain(app) == 1
+    [row] = outbox_rows(app)
+    assert (row.status, row.attempts) == ('failed', 3)
+    make_due(app)
+    assert drain(app) == 0
+    assert sink.messages == []
+
+
+def test_retry_succeeds_once_the_server_accepts(app, client, sink):
+    register(client, 'reader')
+    sink.refuse = True
+    drain(app)
+    sink.refuse = False
+    make_due(app)
+
+    assert drain(app) == 1
+    [row] = outbox_rows(app)
+    assert (row.status, row.attempts) == ('sent', 1)
+    assert len(sink.messages) == 1
+
+
+def test_unreachable_server_retries_the_whole_batch(app, client, sink):
+    register(client, 'first')
+    client.get('/logout')
+    register(client, 'second')
+    # Nothing listens on port 1
+    point_mail_at(app, MAIL_PORT=1)
+
+    assert drain(app) == 2
+    assert [(row.status, row.attempts) for row in outbox_rows(app)] == [('pending', 1), ('pending', 1)]
+
+
+def test_inline_batch_sends_with_the_request(app, client, sink, monkeypatch):
+    # As on serverless hosts: no worker threads, a small batch per request
+    monkeypatch.setitem(app.config, 'OUTBOX_INLINE_BATCH', 5)
+    register(client, 'reader')
+
+    [row] = outbox_rows(app)
+    assert row.status == 'sent'
+    assert len(sink.messages) == 1
+
+
+def test_inline_send_never_fails_the_request(app, client, sink, monkeypatch):
+    monkeypatch.setitem(app.config, 'OUTBOX_INLINE_BATCH', 5)
+    point_mail_at(app, MAIL_PORT=1)
+
+    assert register(client, 'reader').status_code == 302
+    [row] = outbox_rows(app)
+    assert (row.status, row.attempts) == ('pending', 1)
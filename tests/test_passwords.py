@@ -0,0 +1,69 @@
+"""Login throttling: per-address limits and the per-account failure backoff"""
+import pytest
+from werkzeug.security import generate_password_hash
+
+from passwords import FailureBackoff
+
+
+def test_backoff_is_free_then_doubles_up_to_the_cap():
+    backoff = FailureBackoff(free=2, base=1, max_delay=4, window=900)
+    for now in (0, 1):
+        backoff.failed('reader', now=now)
+    assert backoff.check('reader', now=1) == 0
+
+    delays = []
+    now = 1
+    for _ in range(5):
+        backoff.failed('reader', now=now)
+        assert backoff.check('reader', now=now) > 0
+        wait = next(seconds for seconds in range(1, 10) if backoff.check('reader', now=now + seconds) == 0)
+        delays.append(wait)
+        now += wait
+    assert delays == [1, 2, 4, 4, 4]
+
+
+def test_backoff_forgets_after_the_window_and_on_reset():
+    backoff = FailureBackoff(free=0, base=10, max_delay=60, window=100)
+    backoff.failed('reader', now=0)
+    assert backoff.check('reader', now=5) > 0
+    assert backoff.check('reader', now=150) == 0
+    backoff.failed('reader', now=200)
+    backoff.reset('reader')
+    assert backoff.check('reader', now=200) == 0
+
+
+def test_guessing_from_many_addresses_is_slowed(app, client, monkeypatch):
+    import passwords
+    from extensions import db
+    from models import User
+
+    monkeypatch.setattr(passwords.login_account_backoff, 'free', 3)
+    with app.app_context():
+        db.session.add(User(username='reader', email='reader@example.com',
+                            password=generate_password_hash('right', 'pbkdf2:sha256:1000')))
+        db.session.commit()
+
+    def attempt(address, password):
+        return client.post('/login', data={'username': 'reader', 'password': password},
+                           environ_base={'REMOTE_ADDR': address})
+
+    for i in range(4):
+        assert attempt(f'10.0.0.{i}', 'wrong').status_code == 200
+    refused = attempt('10.0.1.1', 'right')
+    assert refused.status_code == 429
+    assert 1 <= int(refused.headers['Retry-After']) <= passwords.login_account_backoff.max_delay
+
+
+def test_pool_that_cannot_start_is_busy_not_an_error(monkeypatch):
+    import passwords
+
+    hasher = passwords.PasswordHasher()
+    hasher.configure('pbkdf2:sha256:1000', workers=2, queue_size=2, timeout=5)
+
+    def no_processes(*args, **kwargs):
+        raise OSError('process creation is not allowed')
+
+    monkeypatch.setattr(passwords, 'ProcessPoolExecutor', no_processes)
+    with pytest.raises(passwords.HashingBusy):
+        hasher.hash('secret')
+    assert hasher.counters()['in_flight'] == 0
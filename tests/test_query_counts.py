@@ -0,0 +1,80 @@
+"""
+Queries per page stay fixed however much data there is
+
+Each page is requested cold (empty caches) against a small and a larger
+seed; the X-Query-Count header must be the same constant for both, so
+an N+1 sneaking back into a view fails here.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import log_in
+
+
+def seed(app, scale):
+    """Users, forum posts with comments, catalog loans and holds, borrowed books"""
+    from extensions import db
+    from models import Book, BookHold, BorrowedBook, ForumComment, ForumPost, User, UserBook
+
+    now = datetime.utcnow()
+    today = now.date()
+    with app.app_context():
+        users = [User(username=f'user{i}', email=f'user{i}@example.com', password='x')
+                 for i in range(scale)]
+        db.session.add_all(users)
+        db.session.flush()
+        books = [Book(title=f'Book {i}', author=f'Author {i}', availability=True)
+                 for i in range(scale)]
+        db.session.add_all(books)
+        db.session.flush()
+        for i in range(scale * 5):
+            post = ForumPost(user_id=users[i % scale].id, title=f'Post {i}', content='Text',
+                             date_posted=now - timedelta(minutes=i), comment_count=scale)
+            db.session.add(post)
+            db.session.flush()
+            db.session.add_all(ForumComment(post_id=post.id, user_id=users[j].id, content=f'Comment {j}',
+                                            date_posted=now - timedelta(seconds=j))
+                               for j in range(scale))
+        reader = users[0]
+        db.session.add_all(UserBook(user_id=reader.id, book_title=f'Borrowed {i}', author='Author',
+                                    borrow_date=today, due_date=today + timedelta(days=i - 2))
+                           for i in range(scale))
+        db.session.add_all(BorrowedBook(user_id=reader.id, book_id=book.id, borrow_date=today,
+                                        due_date=today + timedelta(days=14))
+                           for book in books[:scale // 2])
+        db.session.add_all(BookHold(user_id=reader.id, book_id=book.id)
+                           for book in books[scale // 2:])
+        db.session.commit()
+        return reader.id
+
+
+def query_count(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    return int(response.headers['X-Query-Count'])
+
+
+# path -> queries for a signed-in reader on a cold cache, each counting
+# the user loader's one miss
+EXPECTED = {
+    # the statistics cache's four counts
+    '/': 5,
+    # feed version, posts, card versions, comments, authors
+    '/forum': 6,
+    # version stamp, borrowed books, loans and holds with their titles
+    '/borrowed_books': 7,
+}
+
+
+@pytest.mark.parametrize('path', sorted(EXPECTED))
+@pytest.mark.parametrize('scale', [4, 12])
+def test_queries_do_not_grow_with_data(app, client, path, scale):
+    log_in(client, seed(app, scale))
+    assert query_count(client, path) == EXPECTED[path]
+
+
+def test_warm_forum_skips_card_queries(app, client):
+    log_in(client, seed(app, 4))
+    cold = query_count(client, '/forum')
+    assert query_count(client, '/forum') < cold
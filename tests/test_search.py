@@ -0,0 +1,52 @@
+"""Search through the FTS5 index and straight against the database"""
+import pytest
+
+import search_index
+
+
+@pytest.fixture
+def catalog(app):
+    from extensions import db
+    from models import Book, ForumComment, ForumPost, User
+
+    with app.app_context():
+        user = User(username='reader', email='reader@example.com', password='x')
+        book = Book(title='Café Society', author='Charlotte Brontë', availability=True)
+        db.session.add_all([user, book])
+        db.session.flush()
+        post = ForumPost(user_id=user.id, title='Reading list', content='Anything')
+        db.session.add(post)
+        db.session.flush()
+        db.session.add_all(ForumComment(post_id=post.id, user_id=user.id, content=f'society meeting {i}')
+                           for i in range(6))
+        db.session.commit()
+        return book.id
+
+
+@pytest.fixture
+def database_search(app, monkeypatch):
+    monkeypatch.setattr(search_index, 'backend', search_index.DatabaseSearch(rank_window=3))
+    return search_index.backend
+
+
+@pytest.mark.parametrize('query', ['café', 'Brontë', 'café SOCIETY'])
+def test_database_search_matches_accented_text(app, catalog, database_search, query):
+    with app.app_context():
+        results, _ = database_search.search(query, kind='book')
+    assert [(result['kind'], result['ref_id']) for result in results] == [('book', catalog)]
+    assert '<mark>' in results[0]['title'] or '<mark>' in results[0]['snippet']
+
+
+def test_index_ranks_each_kind_in_its_own_window(app, catalog):
+    from models import Book, ForumComment
+
+    with app.app_context():
+        search_index.rebuild()
+        index = search_index.index
+        window, index.rank_window = index.rank_window, 3
+        try:
+            results, _ = index.search('society', per_page=3)
+        finally:
+            index.rank_window = window
+    # Newer comments outnumber the window, but the title match still ranks first
+    assert (results[0]['kind'], results[0]['ref_id'], results[0]['ranked']) == ('book', catalog, True)
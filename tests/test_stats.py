@@ -0,0 +1,46 @@
+"""Borrow counters treat a NULL is_returned as still on loan"""
+from datetime import date
+
+import pytest
+
+
+@pytest.fixture
+def borrower(app):
+    from sqlalchemy import update
+
+    from extensions import db
+    from models import User, UserBook
+
+    with app.app_context():
+        user = User(username='borrower', email='borrower@example.com', password='x')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add_all(
+            UserBook(user_id=user.id, book_title=title, author='Author', borrow_date=date(2026, 1, 1),
+                     due_date=date(2026, 1, 15), is_returned=returned)
+            for title, returned in [('Legacy', False), ('Current', False), ('Done', True)]
+        )
+        db.session.flush()
+        # The column default fills in inserts, so NULL only comes from an update
+        db.session.execute(update(UserBook).where(UserBook.book_title == 'Legacy')
+                           .values(is_returned=None))
+        db.session.commit()
+        return user.id
+
+
+def test_active_borrow_count_includes_null_rows(app, borrower):
+    import stats
+
+    with app.app_context():
+        assert stats.active_borrow_count(borrower, limit=5) == 2
+
+
+def test_active_borrowers_includes_null_rows(app, borrower):
+    import stats
+    from extensions import db
+    from models import UserBook
+
+    with app.app_context():
+        UserBook.query.filter(UserBook.is_returned == False).delete()  # noqa: E712
+        db.session.commit()
+        assert stats.query_counts()['active_borrowers'] == 1
@@ -0,0 +1,220 @@
+import hashlib
+import logging
+import os
+import uuid
+import warnings
+
+from flask import current_app
+from sqlalchemy import update, delete, select
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import StoredUpload
+from image_pipeline import RENDITIONS, FORMATS, rendition_filename, raw_path
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+ALLOWED_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+
+class UploadRejected(ValueError):
+    """The upload breaks the byte, pixel or format budget"""
+
+
+class StagedUpload:
+    """An upload hashed into a temporary file, not yet published"""
+
+    def __init__(self, digest, tmp_path, size, width, height):
+        self.digest = digest
+        self.tmp_path = tmp_path
+        self.size = size
+        self.width = width
+        self.height = height
+        self.published_new = False
+
+    def publish(self, is_new=False):
+        """Move the file to its content address, replacing any copy there"""
+        os.replace(self.tmp_path, raw_path(self.digest))
+        self.published_new = is_new
+
+    def discard(self):
+        """
+        Undo staging after a failed transaction
+
+        Call before rolling back: a raw file published for a row this
+        transaction inserted is removed while the row lock still keeps a
+        concurrent upload of the same content from publishing it again.
+        """
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        if self.published_new:
+            remove_files(self.digest)
+            self.published_new = False
+
+
+def stage_upload(file):
+    """
+    Stream an upload to disk while hashing it and enforcing the budgets
+
+    The byte limit is checked chunk by chunk, so an oversized file is
+    rejected after MAX_UPLOAD_BYTES rather than after being read whole.
+    The pixel limit is checked from the image header alone, before any
+    pixel data is decoded, which stops decompression bombs.
+    """
+    config = current_app.config
+    os.makedirs(config['IMAGE_RAW_FOLDER'], exist_ok=True)
+    tmp_path = raw_path(f"{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = file.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > config['MAX_UPLOAD_BYTES']:
+                    raise UploadRejected('Image is too large.')
+                digest.update(chunk)
+                out.write(chunk)
+        width, height = read_dimensions(tmp_path)
+        if width * height > config['MAX_IMAGE_PIXELS']:
+            raise UploadRejected('Image dimensions are too large.')
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return StagedUpload(digest.hexdigest(), tmp_path, size, width, height)
+
+
+def read_dimensions(path):
+    """Read (width, height) from the image header without decoding"""
+    from PIL import Image, UnidentifiedImageError
+
+    # Header parsing only; MAX_IMAGE_PIXELS is checked by the caller, so
+    # Pillow's own bomb warning is silenced here rather than process-wide
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            with Image.open(path) as img:
+                if img.format not in ALLOWED_FORMATS:
+                    raise UploadRejected('Unsupported image format.')
+                return img.size
+    except Image.DecompressionBombError:
+        raise UploadRejected('Image dimensions are too large.')
+    except UnidentifiedImageError:
+        raise UploadRejected('File is not a valid image.')
+
+
+def acquire(staged):
+    """
+    Add a reference to an upload's content inside the current transaction
+
+    Increments the refcount with a single UPDATE (inserting the row on
+    first use) and then publishes the file. The row lock is held until
+    commit, so a concurrent remove_orphaned waits and then finds the row.
+    If the transaction fails, call staged.discard() before rolling back.
+
+    Returns:
+        True if the content had no live references, i.e. its renditions
+        still have to be built
+    """
+    def increment():
+        return db.session.execute(
+            update(StoredUpload)
+            .where(StoredUpload.digest == staged.digest)
+            .values(refcount=StoredUpload.refcount + 1)
+        ).rowcount
+
+    if increment():
+        refcount = db.session.get(StoredUpload, staged.digest, populate_existing=True).refcount
+        is_new = refcount == 1
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.add(StoredUpload(
+                    digest=staged.digest, refcount=1, size_bytes=staged.size,
+                    width=staged.width, height=staged.height
+                ))
+        except IntegrityError:
+            # Another request inserted the same content first
+            increment()
+            is_new = False
+        else:
+            is_new = True
+    staged.publish(is_new)
+    return is_new
+
+
+def release(digest):
+    """
+    Drop a reference inside the current transaction
+
+    Files are never touched here: when the last reference goes the row
+    is deleted, and the caller passes the digest to remove_orphaned once
+    the transaction has committed.
+
+    Returns:
+        True if the content is now unreferenced
+    """
+    db.session.execute(
+        update(StoredUpload)
+        .where(StoredUpload.digest == digest)
+        .values(refcount=StoredUpload.refcount - 1)
+    )
+    orphaned = db.session.execute(
+        delete(StoredUpload)
+        .where(StoredUpload.digest == digest, StoredUpload.refcount <= 0)
+    ).rowcount
+    return bool(orphaned)
+
+
+def remove_orphaned(digest):
+    """
+    Remove an unreferenced upload's files after the release has committed
+
+    The row is looked up with a locking read first, so an upload of the
+    same content that is in flight (or already committed) keeps its files.
+    """
+    try:
+        in_use = db.session.execute(
+            select(StoredUpload.digest)
+            .where(StoredUpload.digest == digest)
+            .with_for_update()
+        ).first()
+        if not in_use:
+            remove_files(digest)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error removing upload {digest}: {str(e)}")
+
+
+def remove_files(digest):
+    out_dir = current_app.config['IMAGE_UPLOAD_FOLDER']
+    paths = [raw_path(digest)] + [
+        os.path.join(out_dir, rendition_filename(digest, rendition, fmt))
+        for rendition in RENDITIONS for fmt in FORMATS
+    ]
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_legacy_file(filename):
+    """Delete a photo stored before content addressing (one file per post)"""
+    path = os.path.join(current_app.config['IMAGE_UPLOAD_FOLDER'], filename)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def init_app(app):
+    app.config.setdefault('MAX_UPLOAD_BYTES', 16 * 1024 * 1024)
+    app.config.setdefault('MAX_IMAGE_PIXELS', 50_000_000)
+    # Let Werkzeug refuse oversized request bodies before parsing them;
+    # the slack leaves room for the other form fields
+    app.config.setdefault('MAX_CONTENT_LENGTH', app.config['MAX_UPLOAD_BYTES'] + 1024 * 1024)
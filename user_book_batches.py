@@ -0,0 +1,289 @@
+"""
+Batched operations on a reader's borrowed-books list
+
+Backs the JSON API for clients and library kiosks that sync many
+records at once. A batch is validated as a whole and then written in
+one transaction with one multi-row INSERT or one UPDATE, plus a single
+version bump, rollup update and notification email, so syncing N books
+costs one round-trip instead of N form posts and N commits.
+"""
+from collections import defaultdict
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import and_, insert, or_, select, update
+
+from extensions import db
+from models import UserBook
+from email_service import register_template, send_templated_email
+from http_cache import bump, user_books_key
+import analytics
+
+MAX_TEXT_LENGTH = 255
+
+BORROWED_BATCH_EMAIL_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <style>
+        body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; }
+        .header { background: #f8f9fa; padding: 20px; text-align: center; }
+        .content { padding: 20px; }
+        .footer { background: #f8f9fa; padding: 20px; text-align: center; }
+        .book-details { background: #f1f1f1; padding: 15px; border-radius: 5px; }
+    </style>
+</head>
+<body>
+    <div class="header">
+        <h1>Borrowed Books Added</h1>
+    </div>
+    <div class="content">
+        <h2>Hello {{username}},</h2>
+        <p>{{books|length}} books were added to your borrowed list:</p>
+
+        <div class="book-details">
+            {% for book in books %}
+            <p><strong>{{book.book_title}}</strong> by {{book.author}}<br>
+               Borrowed {{book.borrow_date}}, due {{book.due_date}}</p>
+            {% endfor %}
+        </div>
+
+        <p>Please remember to return the books by their due dates.</p>
+    </div>
+    <div class="footer">
+        <p>Best regards,<br>Your Library Team</p>
+    </div>
+</body>
+</html>
+"""
+register_template('borrowed_books_batch', 'New Borrowed Books Notification', BORROWED_BATCH_EMAIL_TEMPLATE)
+
+STATUSES = ('active', 'returned', 'overdue')
+
+
+class BatchRejected(ValueError):
+    """A batch that fails validation; nothing was written"""
+
+    def __init__(self, message, errors=()):
+        super().__init__(message)
+        self.errors = list(errors)
+
+
+def parse_date(value, field):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} must be a YYYY-MM-DD date')
+
+
+def parse_text(item, field, required=True):
+    value = item.get(field)
+    if value is None and not required:
+        return None
+    if not isinstance(value, str) or (required and not value.strip()):
+        raise ValueError(f'{field} is required')
+    value = value.strip()
+    if field != 'notes' and len(value) > MAX_TEXT_LENGTH:
+        raise ValueError(f'{field} is longer than {MAX_TEXT_LENGTH} characters')
+    return value
+
+
+def validate_book(item, user_id, today):
+    """Turn one request item into a user_books row, or raise ValueError"""
+    if not isinstance(item, dict):
+        raise ValueError('each book must be an object')
+    borrow_date = parse_date(item['borrow_date'], 'borrow_date') if item.get('borrow_date') else today
+    due_date = parse_date(item.get('due_date'), 'due_date')
+    if due_date < borrow_date:
+        raise ValueError('due_date is before borrow_date')
+    return {
+        'user_id': user_id,
+        'book_title': parse_text(item, 'title'),
+        'author': parse_text(item, 'author'),
+        'borrow_date': borrow_date,
+        'due_date': due_date,
+        'is_returned': False,
+        'notes': parse_text(item, 'notes', required=False),
+    }
+
+
+def check_size(items, name):
+    limit = current_app.config['API_BATCH_LIMIT']
+    if not isinstance(items, list) or not items:
+        raise BatchRejected(f'{name} must be a non-empty list')
+    if len(items) > limit:
+        raise BatchRejected(f'at most {limit} {name} per request')
+
+
+ROW_KEY = ('user_id', 'book_title', 'author', 'borrow_date', 'due_date')
+
+
+def insert_rows(rows):
+    """
+    Insert user_books rows with one multi-row INSERT
+
+    Auto-increment ids need not be consecutive (auto_increment_increment,
+    interleaved lock mode), so ids are matched back to rows by content:
+    from RETURNING where the database has it, otherwise by re-reading
+    the rows from LAST_INSERT_ID() on in the same transaction. Identical
+    rows in one batch take their ids in VALUES order, which a single
+    statement allocates in ascending order; at worst a concurrent batch
+    from the same reader with identical rows swaps ids between copies.
+
+    Returns:
+        The new ids, in the order of rows
+    """
+    columns = [UserBook.id] + [getattr(UserBook, name) for name in ROW_KEY]
+    stmt = insert(UserBook).values(rows)
+    if db.engine.dialect.insert_returning:
+        inserted = db.session.execute(stmt.returning(*columns)).all()
+    else:
+        # MySQL has no RETURNING; LAST_INSERT_ID() is the first row's id
+        # and every later id in the statement is larger
+        first_id = db.session.execute(stmt).lastrowid
+        user_ids = sorted({row['user_id'] for row in rows})
+        inserted = db.session.execute(
+            select(*columns).where(UserBook.id >= first_id, UserBook.user_id.in_(user_ids))
+        ).all()
+
+    ids = defaultdict(list)
+    for book in sorted(inserted, key=lambda book: book.id, reverse=True):
+        ids[tuple(getattr(book, name) for name in ROW_KEY)].append(book.id)
+    return [ids[tuple(row[name] for name in ROW_KEY)].pop() for row in rows]
+
+
+def add_books(user, items, today=None):
+    """
+    Add a batch of borrowed books for a user in one transaction
+
+    Returns:
+        The new UserBook rows, detached and in request order
+    """
+    today = today or datetime.utcnow().date()
+    check_size(items, 'books')
+    rows, errors = [], []
+    for position, item in enumerate(items):
+        try:
+            rows.append(validate_book(item, user.id, today))
+        except (KeyError, ValueError) as e:
+            errors.append({'index': position, 'error': str(e)})
+    if errors:
+        raise BatchRejected('some books are invalid', errors)
+
+    ids = insert_rows(rows)
+    books = [UserBook(id=book_id, **row) for book_id, row in zip(ids, rows)]
+    analytics.record_borrows(books)
+    bump(user_books_key(user.id))
+    send_templated_email(
+        'borrowed_books_batch', [user.email], commit=False, username=user.username,
+        books=[{'book_title': row['book_title'], 'author': row['author'],
+                'borrow_date': row['borrow_date'].strftime('%Y-%m-%d'),
+                'due_date': row['due_date'].strftime('%Y-%m-%d')} for row in rows]
+    )
+    db.session.commit()
+    return books
+
+
+def return_books(user_id, ids, today=None):
+    """
+    Mark a batch of a user's books returned in one transaction
+
+    Returns:
+        Dict of id lists: 'returned', 'already_returned' and 'not_found'
+        (which includes other users' books)
+    """
+    today = today or datetime.utcnow().date()
+    check_size(ids, 'ids')
+    if not all(isinstance(book_id, int) and not isinstance(book_id, bool) for book_id in ids):
+        raise BatchRejected('ids must be integers')
+    wanted = list(dict.fromkeys(ids))
+
+    # Locked so a concurrent return of the same book cannot count twice
+    books = db.session.execute(
+        select(UserBook).where(UserBook.id.in_(wanted), UserBook.user_id == user_id)
+        .with_for_update()
+    ).scalars().all()
+    found = {book.id: book for book in books}
+    pending = [book for book in books if not book.is_returned]
+    if pending:
+        db.session.execute(
+            update(UserBook).where(UserBook.id.in_([book.id for book in pending]))
+            .values(is_returned=True, return_date=today)
+            .execution_options(synchronize_session=False)
+        )
+        deltas = analytics.Deltas()
+        for book in pending:
+            deltas.give_back(book.user_id, book.borrow_date, book.due_date, today)
+        analytics.apply(deltas)
+        bump(user_books_key(user_id))
+    db.session.commit()
+    returned = {book.id for book in pending}
+    return {
+        'returned': [book_id for book_id in wanted if book_id in returned],
+        'already_returned': [book_id for book_id in wanted if book_id in found and book_id not in returned],
+        'not_found': [book_id for book_id in wanted if book_id not in found],
+    }
+
+
+def encode_cursor(book):
+    return f"{book.borrow_date.isoformat()}_{book.id}"
+
+
+def decode_cursor(cursor):
+    day, _, book_id = cursor.partition('_')
+    return parse_date(day, 'cursor'), int(book_id)
+
+
+def list_books(user_id, status=None, due_before=None, cursor=None, limit=50, today=None):
+    """
+    One page of a user's books, newest borrow first
+
+    Walks ix_user_books_user_borrow_date with a (borrow_date, id) keyset
+    cursor, so deep pages cost the same as the first.
+
+    Returns:
+        Tuple of (books, next_cursor); next_cursor is None on the last page
+    """
+    today = today or datetime.utcnow().date()
+    query = UserBook.query.filter(UserBook.user_id == user_id)
+    if status == 'active':
+        query = query.filter(UserBook.is_returned == False)
+    elif status == 'returned':
+        query = query.filter(UserBook.is_returned == True)
+    elif status == 'overdue':
+        query = query.filter(UserBook.is_returned == False, UserBook.due_date < today)
+    if due_before:
+        query = query.filter(UserBook.due_date < due_before)
+    if cursor:
+        borrow_date, book_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            UserBook.borrow_date < borrow_date,
+            and_(UserBook.borrow_date == borrow_date, UserBook.id < book_id)
+        ))
+    books = query.order_by(UserBook.borrow_date.desc(), UserBook.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(books) > limit:
+        books = books[:limit]
+        next_cursor = encode_cursor(books[-1])
+    return books, next_cursor
+
+
+def book_json(book, today=None):
+    today = today or datetime.utcnow().date()
+    return {
+        'id': book.id,
+        'title': book.book_title,
+        'author': book.author,
+        'borrow_date': book.borrow_date.isoformat(),
+        'due_date': book.due_date.isoformat(),
+        'return_date': book.return_date.isoformat() if book.return_date else None,
+        'is_returned': bool(book.is_returned),
+        'overdue': not book.is_returned and book.due_date < today,
+        'notes': book.notes,
+    }
+
+
+def init_app(app):
+    app.config.setdefault('API_BATCH_LIMIT', 500)
+    app.config.setdefault('API_PAGE_SIZE', 50)
+    app.config.setdefault('API_MAX_PAGE_SIZE', 200)
@@ -0,0 +1,192 @@
+"""
+Identity cache behind Flask-Login's user loader
+
+Every authenticated request used to load its user with a primary-key
+query. Column values are cached instead, in a bounded in-process LRU
+with a TTL and, when USER_CACHE_URL points at Redis, a shared tier that
+every worker process sees. A hit rebuilds the User without a round-trip;
+relationships still load lazily on first access.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+
+from extensions import db
+from models import User
+
+logger = logging.getLogger(__name__)
+
+
+def to_entry(user):
+    # The password hash is left out so it never reaches the shared tier;
+    # reading it from a cached user loads it on demand
+    return {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'created_at': user.created_at.isoformat() if user.created_at else None,
+    }
+
+def from_entry(entry):
+    """Build a persistent User from cached columns without a query"""
+    entry = dict(entry)
+    if entry['created_at']:
+        entry['created_at'] = datetime.fromisoformat(entry['created_at'])
+    user = User(**entry)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+class RedisBackend:
+    """Shared tier; entries expire on their own after the TTL"""
+
+    def __init__(self, url, prefix='user:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, user_id):
+        value = self.client.get(f"{self.prefix}{user_id}")
+        return json.loads(value) if value is not None else None
+
+    def set(self, user_id, entry, ttl):
+        self.client.set(f"{self.prefix}{user_id}", json.dumps(entry), ex=ttl)
+
+    def delete(self, user_ids):
+        self.client.delete(*[f"{self.prefix}{user_id}" for user_id in user_ids])
+
+
+class UserCache:
+    """
+    Bounded LRU of user columns with a TTL and an optional shared tier
+
+    Updates and deletes of a User invalidate its entry when the session
+    commits. Another process's local copy can lag for at most the TTL,
+    unless it reads through the shared tier.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = self.shared_hits = self.misses = 0
+
+    def _get_local(self, user_id):
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item is None:
+                return None
+            entry, expires_at = item
+            if time.monotonic() >= expires_at:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+
+    def _put_local(self, user_id, entry):
+        with self._lock:
+            self._entries[user_id] = (entry, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _get_shared(self, user_id):
+        try:
+            return self.backend.get(user_id)
+        except Exception as e:
+            logger.error(f"User cache backend read failed: {str(e)}")
+            return None
+
+    def load(self, user_id):
+        """Return the User for user_id, or None if it does not exist"""
+        entry = self._get_local(user_id)
+        if entry is None and self.backend is not None:
+            entry = self._get_shared(user_id)
+            if entry is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                self._put_local(user_id, entry)
+        if entry is not None:
+            return from_entry(entry)
+
+        with self._lock:
+            self.misses += 1
+        user = db.session.get(User, user_id)
+        if user is not None:
+            self.store(user)
+        return user
+
+    def store(self, user):
+        entry = to_entry(user)
+        self._put_local(user.id, entry)
+        if self.backend is not None:
+            try:
+                self.backend.set(user.id, entry, self.ttl)
+            except Exception as e:
+                logger.error(f"User cache backend write failed: {str(e)}")
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+        if self.backend is not None and user_ids:
+            try:
+                self.backend.delete(user_ids)
+            except Exception as e:
+                logger.error(f"User cache backend delete failed: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def counters(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+            }
+
+
+user_cache = UserCache()
+
+
+# Invalidation: changed users are collected during flush and dropped
+# once the transaction commits, so a rollback leaves the cache alone
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_user_ids', set()).add(target.id)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    user_ids = session.info.pop('changed_user_ids', None)
+    if user_ids:
+        user_cache.invalidate(list(user_ids))
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('changed_user_ids', None)
+
+
+def init_app(app):
+    app.config.setdefault('USER_CACHE_SIZE', 1024)
+    app.config.setdefault('USER_CACHE_TTL', 60)
+    app.config.setdefault('USER_CACHE_URL', None)
+    user_cache.max_size = app.config['USER_CACHE_SIZE']
+    user_cache.ttl = app.config['USER_CACHE_TTL']
+    if app.config['USER_CACHE_URL']:
+        user_cache.backend = RedisBackend(app.config['USER_CACHE_URL'])
@@ -0,0 +1,34 @@
+"""
+WSGI entry point
+
+Serverless hosts import this module once per cold start. A preforking
+server can build the app once and fork workers from it:
+
+    gunicorn --preload --workers 4 wsgi:app
+
+Creating the app touches neither the database nor any thread or process
+pool; those are opened lazily in each worker. Each worker starts its
+EMAIL_WORKERS outbox threads on its first request, which also sends mail
+left pending by a restart. To send from a separate process instead, set
+EMAIL_WORKERS=0 and run `flask outbox-worker` alongside the web server.
+
+Serverless hosts freeze background threads once a response is sent, so
+with DB_SERVERLESS (or VERCEL) set EMAIL_WORKERS defaults to 0 and each
+request that queues mail sends up to OUTBOX_INLINE_BATCH messages itself
+after its commit. Retries and anything left over need a scheduled
+
+    flask drain-outbox
+
+e.g. a cron job every few minutes with the same environment.
+
+Live forum updates (LIVE_ENABLED) keep a request open per browser tab,
+so they need a threaded, gevent or ASGI worker, e.g.
+
+    gunicorn --preload --workers 4 --threads 32 wsgi:app
+
+With sync workers every open tab ties up a whole worker; on serverless
+hosts live updates stay off whatever LIVE_ENABLED says.
+"""
+from app import create_app
+
+app = create_app()